@@ -0,0 +1,215 @@
+# pipeline.py - times each stage of the newsletter pipeline on its own
+#
+# Meant for a database from data/generate_data.py. Run from the repository
+# root:
+#
+#   python data/generate_data.py --db data/bench.db
+#   python bench/pipeline.py --db data/bench.db [--limit 2000] [--repeat 3] [--json]
+#
+# Stages:
+#   selection  pending_newsletters() over the whole database
+#   render     newsletters for the first --limit customers, fresh renderer
+#   mime       build_message() for the rendered newsletters
+#   send       the messages through DispatchEngine to bench/smtp_sink.py
+#   matrix     the Categories & Matrix tab in Matrix View until it is filled
+#
+# Every stage reports the median of --repeat runs. With --json the result
+# has a fixed layout (sorted keys, same fields every run) so the output of
+# two commits can be diffed or compared by a script.
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from bench.smtp_sink import SMTPSink
+from core.db import get_connection
+from core.dispatch import current_quarter
+from core.email_sender import NewsletterRenderer, SMTPConnectionPool, DispatchEngine, OutgoingMessage, build_message
+from core.models import pending_newsletters
+from core.settings import Settings
+
+STAGES = ("selection", "render", "mime", "send", "matrix")
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def table_counts(conn):
+    tables = ("Customers", "CustomerEmails", "Categories", "CustomerCategoryMapping", "RegulatoryChanges")
+    return {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in tables}
+
+
+class Pipeline:
+    # Each stage method runs once and returns the number of items it
+    # processed; anything a stage needs from an earlier one is prepared
+    # outside the timed call.
+    def __init__(self, db_path, settings, limit, workers):
+        self.db_path = db_path
+        self.settings = settings
+        self.limit = limit
+        self.workers = workers
+        self.quarter = current_quarter()
+        self.newsletters = None
+        self.rendered = None
+        self.messages = None
+
+    def selection(self):
+        customers = 0
+        for customer, changes in pending_newsletters(get_connection(self.db_path)):
+            customers += 1
+        return customers
+
+    def prepare_newsletters(self):
+        if self.newsletters is None:
+            newsletters = []
+            for customer, changes in pending_newsletters(get_connection(self.db_path)):
+                newsletters.append((customer, changes))
+                if len(newsletters) == self.limit:
+                    break
+            self.newsletters = newsletters
+        return self.newsletters
+
+    def new_renderer(self):
+        # No bytecode cache, empty fragment and skeleton caches: a cold run
+        config = self.settings.config
+        return NewsletterRenderer(
+            config['APP']['template_path'], subject_template=config['NEWSLETTER'].get('subject_template'),
+        )
+
+    def render(self):
+        renderer = self.new_renderer()
+        rendered = []
+        for customer, changes in self.prepare_newsletters():
+            subject = renderer.render_subject(self.quarter, customer["name"])
+            for email in customer["emails"]:
+                rendered.append((email, subject, renderer.render(self.quarter, customer["name"], email, changes)))
+        self.rendered = rendered
+        return len(rendered)
+
+    def mime(self):
+        if self.rendered is None:
+            self.render()
+        from_email = self.settings.config['NEWSLETTER']['from_email']
+        from_name = self.settings.config['NEWSLETTER'].get('from_name')
+        messages = [
+            OutgoingMessage(from_email, email, build_message(html, subject, from_email, email, from_name))
+            for email, subject, html in self.rendered
+        ]
+        self.messages = messages
+        return len(messages)
+
+    def send(self):
+        if self.messages is None:
+            self.mime()
+        sink = SMTPSink().start()
+        pool = SMTPConnectionPool("127.0.0.1", sink.port, size=self.workers)
+        try:
+            results = DispatchEngine(pool, self.workers).send(iter(self.messages))
+        finally:
+            pool.close()
+            sink.stop()
+        failed = [error for _, error in results if error is not None]
+        if failed:
+            raise RuntimeError(f"{len(failed)} messages failed, first error: {failed[0]}")
+        return sink.counts()["messages"]
+
+    def matrix(self):
+        from PySide6.QtWidgets import QApplication
+        from ui.category_matrix import CategoryMatrixTab
+        from ui.tasks import TaskRunner
+        app = QApplication.instance() or QApplication(sys.argv[:1])
+        tasks = TaskRunner()
+        tab = CategoryMatrixTab(self.db_path, tasks)
+        tab.resize(1200, 800)
+        tab.show()
+        tab.mode_selector.setCurrentText("Matrix View")
+        while tasks.active():
+            tasks.wait(10)
+            app.processEvents()
+        app.processEvents()
+        cells = tab.matrix_model.rowCount() * tab.matrix_model.columnCount()
+        tab.close()
+        tab.deleteLater()
+        app.processEvents()
+        return cells
+
+
+def run_stage(pipeline, name, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        items = getattr(pipeline, name)()
+        times.append(time.perf_counter() - started)
+    median = statistics.median(times)
+    return {
+        "items": items,
+        "median_ms": round(median * 1000, 3),
+        "min_ms": round(min(times) * 1000, 3),
+        "per_second": round(items / median, 1) if median else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage benchmark of the newsletter pipeline")
+    parser.add_argument("--db", default="data/bench.db")
+    parser.add_argument("--config", default=os.path.join(ROOT, "config.ini"))
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"comma separated, from {', '.join(STAGES)}")
+    parser.add_argument("--limit", type=int, default=2000, help="customers rendered, built and sent")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--output", help="also write the JSON result to this file")
+    args = parser.parse_args()
+
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(sorted(unknown))}")
+    if not os.path.exists(args.db):
+        parser.error(f"{args.db} not found, create it with data/generate_data.py")
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    db_path = os.path.abspath(args.db)
+    os.chdir(ROOT)
+
+    pipeline = Pipeline(db_path, Settings(args.config), args.limit, args.workers)
+    result = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "limit": args.limit,
+        "repeat": args.repeat,
+        "workers": args.workers,
+        "database": table_counts(get_connection(db_path)),
+        "stages": {name: run_stage(pipeline, name, args.repeat) for name in stages},
+    }
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    if args.json:
+        print(output)
+    else:
+        print(f"{args.db}: " + ", ".join(f"{count} {table}" for table, count in result["database"].items()))
+        print(f"Median of {args.repeat} runs:")
+        for name, stage in result["stages"].items():
+            print(f"  {name:<12}{stage['median_ms']:10.1f} ms  {stage['items']:>9} items  "
+                  f"{stage['per_second'] or 0:>10.0f}/s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
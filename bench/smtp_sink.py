@@ -0,0 +1,151 @@
+# smtp_sink.py - local SMTP server that accepts and discards every message
+#
+# Used by bench/pipeline.py for the send stage. It can also run on its own
+# to point a real dispatch at it (host/port in config.ini, use_tls = no):
+#
+#   python bench/smtp_sink.py [--port 2525] [--delay-ms 0] [--max-recipients 0] [--throttle-every 0]
+#
+# It speaks just enough SMTP for smtplib: EHLO/HELO, AUTH (always
+# accepted), MAIL, RCPT, DATA, RSET, NOOP and QUIT.
+import argparse
+import socketserver
+import threading
+import time
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        sink = self.server
+        with sink.lock:
+            sink.connections += 1
+        self.reply("220 smtp-sink ready")
+        recipients = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b"EHLO", b"HELO"):
+                self.reply("250-smtp-sink", "250-AUTH PLAIN LOGIN", "250-8BITMIME", "250 SIZE 0")
+            elif command == b"AUTH":
+                self.reply("235 Authentication successful")
+            elif command == b"MAIL":
+                recipients = 0
+                self.reply("250 OK")
+            elif command == b"RCPT":
+                if sink.max_recipients and recipients >= sink.max_recipients:
+                    self.reply("452 4.5.3 Too many recipients")
+                    continue
+                recipients += 1
+                self.reply("250 OK")
+            elif command == b"DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                for data in self.rfile:
+                    if data == b".\r\n":
+                        break
+                    size += len(data)
+                if sink.delay:
+                    time.sleep(sink.delay)
+                with sink.lock:
+                    sink.received += 1
+                    throttle = sink.throttle_every and sink.received % sink.throttle_every == 0
+                    if throttle:
+                        sink.throttled += 1
+                    else:
+                        sink.messages += 1
+                        sink.recipients += recipients
+                        sink.bytes += size
+                if throttle:
+                    self.reply(sink.throttle_reply)
+                    if sink.throttle_reply.startswith("421"):
+                        # 421 ends the session
+                        return
+                    continue
+                self.reply("250 OK")
+            elif command == b"QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                # RSET, NOOP and anything else
+                self.reply("250 OK")
+
+    def reply(self, *lines):
+        self.wfile.write("".join(f"{line}\r\n" for line in lines).encode())
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    # Counts connections, messages, recipients and bytes; delay is the time
+    # each DATA takes to be acknowledged, max_recipients the RCPT limit per
+    # message and throttle_every N answers every Nth DATA with
+    # throttle_reply instead, to mimic a remote server
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, delay=0.0, max_recipients=0, throttle_every=0,
+                 throttle_reply="451 4.7.1 Rate limit exceeded, try again later"):
+        super().__init__((host, port), SinkHandler)
+        self.delay = delay
+        self.max_recipients = max_recipients
+        self.throttle_every = throttle_every
+        self.throttle_reply = throttle_reply
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.received = 0
+        self.throttled = 0
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def counts(self):
+        with self.lock:
+            return {
+                "connections": self.connections,
+                "messages": self.messages,
+                "recipients": self.recipients,
+                "bytes": self.bytes,
+                "throttled": self.throttled,
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SMTP server that discards all mail")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2525)
+    parser.add_argument("--delay-ms", type=float, default=0, help="delay before acknowledging each message")
+    parser.add_argument("--max-recipients", type=int, default=0, help="RCPT limit per message, 0 = none")
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every Nth message with 451, 0 = never")
+    args = parser.parse_args()
+
+    sink = SMTPSink(args.host, args.port, args.delay_ms / 1000, args.max_recipients, args.throttle_every).start()
+    print(f"SMTP sink listening on {args.host}:{sink.port}, Ctrl+C to stop")
+    last = None
+    try:
+        while True:
+            time.sleep(5)
+            counts = sink.counts()
+            if counts != last:
+                print(", ".join(f"{value} {key}" for key, value in counts.items()))
+                last = counts
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# startup.py - measures time-to-login-window and time-to-main-window
+#
+# Every run starts a fresh interpreter, so imports are measured cold the
+# way a user sees them. Run from the repository root:
+#
+#   python bench/startup.py [--runs 5] [--json] [--max-login-ms 400] [--max-main-ms 1500]
+#
+# Exits with 1 when a median is above its --max-* limit, so the script can
+# guard against startup regressions in CI or before a release.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Packages listed separately in the import-time breakdown; core.* and ui.*
+# modules are always listed one by one
+BREAKDOWN = ("PySide6", "shiboken6", "shibokensupport", "jinja2", "markupsafe", "sqlite3", "smtplib", "email")
+
+
+def measure():
+    # Child process: prints one JSON line with timings in milliseconds
+    start = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    from PySide6.QtWidgets import QApplication
+    from ui.login import LoginWindow
+    imported = time.perf_counter()
+
+    app = QApplication(sys.argv[:1])
+    login = LoginWindow()
+    login.show()
+    app.processEvents()
+    login_shown = time.perf_counter()
+
+    from core.db import get_connection
+    from core.settings import settings
+    conn = get_connection(settings.db_path)
+    user_id, username = conn.execute("SELECT id, username FROM Users LIMIT 1").fetchone()
+    login.accept_login(user_id, username)
+    app.processEvents()
+    main_shown = time.perf_counter()
+
+    # Initial loads run as background tasks; wait until the window is filled
+    window = login.main_window
+    while window.tasks.active():
+        window.tasks.wait(10)
+        app.processEvents()
+    main_loaded = time.perf_counter()
+    window.close()
+
+    print(json.dumps({
+        "imports": (imported - start) * 1000,
+        "login_window": (login_shown - start) * 1000,
+        "main_window": (main_shown - start) * 1000,
+        "main_window_loaded": (main_loaded - start) * 1000,
+    }))
+
+
+def run_child(env):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child"],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def import_breakdown(env):
+    # Self import time (ms) summed per package from -X importtime; the
+    # values add up to the total import time without double counting
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", os.path.abspath(__file__), "--child"],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    ).stderr
+    totals = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        own, _, name = line[len("import time:"):].split("|")
+        if not own.strip().isdigit():
+            continue  # header line
+        name = name.strip()
+        package = name.split(".")[0]
+        if package in ("core", "ui"):
+            key = name
+        elif package in BREAKDOWN:
+            key = package
+        else:
+            key = "other"
+        totals[key] = totals.get(key, 0) + int(own) / 1000
+    return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup benchmark for the newsletter app")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--max-login-ms", type=float)
+    parser.add_argument("--max-main-ms", type=float)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure()
+        return 0
+
+    env = dict(os.environ)
+    env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    runs = [run_child(env) for _ in range(args.runs)]
+    medians = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+    result = {"runs": args.runs, "median_ms": medians, "imports_ms": import_breakdown(env)}
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(f"Median of {args.runs} cold starts:")
+        for key, value in medians.items():
+            print(f"  {key:<20}{value:8.1f} ms")
+        print("Import time by package:")
+        for key, value in result["imports_ms"].items():
+            print(f"  {key:<20}{value:8.1f} ms")
+
+    failed = False
+    for limit, key in ((args.max_login_ms, "login_window"), (args.max_main_ms, "main_window")):
+        if limit is not None and medians[key] > limit:
+            print(f"{key}: {medians[key]:.1f} ms exceeds limit of {limit:.0f} ms", file=sys.stderr)
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
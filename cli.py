@@ -0,0 +1,263 @@
+# cli.py - headless entry point for cron/systemd runs, never imports Qt
+#
+#   python cli.py dispatch [--quarter "Q3 2025"] [--workers 4] [--dry-run] [--retry-interrupted] [--metrics]
+#   python cli.py preview --customer 12 [--output preview.html]
+#   python cli.py stats
+#   python cli.py archive [--quarter "Q3 2025"] [--pdf] [--workers 8] [--output archive]
+#   python cli.py track [--port 8025]
+#   python cli.py import customers.csv [--dry-run] [--replace]
+#   python cli.py export customers.xlsx
+#   python cli.py bounces [--mailbox /var/mail/newsletter]
+import argparse
+import sys
+from core.archive import archive_quarter, ArchiveError
+from core.bounces import process_bounces, BounceError
+from core.bulk_io import import_customers, export_customers, BulkIOError
+from core.db import get_connection
+from core.dispatch import run_dispatch, current_quarter
+from core.dispatch_queue import RunInProgress
+from core.email_sender import format_progress
+from core.models import pending_newsletters
+from core.settings import Settings, CONFIG_PATH
+
+
+def print_progress(snapshot):
+    print(f"\r{format_progress(snapshot)}\033[K", end="", file=sys.stderr, flush=True)
+
+
+def print_metrics(snapshot):
+    # Slowest stage first; counters after the table
+    print(f"{'stage':<20}{'count':>8}{'total s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+          file=sys.stderr)
+    for stage, figures in sorted(snapshot["stages"].items(), key=lambda item: -item[1]["total_ms"]):
+        print(f"{stage:<20}{figures['count']:>8}{figures['total_ms'] / 1000:>10.2f}{figures['p50_ms']:>10.1f}"
+              f"{figures['p95_ms']:>10.1f}{figures['p99_ms']:>10.1f}{figures['max_ms']:>10.1f}", file=sys.stderr)
+    for name, value in snapshot["counters"].items():
+        print(f"{name:<20}{value:>8}", file=sys.stderr)
+
+
+def cmd_dispatch(args, settings):
+    try:
+        summary = run_dispatch(
+            settings, args.quarter, args.workers, args.dry_run, retry_interrupted=args.retry_interrupted,
+            # Live figures only on a terminal, cron mails would fill up otherwise
+            on_progress=print_progress if sys.stderr.isatty() else None,
+        )
+    except RunInProgress as e:
+        print(e, file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        print("Interrupted, run the command again to resume", file=sys.stderr)
+        return 130
+    if sys.stderr.isatty():
+        print(file=sys.stderr)
+    if summary.get("resumed"):
+        print(f"Resumed run {summary['run_id']}")
+    prefix = "Would send" if args.dry_run else "Sent"
+    print(f"{prefix} {summary['sent']} messages to {summary['customers']} customers ({summary['quarter']})")
+    if args.metrics and "metrics" in summary:
+        print_metrics(summary["metrics"])
+    if summary["failed"]:
+        print(f"{summary['failed']} messages failed, see log for details")
+        return 1
+    return 0
+
+
+def cmd_preview(args, settings):
+    conn = get_connection(settings.db_path)
+    for customer, changes in pending_newsletters(conn):
+        if customer["id"] != args.customer:
+            continue
+        email = customer["emails"][0] if customer["emails"] else ""
+        html = settings.renderer.render(
+            args.quarter or current_quarter(), customer["name"], email, changes
+        )
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(html)
+        else:
+            print(html)
+        return 0
+    print(f"No pending changes for customer {args.customer}", file=sys.stderr)
+    return 1
+
+
+def cmd_stats(args, settings):
+    conn = get_connection(settings.db_path)
+    customers, active = conn.execute("SELECT COUNT(*), COALESCE(SUM(active = 1), 0) FROM Customers").fetchone()
+    print(f"Customers:          {customers} ({active} active)")
+    emails, suppressed = conn.execute("SELECT COUNT(*), COUNT(suppressed_at) FROM CustomerEmails").fetchone()
+    print(f"Email addresses:    {emails} ({suppressed} suppressed after bounces)")
+    for label, table in (("Categories:", "Categories"), ("Regulatory changes:", "RegulatoryChanges")):
+        print(f"{label:<20}{conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]}")
+
+    pending_customers = set()
+    pending_messages = 0
+    for customer, _ in pending_newsletters(conn):
+        if customer["emails"]:
+            pending_customers.add(customer["id"])
+            pending_messages += len(customer["emails"])
+    print(f"Pending:            {pending_messages} messages to {len(pending_customers)} customers")
+
+    last = conn.execute("""
+        SELECT r.id, r.quarter, r.started_at, r.finished_at,
+               SUM(d.status = 'sent'), SUM(d.status = 'failed'), SUM(d.status = 'pending'),
+               COUNT(d.opened_at), COUNT(d.clicked_at)
+        FROM DispatchRuns r
+        JOIN NewsletterDispatch d ON d.run_id = r.id
+        WHERE r.id = (SELECT MAX(id) FROM DispatchRuns)
+    """).fetchone()
+    if last[0]:
+        run_id, quarter, started_at, finished_at, sent, failed, pending, opened, clicked = last
+        state = "finished" if finished_at else f"unfinished, {pending} pending"
+        print(f"Last run:           #{run_id} {quarter} at {started_at} ({sent} sent, {failed} failed, {state})")
+        if opened or clicked:
+            print(f"Tracked:            {opened} opened, {clicked} clicked")
+    return 0
+
+
+def cmd_archive(args, settings):
+    def progress(summary):
+        print(f"\rArchived {summary['customers']} customers ({summary['written']} written, "
+              f"{summary['unchanged']} unchanged)\033[K", end="", file=sys.stderr, flush=True)
+
+    try:
+        summary = archive_quarter(
+            settings, args.quarter or current_quarter(), args.output, True if args.pdf else None, args.workers,
+            on_progress=progress if sys.stderr.isatty() else None,
+        )
+    except ArchiveError as e:
+        print(e, file=sys.stderr)
+        return 2
+    if sys.stderr.isatty():
+        print(file=sys.stderr)
+    print(f"{summary['quarter']}: {summary['customers']} newsletters in {summary['directory']} "
+          f"({summary['written']} written, {summary['unchanged']} unchanged, {summary['removed']} removed) "
+          f"in {summary['seconds']:.1f}s")
+    if summary["failed"]:
+        print(f"{summary['failed']} newsletters failed, see log for details")
+        return 1
+    return 0
+
+
+def cmd_track(args, settings):
+    from core.tracking import TrackingServer
+    tracker = settings.tracker
+    if tracker is None:
+        print("Tracking is disabled, set [TRACKING] enabled = yes", file=sys.stderr)
+        return 2
+    server = TrackingServer.from_config(tracker, settings.db_path, settings.config)
+    if args.port is not None:
+        server.port = args.port
+    print(f"Tracking endpoint on {server.host}:{server.port} for {tracker.base_url}, Ctrl+C to stop")
+    server.run()
+    return 0
+
+
+def cmd_import(args, settings):
+    def progress(rows):
+        print(f"\rRead {rows} rows\033[K", end="", file=sys.stderr, flush=True)
+
+    try:
+        summary = import_customers(
+            settings.db_path, args.file, args.dry_run, args.replace,
+            on_progress=progress if sys.stderr.isatty() else None,
+        )
+    except BulkIOError as e:
+        print(e, file=sys.stderr)
+        return 2
+    if sys.stderr.isatty():
+        print(file=sys.stderr)
+    for error in summary["errors"]:
+        print(error, file=sys.stderr)
+    if summary["invalid"] > len(summary["errors"]):
+        print(f"... {summary['invalid'] - len(summary['errors'])} more", file=sys.stderr)
+    prefix = "Would import" if args.dry_run else "Imported"
+    print(f"{prefix} {summary['rows'] - summary['invalid']} of {summary['rows']} rows in {summary['seconds']:.1f}s")
+    for key in ("customers_added", "customers_updated", "emails_added", "emails_removed", "emails_suppressed",
+                "mappings_added", "mappings_removed"):
+        print(f"  {key.replace('_', ' '):<20}{summary[key]:>8}")
+        if args.dry_run:
+            for sample in summary["samples"][key]:
+                print(f"      {sample}")
+    return 1 if summary["invalid"] else 0
+
+
+def cmd_export(args, settings):
+    try:
+        written = export_customers(settings.db_path, args.file)
+    except BulkIOError as e:
+        print(e, file=sys.stderr)
+        return 2
+    print(f"Exported {written} customers to {args.file}")
+    return 0
+
+
+def cmd_bounces(args, settings):
+    try:
+        summary = process_bounces(settings, args.mailbox)
+    except BounceError as e:
+        print(e, file=sys.stderr)
+        return 2
+    print(f"{summary['messages']} new messages in {summary['mailbox']}: {summary['hard']} hard and "
+          f"{summary['soft']} soft bounces, {summary['suppressed']} addresses suppressed"
+          + (f", {summary['unknown']} not in the database" if summary["unknown"] else ""))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ISO 50001 newsletter batch tool")
+    parser.add_argument("--config", default=CONFIG_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    dispatch = commands.add_parser("dispatch", help="send the newsletter to all pending customers")
+    dispatch.add_argument("--quarter", help="label used in subject and body, default: current quarter")
+    dispatch.add_argument("--workers", type=int, help="parallel SMTP sessions, default: [SMTP] pool_size")
+    dispatch.add_argument("--dry-run", action="store_true", help="render everything, send nothing")
+    dispatch.add_argument("--retry-interrupted", action="store_true",
+                          help="when resuming, resend messages whose delivery was cut off (may duplicate)")
+    dispatch.add_argument("--metrics", action="store_true", help="print time spent per stage to stderr")
+    dispatch.set_defaults(handler=cmd_dispatch)
+
+    preview = commands.add_parser("preview", help="render one customer's pending newsletter")
+    preview.add_argument("--customer", type=int, required=True)
+    preview.add_argument("--quarter")
+    preview.add_argument("--output", help="write HTML to this file instead of stdout")
+    preview.set_defaults(handler=cmd_preview)
+
+    stats = commands.add_parser("stats", help="print database and dispatch figures")
+    stats.set_defaults(handler=cmd_stats)
+
+    archive = commands.add_parser("archive", help="write every customer's quarter newsletter to disk for audits")
+    archive.add_argument("--quarter", help="e.g. \"Q3 2025\", default: current quarter")
+    archive.add_argument("--pdf", action="store_true", help="also write PDFs (needs WeasyPrint), default: [ARCHIVE] pdf")
+    archive.add_argument("--workers", type=int, help="processes, default: [ARCHIVE] workers or one per CPU")
+    archive.add_argument("--output", help="base directory, default: [ARCHIVE] directory")
+    archive.set_defaults(handler=cmd_archive)
+
+    track = commands.add_parser("track", help="serve the open/click tracking endpoint")
+    track.add_argument("--port", type=int, help="default: [TRACKING] port")
+    track.set_defaults(handler=cmd_track)
+
+    bulk_import = commands.add_parser("import", help="add or update customers, emails and categories from CSV/XLSX")
+    bulk_import.add_argument("file", help="columns id, name, active, emails, category_ids, suppressed; .xlsx needs openpyxl")
+    bulk_import.add_argument("--dry-run", action="store_true", help="show what would change, change nothing")
+    bulk_import.add_argument("--replace", action="store_true",
+                             help="remove emails and categories of listed customers that the file doesn't have")
+    bulk_import.set_defaults(handler=cmd_import)
+
+    export = commands.add_parser(
+        "export", help="write all customers with emails, categories and suppressed emails to CSV/XLSX")
+    export.add_argument("file")
+    export.set_defaults(handler=cmd_export)
+
+    bounces = commands.add_parser("bounces", help="suppress addresses that bounced, from a local mbox or Maildir")
+    bounces.add_argument("--mailbox", help="mbox file or Maildir directory, default: [BOUNCES] mailbox")
+    bounces.set_defaults(handler=cmd_bounces)
+
+    args = parser.parse_args(argv)
+    return args.handler(args, Settings(args.config))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
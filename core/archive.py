@@ -0,0 +1,231 @@
+# archive.py - every customer's newsletter of a quarter as HTML (optionally PDF), rendered on all cores
+#
+#   archive/2025-Q3/manifest.json   quarter, period, one entry per customer with its SHA-256
+#   archive/2025-Q3/12.html         newsletter of customer 12
+#   archive/2025-Q3/12.pdf          the same as PDF (pdf = yes, needs WeasyPrint)
+#
+# A customer's quarter newsletter holds the changes in its categories added
+# during the quarter. Re-running a quarter rewrites only documents whose
+# content hash differs from the manifest, so a nightly run is cheap.
+import concurrent.futures
+import hashlib
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+import time
+from datetime import date, datetime
+from core.db import get_connection
+from core.models import quarter_newsletters
+
+MANIFEST_NAME = "manifest.json"
+QUARTER_PATTERN = re.compile(r"Q([1-4])\s+(\d{4})")
+
+# Per-process state of a pool worker, set up once by init_worker()
+_worker = {}
+
+
+def current_umask():
+    # The umask can only be read by setting it; done once at import, before
+    # any threads exist
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+# What open() would give a new file; mkstemp() creates them 0600
+FILE_MODE = 0o666 & ~current_umask()
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def parse_quarter(quarter):
+    match = QUARTER_PATTERN.fullmatch(quarter.strip())
+    if not match:
+        raise ArchiveError(f"Quarter must look like 'Q3 2025', got '{quarter}'")
+    return int(match.group(1)), int(match.group(2))
+
+
+def quarter_range(quarter):
+    # [start, end) as dates; compares correctly with added_at timestamps
+    number, year = parse_quarter(quarter)
+    start = date(year, 3 * number - 2, 1)
+    end = date(year + 1, 1, 1) if number == 4 else date(year, 3 * number + 1, 1)
+    return start.isoformat(), end.isoformat()
+
+
+def atomic_write(path, data):
+    # Readers see the old file or the new one, never a partial write: the
+    # data goes to a temporary file in the same directory that is renamed
+    # over the target
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if hasattr(os, "fchmod"):
+                # Not on Windows, where mkstemp() files aren't restricted
+                os.fchmod(f.fileno(), FILE_MODE)
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logging.warning(f"Ignoring unreadable archive manifest in {directory}: {e}")
+        return {}
+    return {entry["customer_id"]: entry for entry in manifest.get("customers", [])}
+
+
+def init_worker(template_path, cache_dir, pdf):
+    from core.email_sender import NewsletterRenderer
+    _worker["renderer"] = NewsletterRenderer(template_path, cache_dir=cache_dir)
+    _worker["base_url"] = os.path.dirname(os.path.abspath(template_path))
+    if pdf:
+        from weasyprint import HTML
+        _worker["pdf"] = HTML
+
+
+def render_chunk(directory, quarter, year, chunk):
+    # Runs in a pool worker. chunk: (customer, changes, manifest entry of
+    # the previous run or None). Returns one manifest entry per customer.
+    renderer = _worker["renderer"]
+    pdf = _worker.get("pdf")
+    entries = []
+    for customer, changes, previous in chunk:
+        entry = {
+            "customer_id": customer["id"],
+            "name": customer["name"],
+            "emails": customer["emails"],
+            "change_ids": [change["id"] for change in changes],
+            "html": f"{customer['id']}.html",
+        }
+        try:
+            # The year is the quarter's, so the footer doesn't change the
+            # hash of an old quarter when it is re-run in a later year
+            html = renderer.render(quarter, customer["name"], ", ".join(customer["emails"]), changes, year)
+            data = html.encode("utf-8")
+            entry["sha256"] = hashlib.sha256(data).hexdigest()
+            unchanged = previous is not None and previous.get("sha256") == entry["sha256"]
+            written = False
+            html_path = os.path.join(directory, entry["html"])
+            if not (unchanged and os.path.exists(html_path)):
+                atomic_write(html_path, data)
+                written = True
+            if pdf:
+                entry["pdf"] = f"{customer['id']}.pdf"
+                pdf_path = os.path.join(directory, entry["pdf"])
+                if not (unchanged and os.path.exists(pdf_path)):
+                    atomic_write(pdf_path, pdf(string=html, base_url=_worker["base_url"]).write_pdf())
+                    written = True
+            entry["status"] = "written" if written else "unchanged"
+        except Exception as e:
+            entry["status"] = "failed"
+            entry["error"] = str(e)
+        entries.append(entry)
+    return entries
+
+
+def chunked(newsletters, previous, size):
+    chunk = []
+    for customer, changes in newsletters:
+        chunk.append((customer, changes, previous.get(customer["id"])))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def archive_quarter(settings, quarter, directory=None, pdf=None, workers=None, chunk_size=None, on_progress=None):
+    # Selection streams from SQLite in this process; rendering, hashing and
+    # writing run in a process pool, one chunk of customers per task. Changes
+    # shared by customers of a chunk are pickled once per chunk. At most two
+    # chunks per worker are in flight, so memory stays flat however many
+    # customers there are. on_progress(summary) after every chunk.
+    config = settings.config
+    # [ARCHIVE] in config.ini, all keys optional; arguments take precedence
+    directory = directory or config.get('ARCHIVE', 'directory', fallback='archive')
+    pdf = config.getboolean('ARCHIVE', 'pdf', fallback=False) if pdf is None else pdf
+    workers = workers or config.getint('ARCHIVE', 'workers', fallback=0) or os.cpu_count() or 1
+    chunk_size = chunk_size or config.getint('ARCHIVE', 'chunk_size', fallback=50)
+    if pdf and importlib.util.find_spec("weasyprint") is None:
+        raise ArchiveError("PDF output needs WeasyPrint: pip install weasyprint")
+
+    number, year = parse_quarter(quarter)
+    start, end = quarter_range(quarter)
+    target = os.path.join(directory, f"{year}-Q{number}")
+    os.makedirs(target, exist_ok=True)
+    previous = load_manifest(target)
+
+    started = time.perf_counter()
+    summary = {"quarter": quarter, "directory": target, "customers": 0, "written": 0, "unchanged": 0, "failed": 0}
+    entries = []
+
+    def collect(future):
+        for entry in future.result():
+            summary["customers"] += 1
+            summary[entry["status"]] += 1
+            if entry["status"] == "failed":
+                logging.error(f"Archiving newsletter of customer {entry['customer_id']} failed: {entry['error']}")
+            entry.pop("status")
+            entries.append(entry)
+        if on_progress:
+            on_progress(dict(summary))
+
+    chunks = chunked(quarter_newsletters(get_connection(settings.db_path), start, end), previous, chunk_size)
+    # spawn, not fork: the audit and log writer threads may hold locks at fork time
+    with concurrent.futures.ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker,
+        initargs=(config['APP']['template_path'], config['APP'].get('template_cache_dir'), pdf),
+    ) as pool:
+        in_flight = set()
+        for chunk in chunks:
+            if len(in_flight) >= workers * 2:
+                done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+            in_flight.add(pool.submit(render_chunk, target, quarter, year, chunk))
+        for future in concurrent.futures.as_completed(in_flight):
+            collect(future)
+
+    # Customers archived before but without changes this time (deactivated,
+    # unmapped, change deleted): their files go, so the directory always
+    # matches the manifest
+    current = {entry["customer_id"] for entry in entries}
+    summary["removed"] = 0
+    for customer_id, entry in previous.items():
+        if customer_id in current:
+            continue
+        for name in (entry.get("html"), entry.get("pdf")):
+            if name and os.path.exists(os.path.join(target, name)):
+                os.remove(os.path.join(target, name))
+        summary["removed"] += 1
+
+    entries.sort(key=lambda entry: entry["customer_id"])
+    manifest = {
+        "quarter": quarter,
+        "period": {"start": start, "end": end},
+        "generated_at": datetime.now().isoformat(timespec="seconds"),
+        "pdf": pdf,
+        "customers": entries,
+    }
+    atomic_write(os.path.join(target, MANIFEST_NAME),
+                 json.dumps(manifest, ensure_ascii=False, indent=1).encode("utf-8"))
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    logging.info(
+        f"Archived {quarter} to {target}: {summary['written']} written, {summary['unchanged']} unchanged, "
+        f"{summary['failed']} failed, {summary['removed']} removed in {summary['seconds']}s with {workers} processes"
+    )
+    return summary
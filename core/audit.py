@@ -0,0 +1,176 @@
+# audit.py - buffered AuditLog writer and audit trail queries
+import atexit
+import json
+import logging
+import threading
+import time
+from core.db import get_connection, transaction
+from core.metrics import metrics
+
+# Defaults for logs created by audit_log(), from [AUDIT] in config.ini
+DEFAULTS = {}
+
+INSERT_SQL = "INSERT INTO AuditLog (user_id, action, table_name, row_id, timestamp, details) VALUES (?, ?, ?, ?, ?, ?)"
+
+
+class AuditLog:
+    # record() only appends to an in-memory list, so auditing adds no I/O to
+    # the action itself. A background thread writes the buffer in one
+    # transaction once batch_size events are waiting or flush_interval
+    # seconds have passed; close() (also run at exit) writes the rest. Events
+    # keep the time they happened, not the time they were flushed. A hard
+    # crash loses at most the last flush_interval seconds of events.
+    def __init__(self, db_path, batch_size=500, flush_interval=2.0, enabled=True):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        # Default for record(); the login window sets it
+        self.user_id = None
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = None
+
+    def record(self, action, table_name=None, row_id=None, details=None, user_id=None):
+        # details: anything json.dumps accepts, stored as JSON text
+        if not self.enabled:
+            return
+        event = (
+            self.user_id if user_id is None else user_id,
+            action,
+            table_name,
+            row_id,
+            # Same format and UTC clock as CURRENT_TIMESTAMP
+            time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
+            None if details is None else json.dumps(details, ensure_ascii=False, default=str),
+        )
+        with self._lock:
+            self._buffer.append(event)
+            closed = self._closed
+            full = len(self._buffer) >= self.batch_size
+            if self._thread is None and not closed:
+                self._start()
+        if closed:
+            # Nothing flushes after close(), so write through
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Writing audit log failed: {e}")
+        elif full:
+            self._wake.set()
+
+    def flush(self):
+        # Writes everything recorded so far; returns the number of events
+        with self._flush_lock:
+            with self._lock:
+                events, self._buffer = self._buffer, []
+            if events:
+                self._write(events)
+            return len(events)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(self.flush_interval + 5)
+        self.flush()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name="AuditLog", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # Keep the thread alive; the events are retried by the next flush
+                logging.error(f"Writing audit log failed: {e}")
+
+    def _write(self, events):
+        try:
+            with metrics.timer("db.audit_flush"), transaction(self.db_path) as conn:
+                conn.executemany(INSERT_SQL, events)
+        except Exception:
+            with self._lock:
+                self._buffer[:0] = events
+            raise
+
+
+_logs = {}
+_logs_lock = threading.Lock()
+
+
+def audit_log(db_path):
+    # One shared writer per database file, like get_connection()
+    log = _logs.get(db_path)
+    if log is None:
+        with _logs_lock:
+            log = _logs.get(db_path)
+            if log is None:
+                log = _logs[db_path] = AuditLog(db_path, **DEFAULTS)
+    return log
+
+
+def configure_audit(config):
+    # [AUDIT] section of config.ini, all keys optional
+    if not config.has_section('AUDIT'):
+        return
+    section = config['AUDIT']
+    DEFAULTS["enabled"] = section.getboolean('enabled', fallback=True)
+    DEFAULTS["batch_size"] = section.getint('batch_size', fallback=500)
+    DEFAULTS["flush_interval"] = section.getfloat('flush_interval', fallback=2.0)
+
+
+def audit_entries(conn, user_id=None, table_name=None, row_id=None, before=None, limit=100):
+    # Newest first as (id, timestamp, user_id, username, action, table_name,
+    # row_id, details). Filters combine; `before` is the smallest id of the
+    # previous page. Each filter has an index that already yields its rows in
+    # id order (idx_audit_user, idx_audit_table, idx_audit_row), so a page
+    # is read without sorting however long the log gets.
+    conditions = []
+    params = []
+    if user_id is not None:
+        conditions.append("a.user_id = ?")
+        params.append(user_id)
+    if table_name is not None:
+        conditions.append("a.table_name = ?")
+        params.append(table_name)
+    if row_id is not None:
+        conditions.append("a.row_id = ?")
+        params.append(row_id)
+    if before is not None:
+        conditions.append("a.id < ?")
+        params.append(before)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    return conn.execute(f"""
+        SELECT a.id, a.timestamp, a.user_id, u.username, a.action, a.table_name, a.row_id, a.details
+        FROM AuditLog a
+        LEFT JOIN Users u ON u.id = a.user_id{where}
+        ORDER BY a.id DESC
+        LIMIT ?
+    """, params + [limit]).fetchall()
+
+
+def user_history(db_path, user_id, limit=100, before=None):
+    return audit_entries(get_connection(db_path), user_id=user_id, before=before, limit=limit)
+
+
+def table_history(db_path, table_name, limit=100, before=None):
+    return audit_entries(get_connection(db_path), table_name=table_name, before=before, limit=limit)
+
+
+def row_history(db_path, table_name, row_id, limit=100, before=None):
+    return audit_entries(get_connection(db_path), table_name=table_name, row_id=row_id, before=before, limit=limit)
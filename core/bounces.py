@@ -0,0 +1,299 @@
+# bounces.py - reads delivery status notifications from a local mailbox and suppresses dead addresses
+#
+#   python cli.py bounces [--mailbox /var/mail/newsletter]
+#
+# [BOUNCES] mailbox is the mbox file or Maildir directory the newsletter's
+# bounce address is delivered to. Each run reads only what arrived since
+# the previous one: the mbox byte offset is kept in BounceMailboxes, the
+# unique names of the Maildir files done in BounceMaildirFiles, each
+# written in the same transaction as the suppressions it led to, so an
+# interrupted run neither loses nor repeats a bounce. A permanent failure suppresses the address right away, soft
+# failures (mailbox full, policy blocks, retries given up) after
+# soft_limit of them. Suppressed addresses stay in CustomerEmails with the
+# reason but get no newsletters until they are reactivated.
+import email
+import hashlib
+import logging
+import os
+import re
+import time
+from core.audit import audit_log
+from core.db import get_connection, transaction
+from core.events import UPDATE, events
+
+# Only the start of a message is parsed; the delivery report comes before
+# the returned original and its attachments
+MAX_MESSAGE_BYTES = 256 * 1024
+# 5.x.x statuses that say nothing about the address itself: mailbox full,
+# message too big, and 5.7.x policy/spam rejections
+SOFT_STATUSES = ("5.2.2", "5.3.4", "5.7.")
+STATUS_PATTERN = re.compile(r"[245]\.\d{1,3}\.\d{1,3}")
+
+
+class BounceError(Exception):
+    pass
+
+
+def mbox_messages(path, position, marker):
+    # (raw message, offset after it, marker) from `position` on. The marker
+    # is a hash of the first line; if it changed, or the file is shorter
+    # than the offset, the mailbox was rotated and is read from the start.
+    with open(path, "rb") as f:
+        current = hashlib.sha256(f.readline()).hexdigest()[:16]
+        if current != marker or position > os.fstat(f.fileno()).st_size:
+            position = 0
+        f.seek(position)
+        lines = None
+        kept = 0
+        offset = position
+        # A 'From ' line only separates messages after a blank line, so an
+        # unescaped one in a returned message's body doesn't split it
+        blank = True
+        for line in f:
+            if blank and line.startswith(b"From "):
+                if lines is not None:
+                    yield b"".join(lines), offset, current
+                lines = []
+                kept = 0
+            elif lines is not None and kept < MAX_MESSAGE_BYTES:
+                lines.append(line)
+                kept += len(line)
+            blank = not line.strip()
+            offset += len(line)
+        if lines is not None:
+            yield b"".join(lines), offset, current
+
+
+def maildir_files(path):
+    # Unique name -> (mtime, file path) of every message in new/ and cur/.
+    # The name is taken without the ':2,S' flags a mail client adds when it
+    # moves a message to cur/, so a message keeps it wherever it is.
+    files = {}
+    for folder in ("new", "cur"):
+        directory = os.path.join(path, folder)
+        if not os.path.isdir(directory):
+            continue
+        with os.scandir(directory) as scan:
+            for entry in scan:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                files[entry.name.split(":")[0]] = (entry.stat().st_mtime_ns, entry.path)
+    return files
+
+
+def maildir_messages(files, done):
+    # (raw message, unique name) of the files not done yet, oldest first.
+    # Names rather than an mtime high-water mark: a delivery agent may keep
+    # the sender's time, a restore may set any, and such a message would
+    # sort behind one already read.
+    pending = sorted((mtime, name, file_path) for name, (mtime, file_path) in files.items() if name not in done)
+    for _, name, file_path in pending:
+        try:
+            with open(file_path, "rb") as f:
+                raw = f.read(MAX_MESSAGE_BYTES)
+        except FileNotFoundError:
+            # Moved to cur/ meanwhile; the next run finds it there
+            continue
+        yield raw, name
+
+
+def recipient_address(value):
+    # 'rfc822; Max@Example.com' -> 'max@example.com'
+    return value.rpartition(";")[2].strip().strip("<>").lower()
+
+
+def delivery_reports(message):
+    # Per-recipient field blocks of every message/delivery-status part
+    for part in message.walk():
+        if part.get_content_type() != "message/delivery-status":
+            continue
+        payload = part.get_payload()
+        if isinstance(payload, str):
+            payload = [email.message_from_string(block) for block in re.split(r"\r?\n\s*\r?\n", payload)]
+        for block in payload:
+            if block.get("Final-Recipient") or block.get("Original-Recipient"):
+                yield block
+
+
+def parse_bounce(raw):
+    # [(address, action, status, diagnostic)] for a delivery status
+    # notification (RFC 3464), or Exim's X-Failed-Recipients; [] for any
+    # other mail, e.g. out-of-office replies
+    message = email.message_from_bytes(raw)
+    recipients = []
+    for block in delivery_reports(message):
+        address = recipient_address(block.get("Final-Recipient") or block.get("Original-Recipient"))
+        status = STATUS_PATTERN.search(block.get("Status", ""))
+        recipients.append((
+            address,
+            block.get("Action", "failed").strip().lower(),
+            status.group(0) if status else "",
+            " ".join(block.get("Diagnostic-Code", "").split()),
+        ))
+    if not recipients and message.get("X-Failed-Recipients"):
+        subject = " ".join(str(message.get("Subject", "")).split())
+        for address in message["X-Failed-Recipients"].split(","):
+            recipients.append((recipient_address(address), "failed", "5.0.0", subject))
+    return [recipient for recipient in recipients if "@" in recipient[0]]
+
+
+def classify(action, status):
+    # 'hard', 'soft', or None for reports that aren't failures (delayed,
+    # delivered, relayed, expanded). Delayed means the relay still retries;
+    # its final verdict arrives as its own report.
+    if action != "failed":
+        return None
+    if status.startswith("5") and not status.startswith(SOFT_STATUSES):
+        return "hard"
+    if not status:
+        # A failure without a status code is treated as permanent
+        return "hard"
+    return "soft"
+
+
+def apply_bounces(conn, bounces, soft_limit):
+    # bounces: (address, kind, reason). Returns (suppressed rows as (id,
+    # email, reason), addresses found in no CustomerEmails row).
+    suppressed = []
+    unknown = 0
+    for address, kind, reason in bounces:
+        rows = conn.execute(
+            "SELECT id, customer_id, email, soft_bounces FROM CustomerEmails "
+            "WHERE lower(email) = ? AND suppressed_at IS NULL",
+            (address,),
+        ).fetchall()
+        if not rows and not conn.execute(
+                "SELECT 1 FROM CustomerEmails WHERE lower(email) = ?", (address,)).fetchone():
+            unknown += 1
+        for email_id, customer_id, stored, soft_bounces in rows:
+            if kind == "hard" or soft_bounces + 1 >= soft_limit:
+                conn.execute(
+                    "UPDATE CustomerEmails SET suppressed_at = CURRENT_TIMESTAMP, bounce_reason = ?, "
+                    "soft_bounces = soft_bounces + ? WHERE id = ?",
+                    (reason, 1 if kind == "soft" else 0, email_id),
+                )
+                suppressed.append((email_id, stored, reason))
+                events.publish("CustomerEmails", UPDATE, email_id, customer_id=customer_id, suppressed=True,
+                               bounce_reason=reason)
+            else:
+                conn.execute(
+                    "UPDATE CustomerEmails SET soft_bounces = soft_bounces + 1, bounce_reason = ? WHERE id = ?",
+                    (reason, email_id),
+                )
+    return suppressed, unknown
+
+
+def process_mailbox(db_path, path, soft_limit=3, batch_size=200):
+    # Reads everything new in the mailbox at `path` and returns a summary
+    # dict. Bounces of batch_size messages are written together with the
+    # mailbox position in one transaction.
+    if not os.path.exists(path):
+        raise BounceError(f"Bounce mailbox {path} does not exist")
+    key = os.path.abspath(path)
+    conn = get_connection(db_path)
+    row = conn.execute("SELECT position, marker FROM BounceMailboxes WHERE path = ?", (key,)).fetchone()
+    position, marker = row or (0, None)
+    names = []
+    gone = set()
+    if os.path.isdir(path):
+        files = maildir_files(path)
+        done_names = {name for name, in conn.execute(
+            "SELECT name FROM BounceMaildirFiles WHERE mailbox = ?", (key,))}
+        # Names of deleted files are forgotten; unique names don't come back
+        gone = done_names - files.keys()
+
+        def read_maildir():
+            # The names go into BounceMaildirFiles with the batch they're in
+            for raw, name in maildir_messages(files, done_names):
+                names.append(name)
+                yield raw, 0, None
+
+        messages = read_maildir()
+    else:
+        messages = mbox_messages(path, position, marker)
+
+    started = time.perf_counter()
+    summary = {"mailbox": path, "messages": 0, "bounces": 0, "hard": 0, "soft": 0, "suppressed": 0, "unknown": 0}
+    bounces = []
+    done = 0
+    log = audit_log(db_path)
+
+    def write(position, marker):
+        with transaction(db_path) as conn:
+            suppressed, unknown = apply_bounces(conn, bounces, soft_limit)
+            conn.execute(
+                "INSERT OR REPLACE INTO BounceMailboxes (path, position, marker, checked_at) "
+                "VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+                (key, position, marker),
+            )
+            conn.executemany("INSERT OR IGNORE INTO BounceMaildirFiles (mailbox, name) VALUES (?, ?)",
+                             [(key, name) for name in names])
+            conn.executemany("DELETE FROM BounceMaildirFiles WHERE mailbox = ? AND name = ?",
+                             [(key, name) for name in gone])
+        summary["suppressed"] += len(suppressed)
+        summary["unknown"] += unknown
+        for email_id, address, reason in suppressed:
+            logging.info(f"Suppressed {address} after bounce: {reason}")
+            log.record("suppress", "CustomerEmails", email_id, {"email": address, "reason": reason})
+        bounces.clear()
+        names.clear()
+        gone.clear()
+
+    for raw, position, marker in messages:
+        summary["messages"] += 1
+        done += 1
+        try:
+            recipients = parse_bounce(raw)
+        except Exception as e:
+            logging.warning(f"Skipping unreadable message in {path}: {e}")
+            recipients = []
+        for address, action, status, diagnostic in recipients:
+            kind = classify(action, status)
+            if kind is None:
+                continue
+            summary["bounces"] += 1
+            summary[kind] += 1
+            bounces.append((address, kind, f"{status} {diagnostic}".strip()[:500]))
+        if done >= batch_size:
+            write(position, marker)
+            done = 0
+    if done or gone:
+        write(position, marker)
+
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    logging.info(
+        f"Read {summary['messages']} messages from {path}: {summary['hard']} hard and {summary['soft']} soft "
+        f"bounces, {summary['suppressed']} addresses suppressed, {summary['unknown']} unknown "
+        f"in {summary['seconds']}s"
+    )
+    return summary
+
+
+def process_bounces(settings, mailbox=None):
+    # [BOUNCES] in config.ini; the argument takes precedence
+    config = settings.config
+    mailbox = mailbox or config.get('BOUNCES', 'mailbox', fallback='').strip()
+    if not mailbox:
+        raise BounceError("No bounce mailbox configured, set [BOUNCES] mailbox")
+    return process_mailbox(
+        settings.db_path, mailbox,
+        config.getint('BOUNCES', 'soft_limit', fallback=3),
+        config.getint('BOUNCES', 'batch_size', fallback=200),
+    )
+
+
+def reactivate(db_path, email_id):
+    # Delivers to a suppressed address again, e.g. after the customer fixed it
+    with transaction(db_path) as conn:
+        row = conn.execute(
+            "SELECT email, bounce_reason, customer_id FROM CustomerEmails WHERE id = ?", (email_id,)
+        ).fetchone()
+        conn.execute(
+            "UPDATE CustomerEmails SET suppressed_at = NULL, bounce_reason = NULL, soft_bounces = 0 WHERE id = ?",
+            (email_id,),
+        )
+        if row:
+            events.publish("CustomerEmails", UPDATE, email_id, customer_id=row[2], suppressed=False,
+                           bounce_reason=None)
+    if row:
+        audit_log(db_path).record("reactivate", "CustomerEmails", email_id, {"email": row[0], "reason": row[1]})
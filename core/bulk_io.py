@@ -0,0 +1,571 @@
+# bulk_io.py - streaming CSV/XLSX import and export of customers, their email addresses and category mappings
+#
+#   id;name;active;emails;category_ids;suppressed
+#   12;Muster GmbH;1;info@muster.example, einkauf@muster.example;3, 17;einkauf@muster.example
+#   ;Neukunde AG;;kontakt@neukunde.example;5;
+#
+# One row per customer. A row with an id updates that customer (or creates
+# it with this id), a row without one is matched by its exact name. Blank
+# cells leave a value as it is; emails and category_ids add to what the
+# customer already has unless replace=True. suppressed lists the addresses
+# that get no newsletters (bounced); the import suppresses them too but
+# never reactivates one, that stays a deliberate step in the email dialog.
+# Columns may come in any order and under their German names; .xlsx files
+# need openpyxl.
+#
+# Rows are validated while they are read and staged in temporary tables in
+# chunks, so memory stays flat however big the file is. The diff against
+# the database is then computed in SQL and applied in one transaction; a
+# dry run computes the same diff and changes nothing. The import has a
+# connection of its own, so its temp tables and settings don't touch the
+# thread's shared one.
+import csv
+import logging
+import os
+import re
+import time
+from core.audit import audit_log
+from core.db import connect, get_connection
+from core.events import RELOAD, events
+
+COLUMNS = ("id", "name", "active", "emails", "category_ids", "suppressed")
+HEADER_ALIASES = {
+    "id": "id", "customer_id": "id", "kundennr": "id", "kundennummer": "id",
+    "name": "name", "customer": "name", "kunde": "name",
+    "active": "active", "aktiv": "active",
+    "emails": "emails", "email": "emails", "e-mail": "emails", "e-mails": "emails",
+    "category_ids": "category_ids", "categories": "category_ids", "kategorien": "category_ids",
+    "suppressed": "suppressed", "bounced": "suppressed", "gesperrt": "suppressed",
+}
+TRUE_VALUES = {"1", "yes", "y", "true", "ja", "j", "x", "active", "aktiv"}
+FALSE_VALUES = {"0", "no", "n", "false", "nein", "inactive", "inaktiv"}
+VALUE_SEPARATOR = re.compile(r"[;,\s]+")
+EMAIL_PATTERN = re.compile(r"[^@\s<>\"]+@[^@\s<>\"]+\.[^@\s<>\".]+")
+# Rows per executemany() while staging
+CHUNK_SIZE = 5000
+# Errors listed in the summary; all of them are counted
+MAX_ERRORS = 100
+# Examples per kind of change in the summary
+SAMPLE_SIZE = 10
+# Secondary indexes of a table are dropped and rebuilt once, instead of
+# being updated row by row, when an import adds at least as many rows as
+# the table already has. Unique indexes stay, they enforce the data.
+DEFERRABLE_INDEXES = {
+    "CustomerEmails": ("idx_customer_emails_customer", "idx_customer_emails_deliverable",
+                       "idx_customer_emails_address"),
+    "CustomerCategoryMapping": ("idx_mapping_category",),
+}
+
+STAGING_TABLES = (
+    "CREATE TEMP TABLE import_customers (line INTEGER PRIMARY KEY, id INTEGER, name TEXT, active INTEGER, "
+    "customer_id INTEGER, ref INTEGER)",
+    "CREATE TEMP TABLE import_emails (line INTEGER, email TEXT, email_key TEXT, suppressed INTEGER)",
+    "CREATE TEMP TABLE import_mappings (line INTEGER, category_id INTEGER)",
+    # The diff: customers to create (ref numbers them until they get an id),
+    # changed customers, rows to add and rows to remove
+    "CREATE TEMP TABLE import_new (ref INTEGER PRIMARY KEY, id INTEGER, name TEXT, active INTEGER)",
+    "CREATE TEMP TABLE import_changes (customer_id INTEGER PRIMARY KEY, name TEXT, active INTEGER, "
+    "old_name TEXT, old_active INTEGER)",
+    "CREATE TEMP TABLE import_email_adds (customer_id INTEGER, ref INTEGER, email TEXT, suppressed INTEGER)",
+    "CREATE TEMP TABLE import_mapping_adds (customer_id INTEGER, ref INTEGER, category_id INTEGER)",
+    "CREATE TEMP TABLE import_email_removals (id INTEGER PRIMARY KEY)",
+    "CREATE TEMP TABLE import_mapping_removals (id INTEGER PRIMARY KEY)",
+    # Existing deliverable addresses the file lists as suppressed
+    "CREATE TEMP TABLE import_email_suppressions (id INTEGER PRIMARY KEY)",
+)
+# bounce_reason of addresses suppressed by an import
+IMPORT_REASON = "suppressed in import"
+
+
+class BulkIOError(Exception):
+    pass
+
+
+def is_xlsx(path):
+    return path.lower().endswith((".xlsx", ".xlsm"))
+
+
+def load_openpyxl():
+    try:
+        import openpyxl
+    except ImportError:
+        raise BulkIOError("XLSX files need openpyxl: pip install openpyxl") from None
+    return openpyxl
+
+
+def cell_text(value):
+    # XLSX cells come typed; 12.0 is an id, True a flag
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def read_rows(path):
+    # (line number, list of cell strings), header row included
+    if is_xlsx(path):
+        workbook = load_openpyxl().load_workbook(path, read_only=True, data_only=True)
+        try:
+            for number, row in enumerate(workbook.active.iter_rows(values_only=True), 1):
+                yield number, [cell_text(value) for value in row]
+        finally:
+            workbook.close()
+        return
+    # utf-8-sig drops the BOM Excel puts in front of CSV exports
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        sample = f.read(65536)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=";,\t")
+        except csv.Error:
+            dialect = "excel"
+        for number, row in enumerate(csv.reader(f, dialect), 1):
+            yield number, row
+
+
+def header_columns(header):
+    # Column name -> cell index
+    columns = {}
+    for index, title in enumerate(header):
+        key = HEADER_ALIASES.get(title.strip().lower())
+        if key and key not in columns:
+            columns[key] = index
+    if "id" not in columns and "name" not in columns:
+        raise BulkIOError(f"The first row must name the columns ({', '.join(COLUMNS)}), at least id or name")
+    return columns
+
+
+def parse_row(cells, columns, categories):
+    # (id, name, active, emails, category ids, suppressed email keys);
+    # ValueError says what is wrong
+    def cell(key):
+        index = columns.get(key)
+        return cells[index].strip() if index is not None and index < len(cells) else ""
+
+    customer_id = cell("id")
+    if customer_id:
+        if not customer_id.isdigit():
+            raise ValueError(f"id '{customer_id}' is not a number")
+        customer_id = int(customer_id)
+    else:
+        customer_id = None
+    name = " ".join(cell("name").split()) or None
+    if customer_id is None and name is None:
+        raise ValueError("neither id nor name")
+
+    active = cell("active").lower()
+    if not active:
+        active = None
+    elif active in TRUE_VALUES:
+        active = 1
+    elif active in FALSE_VALUES:
+        active = 0
+    else:
+        raise ValueError(f"active '{active}' is neither yes nor no")
+
+    emails = {}
+    suppressed = set()
+    for key in ("emails", "suppressed"):
+        for email in VALUE_SEPARATOR.split(cell(key)):
+            email = email.strip("<>")
+            if not email:
+                continue
+            if not EMAIL_PATTERN.fullmatch(email):
+                raise ValueError(f"'{email}' is not an email address")
+            # The first spelling of an address wins; a suppressed one
+            # belongs to the customer as well
+            emails.setdefault(email.lower(), email)
+            if key == "suppressed":
+                suppressed.add(email.lower())
+
+    category_ids = set()
+    for category_id in VALUE_SEPARATOR.split(cell("category_ids")):
+        if not category_id:
+            continue
+        if not category_id.isdigit() or int(category_id) not in categories:
+            raise ValueError(f"no category with id '{category_id}'")
+        category_ids.add(int(category_id))
+    return customer_id, name, active, emails, category_ids, suppressed
+
+
+class Errors:
+    # The first MAX_ERRORS messages, and how many there were
+    def __init__(self):
+        self.messages = []
+        self.count = 0
+
+    def add(self, line, message):
+        self.count += 1
+        if len(self.messages) < MAX_ERRORS:
+            self.messages.append(f"line {line}: {message}")
+
+
+def stage(conn, path, errors, on_progress=None):
+    # Validates every row and loads the valid ones into the staging tables,
+    # CHUNK_SIZE rows per executemany(). Returns (rows read, columns).
+    categories = {row[0] for row in conn.execute("SELECT id FROM Categories")}
+    rows = read_rows(path)
+    first = next(rows, None)
+    if first is None:
+        raise BulkIOError(f"{path} is empty")
+    columns = header_columns(first[1])
+    customers, emails, mappings = [], [], []
+    count = 0
+
+    def write():
+        conn.executemany("INSERT INTO import_customers (line, id, name, active) VALUES (?, ?, ?, ?)", customers)
+        conn.executemany("INSERT INTO import_emails (line, email, email_key, suppressed) VALUES (?, ?, ?, ?)", emails)
+        conn.executemany("INSERT INTO import_mappings (line, category_id) VALUES (?, ?)", mappings)
+        customers.clear()
+        emails.clear()
+        mappings.clear()
+        if on_progress:
+            on_progress(count)
+
+    for line, cells in rows:
+        if not any(cell.strip() for cell in cells):
+            continue
+        count += 1
+        try:
+            customer_id, name, active, row_emails, category_ids, suppressed = parse_row(cells, columns, categories)
+        except ValueError as e:
+            errors.add(line, e)
+            continue
+        customers.append((line, customer_id, name, active))
+        emails.extend((line, email, key, int(key in suppressed)) for key, email in row_emails.items())
+        mappings.extend((line, category_id) for category_id in category_ids)
+        if len(customers) >= CHUNK_SIZE:
+            write()
+    write()
+    return count, columns
+
+
+def resolve(conn, errors):
+    # Links staged rows to existing customers and collects new ones
+    conn.execute("UPDATE import_customers SET customer_id = id WHERE id IN (SELECT id FROM Customers)")
+    for line, customer_id in conn.execute(
+            "SELECT line, id FROM import_customers WHERE customer_id IS NULL AND id IS NOT NULL AND name IS NULL"):
+        errors.add(line, f"no customer with id {customer_id}, and no name to create it")
+    conn.execute("DELETE FROM import_customers WHERE customer_id IS NULL AND id IS NOT NULL AND name IS NULL")
+    # Several customers of the same name: the oldest one
+    conn.execute("""
+        UPDATE import_customers
+        SET customer_id = (SELECT MIN(c.id) FROM Customers c WHERE c.name = import_customers.name)
+        WHERE id IS NULL
+    """)
+    # One new customer per unknown id or name; several rows of one customer
+    # merge, the last row's name and flag win
+    conn.execute("""
+        INSERT INTO import_new (id, name, active)
+        SELECT id, name, active FROM (
+            SELECT id, name, active, MAX(line) AS last FROM import_customers
+            WHERE customer_id IS NULL AND id IS NOT NULL GROUP BY id
+            UNION ALL
+            SELECT NULL, name, active, MAX(line) AS last FROM import_customers
+            WHERE customer_id IS NULL AND id IS NULL GROUP BY name
+        )
+        ORDER BY last
+    """)
+    conn.execute("CREATE INDEX temp.import_new_id ON import_new(id)")
+    conn.execute("CREATE INDEX temp.import_new_name ON import_new(name) WHERE id IS NULL")
+    conn.execute("""
+        UPDATE import_customers SET ref = CASE
+            WHEN id IS NOT NULL THEN (SELECT n.ref FROM import_new n WHERE n.id = import_customers.id)
+            ELSE (SELECT n.ref FROM import_new n WHERE n.id IS NULL AND n.name = import_customers.name)
+        END
+        WHERE customer_id IS NULL
+    """)
+
+
+def diff(conn, columns, replace):
+    # Fills the diff tables from the resolved staging tables. Nothing
+    # outside the temp schema is written.
+    conn.execute("""
+        INSERT INTO import_changes (customer_id, name, active, old_name, old_active)
+        SELECT c.id, IFNULL(f.name, c.name), IFNULL(f.active, c.active), c.name, c.active
+        FROM (SELECT customer_id, name, active, MAX(line) FROM import_customers
+              WHERE customer_id IS NOT NULL GROUP BY customer_id) f
+        JOIN Customers c ON c.id = f.customer_id
+        WHERE (f.name IS NOT NULL AND f.name IS NOT c.name) OR (f.active IS NOT NULL AND f.active IS NOT c.active)
+    """)
+    # Addresses compare case-insensitively, within the file and with the
+    # customer's existing ones
+    conn.execute("""
+        INSERT INTO import_email_adds (customer_id, ref, email, suppressed)
+        SELECT s.customer_id, s.ref, e.email, MAX(e.suppressed)
+        FROM import_emails e
+        JOIN import_customers s ON s.line = e.line
+        WHERE s.customer_id IS NULL OR NOT EXISTS (
+            SELECT 1 FROM CustomerEmails x WHERE x.customer_id = s.customer_id AND lower(x.email) = e.email_key
+        )
+        GROUP BY s.customer_id, s.ref, e.email_key
+    """)
+    conn.execute("""
+        INSERT INTO import_email_suppressions (id)
+        SELECT DISTINCT x.id
+        FROM import_emails e
+        JOIN import_customers s ON s.line = e.line
+        JOIN CustomerEmails x ON x.customer_id = s.customer_id AND lower(x.email) = e.email_key
+        WHERE e.suppressed AND x.suppressed_at IS NULL
+    """)
+    conn.execute("""
+        INSERT INTO import_mapping_adds (customer_id, ref, category_id)
+        SELECT DISTINCT s.customer_id, s.ref, m.category_id
+        FROM import_mappings m
+        JOIN import_customers s ON s.line = m.line
+        WHERE s.customer_id IS NULL OR NOT EXISTS (
+            SELECT 1 FROM CustomerCategoryMapping x WHERE x.customer_id = s.customer_id AND x.category_id = m.category_id
+        )
+    """)
+    if not replace:
+        return
+    # Only customers in the file, and only for columns the file has.
+    # Built here, after loading, so staging didn't maintain them per row.
+    conn.execute("CREATE INDEX temp.import_customers_customer ON import_customers(customer_id)")
+    if "emails" in columns:
+        conn.execute("CREATE INDEX temp.import_emails_line ON import_emails(line, email_key)")
+        conn.execute("""
+            INSERT INTO import_email_removals (id)
+            SELECT x.id
+            FROM (SELECT DISTINCT customer_id FROM import_customers WHERE customer_id IS NOT NULL) f
+            JOIN CustomerEmails x ON x.customer_id = f.customer_id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM import_customers s JOIN import_emails e ON e.line = s.line
+                WHERE s.customer_id = x.customer_id AND e.email_key = lower(x.email)
+            )
+        """)
+    if "category_ids" in columns:
+        conn.execute("CREATE INDEX temp.import_mappings_line ON import_mappings(line, category_id)")
+        conn.execute("""
+            INSERT INTO import_mapping_removals (id)
+            SELECT x.id
+            FROM (SELECT DISTINCT customer_id FROM import_customers WHERE customer_id IS NOT NULL) f
+            JOIN CustomerCategoryMapping x ON x.customer_id = f.customer_id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM import_customers s JOIN import_mappings m ON m.line = s.line
+                WHERE s.customer_id = x.customer_id AND m.category_id = x.category_id
+            )
+        """)
+
+
+def count(conn, table):
+    return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def samples(conn):
+    # A few examples per kind of change, for the dry-run report
+    def fetch(sql):
+        return [row[0] for row in conn.execute(f"{sql} LIMIT {SAMPLE_SIZE}")]
+
+    owner = "IFNULL('#' || a.customer_id, '''' || n.name || '''')"
+    return {
+        "customers_added": fetch(
+            "SELECT IFNULL('#' || id || ' ', '') || name || CASE WHEN active = 0 THEN ' (inactive)' ELSE '' END "
+            "FROM import_new"),
+        "customers_updated": fetch(
+            "SELECT '#' || customer_id || ': ' || CASE WHEN name IS NOT old_name THEN old_name || ' -> ' || name "
+            "ELSE name END || CASE WHEN active IS old_active THEN '' WHEN active THEN ' activated' "
+            "ELSE ' deactivated' END FROM import_changes"),
+        "emails_added": fetch(
+            f"SELECT {owner} || ': ' || a.email || CASE WHEN a.suppressed THEN ' (suppressed)' ELSE '' END "
+            "FROM import_email_adds a LEFT JOIN import_new n ON n.ref = a.ref"),
+        "emails_suppressed": fetch(
+            "SELECT '#' || x.customer_id || ': ' || x.email "
+            "FROM import_email_suppressions r JOIN CustomerEmails x ON x.id = r.id"),
+        "emails_removed": fetch(
+            "SELECT '#' || x.customer_id || ': ' || x.email "
+            "FROM import_email_removals r JOIN CustomerEmails x ON x.id = r.id"),
+        "mappings_added": fetch(
+            f"SELECT {owner} || ': category ' || a.category_id "
+            "FROM import_mapping_adds a LEFT JOIN import_new n ON n.ref = a.ref"),
+        "mappings_removed": fetch(
+            "SELECT '#' || x.customer_id || ': category ' || x.category_id "
+            "FROM import_mapping_removals r JOIN CustomerCategoryMapping x ON x.id = r.id"),
+    }
+
+
+def insert_deferred(conn, table, pending, sql):
+    # Runs the INSERT with the table's secondary indexes dropped and rebuilt
+    # afterwards when the import at least doubles the table
+    names = DEFERRABLE_INDEXES.get(table, ())
+    indexes = []
+    if names and pending and pending >= count(conn, table):
+        placeholders = ", ".join("?" * len(names))
+        indexes = conn.execute(
+            f"SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND name IN ({placeholders})",
+            (table, *names),
+        ).fetchall()
+    for name, _ in indexes:
+        conn.execute(f"DROP INDEX {name}")
+    conn.execute(sql)
+    for _, index_sql in indexes:
+        conn.execute(index_sql)
+    if indexes:
+        logging.info(f"Rebuilt {', '.join(name for name, _ in indexes)} after importing {pending} rows into {table}")
+
+
+def apply(conn):
+    # Writes the diff; runs inside the import transaction
+    # New customers keep their id from the file, the others get ids above
+    # every existing and every requested one
+    base = conn.execute(
+        "SELECT MAX(IFNULL((SELECT MAX(id) FROM Customers), 0), IFNULL((SELECT MAX(id) FROM import_new), 0))"
+    ).fetchone()[0]
+    conn.execute("UPDATE import_new SET id = ? + ref WHERE id IS NULL", (base,))
+    conn.execute("INSERT INTO Customers (id, name, active) SELECT id, name, IFNULL(active, 1) FROM import_new ORDER BY id")
+    conn.execute("""
+        UPDATE Customers SET
+            name = (SELECT ch.name FROM import_changes ch WHERE ch.customer_id = Customers.id),
+            active = (SELECT ch.active FROM import_changes ch WHERE ch.customer_id = Customers.id)
+        WHERE id IN (SELECT customer_id FROM import_changes)
+    """)
+    conn.execute("DELETE FROM CustomerEmails WHERE id IN (SELECT id FROM import_email_removals)")
+    conn.execute("DELETE FROM CustomerCategoryMapping WHERE id IN (SELECT id FROM import_mapping_removals)")
+    conn.execute(
+        "UPDATE CustomerEmails SET suppressed_at = CURRENT_TIMESTAMP, bounce_reason = ? "
+        "WHERE id IN (SELECT id FROM import_email_suppressions)",
+        (IMPORT_REASON,),
+    )
+    insert_deferred(conn, "CustomerEmails", count(conn, "import_email_adds"), f"""
+        INSERT INTO CustomerEmails (customer_id, email, suppressed_at, bounce_reason)
+        SELECT IFNULL(a.customer_id, n.id), a.email,
+               CASE WHEN a.suppressed THEN CURRENT_TIMESTAMP END,
+               CASE WHEN a.suppressed THEN '{IMPORT_REASON}' END
+        FROM import_email_adds a LEFT JOIN import_new n ON n.ref = a.ref
+        ORDER BY 1
+    """)
+    insert_deferred(conn, "CustomerCategoryMapping", count(conn, "import_mapping_adds"), """
+        INSERT OR IGNORE INTO CustomerCategoryMapping (customer_id, category_id)
+        SELECT IFNULL(a.customer_id, n.id), a.category_id
+        FROM import_mapping_adds a LEFT JOIN import_new n ON n.ref = a.ref
+        ORDER BY 1, 2
+    """)
+
+
+def publish_reloads(summary):
+    # One RELOAD per table the import wrote to; listing every row would cost
+    # the open views more than reading the table again
+    touched = {
+        "Customers": summary["customers_added"] + summary["customers_updated"],
+        "CustomerEmails": summary["emails_added"] + summary["emails_removed"] + summary["emails_suppressed"],
+        "CustomerCategoryMapping": summary["mappings_added"] + summary["mappings_removed"],
+    }
+    for table, changed in touched.items():
+        if changed:
+            events.publish(table, RELOAD)
+
+
+def import_customers(db_path, path, dry_run=False, replace=False, on_progress=None):
+    # Returns a summary dict: rows read, invalid rows with the first
+    # MAX_ERRORS messages, what was (or, dry run, would be) added, updated
+    # and removed, and SAMPLE_SIZE examples of each. Rows with errors are
+    # skipped, the rest is imported. on_progress(rows read) after every chunk.
+    if not os.path.exists(path):
+        raise BulkIOError(f"{path} does not exist")
+    if is_xlsx(path):
+        load_openpyxl()
+    conn = connect(db_path)
+    started = time.perf_counter()
+    errors = Errors()
+    # Staging tables live in a temporary file instead of memory (the
+    # connection default), so a file of any size fits; they go away with
+    # the connection
+    conn.execute("PRAGMA temp_store = FILE")
+    try:
+        for sql in STAGING_TABLES:
+            conn.execute(sql)
+        # Staging writes only temp tables and takes no lock on the database
+        conn.execute("BEGIN")
+        try:
+            rows, columns = stage(conn, path, errors, on_progress)
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+        # The diff is computed in the transaction that applies it, so it
+        # can't go stale in between; a dry run reads a consistent snapshot
+        # and rolls back
+        conn.execute("BEGIN" if dry_run else "BEGIN IMMEDIATE")
+        try:
+            resolve(conn, errors)
+            diff(conn, columns, replace)
+            summary = {
+                "file": path,
+                "dry_run": dry_run,
+                "rows": rows,
+                "invalid": errors.count,
+                "errors": errors.messages,
+                "customers_added": count(conn, "import_new"),
+                "customers_updated": count(conn, "import_changes"),
+                "emails_added": count(conn, "import_email_adds"),
+                "emails_removed": count(conn, "import_email_removals"),
+                "emails_suppressed": count(conn, "import_email_suppressions"),
+                "mappings_added": count(conn, "import_mapping_adds"),
+                "mappings_removed": count(conn, "import_mapping_removals"),
+                "samples": samples(conn),
+            }
+            if not dry_run:
+                apply(conn)
+        except BaseException:
+            conn.rollback()
+            raise
+        if dry_run:
+            conn.rollback()
+        else:
+            conn.commit()
+            publish_reloads(summary)
+    finally:
+        conn.close()
+
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    changes = {key: value for key, value in summary.items()
+               if key.endswith(("_added", "_updated", "_removed", "_suppressed"))}
+    if not dry_run:
+        audit_log(db_path).record("import", "Customers", details={"file": os.path.basename(path), **changes})
+    logging.info(
+        f"{'Checked' if dry_run else 'Imported'} {path}: {rows} rows, {errors.count} invalid, "
+        + ", ".join(f"{key.replace('_', ' ')} {value}" for key, value in changes.items())
+        + f" in {summary['seconds']}s"
+    )
+    return summary
+
+
+def export_customers(db_path, path):
+    # Same columns the importer reads, one customer per row in id order,
+    # streamed from the database to the file. Suppressed addresses are in
+    # emails and again in suppressed, so a re-import keeps them suppressed.
+    # Returns the number of rows.
+    rows = get_connection(db_path).execute("""
+        SELECT c.id, c.name, c.active,
+               IFNULL((SELECT group_concat(e.email, ', ') FROM CustomerEmails e WHERE e.customer_id = c.id), ''),
+               IFNULL((SELECT group_concat(m.category_id, ', ') FROM CustomerCategoryMapping m
+                       WHERE m.customer_id = c.id), ''),
+               IFNULL((SELECT group_concat(e.email, ', ') FROM CustomerEmails e
+                       WHERE e.customer_id = c.id AND e.suppressed_at IS NOT NULL), '')
+        FROM Customers c
+        ORDER BY c.id
+    """)
+    written = 0
+    if is_xlsx(path):
+        # write_only keeps no rows in memory
+        workbook = load_openpyxl().Workbook(write_only=True)
+        sheet = workbook.create_sheet("Customers")
+        sheet.append(COLUMNS)
+        for row in rows:
+            sheet.append(row)
+            written += 1
+        workbook.save(path)
+    else:
+        # Semicolons, like Excel expects them in German locales
+        with open(path, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.writer(f, delimiter=";")
+            writer.writerow(COLUMNS)
+            for row in rows:
+                writer.writerow(row)
+                written += 1
+    logging.info(f"Exported {written} customers to {path}")
+    return written
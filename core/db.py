@@ -1 +1,83 @@
 # db.py - handles DB connection
+import sqlite3
+import threading
+from contextlib import contextmanager
+from core.events import events
+from core.metrics import metrics
+from core.migrations import migrate
+
+# Seconds a writer waits for a competing lock before "database is locked"
+BUSY_TIMEOUT = 5.0
+# Prepared statements kept per connection; identical SQL text is reused
+# without re-parsing as long as the connection stays open
+STATEMENT_CACHE_SIZE = 256
+
+PRAGMAS = (
+    # Readers (e.g. a background sender) no longer block on GUI writes
+    "PRAGMA journal_mode = WAL",
+    # Safe with WAL, avoids an fsync per commit
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA foreign_keys = ON",
+    # 16 MB page cache, 256 MB memory-mapped reads
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+)
+
+_local = threading.local()
+
+
+def connect(db_path):
+    # Autocommit mode: writes are grouped explicitly with transaction()
+    conn = sqlite3.connect(
+        db_path,
+        timeout=BUSY_TIMEOUT,
+        isolation_level=None,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    # Slow-query logging when [METRICS] slow_query_ms is set
+    metrics.install_tracer(conn)
+    migrate(conn)
+    return conn
+
+
+def get_connection(db_path):
+    # One long-lived connection per thread and database file
+    connections = _local.__dict__.setdefault("connections", {})
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = connections[db_path] = connect(db_path)
+    return conn
+
+
+def close_connection(db_path=None):
+    connections = _local.__dict__.get("connections", {})
+    for path in [db_path] if db_path else list(connections):
+        conn = connections.pop(path, None)
+        if conn is not None:
+            conn.close()
+
+
+@contextmanager
+def transaction(db_path):
+    # BEGIN IMMEDIATE takes the write lock up front, so a transaction waits
+    # for the busy timeout instead of failing halfway through. Nested use
+    # joins the outer transaction. Changes published meanwhile reach the
+    # subscribers only after the commit.
+    conn = get_connection(db_path)
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    events.begin()
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        events.discard()
+        raise
+    else:
+        conn.commit()
+        events.commit()
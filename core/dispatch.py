@@ -0,0 +1,179 @@
+# dispatch.py - quarterly newsletter run: select, render, send, record
+import logging
+import time
+from datetime import date
+from core.db import get_connection
+from core.dispatch_queue import DispatchQueue
+from core.email_sender import (
+    SMTPConnectionPool, DispatchEngine, OutgoingMessage, MessageGroup, UNDISCLOSED_RECIPIENTS, build_message
+)
+from core.metrics import metrics
+from core.models import load_change_details, pending_newsletters
+
+
+def current_quarter(today=None):
+    today = today or date.today()
+    return f"Q{(today.month - 1) // 3 + 1} {today.year}"
+
+
+def build_newsletters(conn, renderer, config, quarter):
+    # Yields one OutgoingMessage per address, customer by customer
+    from_email = config['NEWSLETTER']['from_email']
+    from_name = config['NEWSLETTER'].get('from_name')
+    for customer, changes in pending_newsletters(conn):
+        subject = renderer.render_subject(quarter, customer["name"])
+        change_ids = ",".join(str(change["id"]) for change in changes)
+        for email in customer["emails"]:
+            html = renderer.render(quarter, customer["name"], email, changes)
+            yield OutgoingMessage(
+                from_email, email, build_message(html, subject, from_email, email, from_name),
+                customer["id"], change_ids,
+            )
+
+
+def render_claimed(conn, renderer, config, quarter, rows, tracker=None):
+    # Rebuilds the messages for claimed queue rows from their stored
+    # change ids. Yields (row ids, OutgoingMessage, MessageGroup of up to
+    # [DISPATCH] max_recipients identical messages, or the render error).
+    # With a LinkTracker every message carries its row's tracking links.
+    from_email = config['NEWSLETTER']['from_email']
+    from_name = config['NEWSLETTER'].get('from_name')
+    max_recipients = max(config.getint('DISPATCH', 'max_recipients', fallback=1), 1)
+    change_ids = {int(i) for row in rows for i in row[3].split(",") if i}
+    customer_ids = {row[1] for row in rows}
+    started = time.perf_counter()
+    # A change whose category is gone still goes out, with an empty category
+    changes = {}
+    load_change_details(conn, change_ids, changes)
+    names = dict(conn.execute(
+        f"SELECT id, name FROM Customers WHERE id IN ({','.join('?' * len(customer_ids))})", list(customer_ids)
+    ))
+    metrics.observe("db.load_batch", time.perf_counter() - started)
+
+    # Rows whose message comes out byte-identical share one: same change
+    # set, and same name/address where the template or subject uses them
+    groups = {}
+    for dispatch_id, customer_id, email, ids in rows:
+        try:
+            customer_changes = [changes[int(i)] for i in ids.split(",") if i and int(i) in changes]
+            customer_changes.sort(key=lambda change: (change["effective_date"] or "", change["id"]))
+            name = names[customer_id]
+            key = (ids, name, email, dispatch_id)
+            if max_recipients > 1 and tracker is None:
+                fields = renderer.personal_fields(customer_changes)
+                key = (ids, name if "customer_name" in fields else None,
+                       email if "customer_email" in fields else None)
+        except Exception as e:
+            logging.error(f"Failed to render newsletter for {email}: {e}")
+            yield [dispatch_id], e
+            continue
+        groups.setdefault(key, []).append((dispatch_id, customer_id, email, ids, name, customer_changes))
+
+    for group in groups.values():
+        for start in range(0, len(group), max_recipients):
+            chunk = group[start:start + max_recipients]
+            dispatch_ids = [row[0] for row in chunk]
+            _, _, email, _, name, customer_changes = chunk[0]
+            try:
+                html = renderer.render(quarter, name, email, customer_changes)
+                if tracker is not None:
+                    html = tracker.rewrite(html, dispatch_ids[0])
+                # Recipients of a shared message don't see each other
+                to_email = email if len(chunk) == 1 else UNDISCLOSED_RECIPIENTS
+                message = build_message(html, renderer.render_subject(quarter, name), from_email, to_email, from_name)
+            except Exception as e:
+                logging.error(f"Failed to render newsletter for {', '.join(row[2] for row in chunk)}: {e}")
+                yield dispatch_ids, e
+                continue
+            members = [
+                OutgoingMessage(from_email, email, message, customer_id, ids, dispatch_id)
+                for dispatch_id, customer_id, email, ids, _, _ in chunk
+            ]
+            yield dispatch_ids, members[0] if len(members) == 1 else MessageGroup(members)
+
+
+def queued_messages(dispatch_queue, run_id, quarter, settings, should_stop=None, poll_interval=1.0):
+    # Claims batches until the run is drained. Rows waiting for a retry are
+    # picked up once due, so a run only ends when every row is sent or failed.
+    conn = get_connection(settings.db_path)
+    while not (should_stop and should_stop()):
+        rows = dispatch_queue.claim(run_id)
+        if rows:
+            unsent = {row[0] for row in rows}
+            try:
+                for dispatch_ids, job in render_claimed(
+                    conn, settings.renderer, settings.config, quarter, rows, settings.tracker
+                ):
+                    if isinstance(job, Exception):
+                        for dispatch_id in dispatch_ids:
+                            dispatch_queue.record(dispatch_id, job)
+                        unsent.difference_update(dispatch_ids)
+                        continue
+                    if should_stop and should_stop():
+                        break
+                    unsent.difference_update(dispatch_ids)
+                    yield job
+            finally:
+                if unsent:
+                    dispatch_queue.release(unsent)
+            continue
+        in_flight, wait = dispatch_queue.outstanding(run_id)
+        if not in_flight and wait is None:
+            return
+        dispatch_queue.heartbeat(run_id)
+        time.sleep(poll_interval if wait is None else min(max(wait, 0.05), poll_interval))
+
+
+def run_dispatch(settings, quarter=None, workers=None, dry_run=False, on_result=None,
+                 should_stop=None, retry_interrupted=False, on_progress=None):
+    # Resumes an unfinished run if there is one, otherwise enqueues all
+    # pending newsletters as a new run and sends it
+    config = settings.config
+    db_path = settings.db_path
+    # Per-run figures; stage timings from other work in this process are dropped
+    metrics.reset()
+
+    if dry_run:
+        summary = {"quarter": quarter or current_quarter(), "sent": 0, "failed": 0, "pending": 0}
+        customers = set()
+        for job in build_newsletters(get_connection(db_path), settings.renderer, config, summary["quarter"]):
+            summary["sent"] += 1
+            customers.add(job.customer_id)
+            if on_result:
+                on_result(job, None)
+        summary["customers"] = len(customers)
+        summary["metrics"] = metrics.log_summary("Dry run metrics")
+        return summary
+
+    dispatch_queue = DispatchQueue.from_config(db_path, config, retry_interrupted=retry_interrupted)
+    run = dispatch_queue.open_run(quarter or current_quarter())
+    if run is None:
+        return {"quarter": quarter or current_quarter(), "sent": 0, "failed": 0, "pending": 0, "customers": 0}
+    run_id, quarter, resumed = run
+
+    def record(job, error):
+        dispatch_queue.record(job.dispatch_id, error)
+        if on_result:
+            on_result(job, error)
+
+    pool = SMTPConnectionPool.from_config(config)
+    try:
+        with dispatch_queue.keep_lease(run_id):
+            DispatchEngine.from_config(pool, config, workers).send(
+                queued_messages(dispatch_queue, run_id, quarter, settings, should_stop),
+                on_result=record,
+                before_send=lambda job: dispatch_queue.mark_started(*[member.dispatch_id for member in job.members]),
+                total=dispatch_queue.counts(run_id)["pending"],
+                on_progress=on_progress,
+            )
+    finally:
+        pool.close()
+        dispatch_queue.close_run(run_id)
+
+    summary = dict(dispatch_queue.counts(run_id), quarter=quarter, run_id=run_id, resumed=resumed)
+    logging.info(
+        f"Newsletter run {run_id} ({quarter}): {summary['sent']} sent, {summary['failed']} failed, "
+        f"{summary['pending']} pending"
+    )
+    summary["metrics"] = metrics.log_summary(f"Newsletter run {run_id} metrics")
+    return summary
@@ -0,0 +1,293 @@
+# dispatch_queue.py - persistent, resumable send queue on NewsletterDispatch
+import logging
+import os
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+from core.audit import audit_log
+from core.db import close_connection, get_connection, transaction
+from core.email_sender import is_transient_error
+from core.metrics import metrics
+from core.models import pending_newsletters
+
+# Unclaimed rows of a run that are due now
+CLAIM_SQL = """
+    SELECT id, customer_id, email, change_ids
+    FROM NewsletterDispatch
+    WHERE run_id = ? AND status = 'pending' AND claimed_at IS NULL
+      AND (next_attempt_at IS NULL OR next_attempt_at <= CURRENT_TIMESTAMP)
+    ORDER BY id
+    LIMIT ?
+"""
+
+INTERRUPTED_MESSAGE = "Interrupted during delivery, not retried to avoid a duplicate"
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+class RunInProgress(Exception):
+    pass
+
+
+class DispatchQueue:
+    # A run enqueues one 'pending' row per recipient with the change ids it
+    # will carry, so what a customer receives is fixed at enqueue time. The
+    # sender claims rows in batches and stamps attempt_started_at (committed)
+    # right before each SMTP transaction. After a crash, rows that were
+    # claimed but never attempted go back to the queue; rows with a stamped
+    # attempt may already have been delivered and are marked failed instead
+    # of being sent twice, unless retry_interrupted is set.
+    #
+    # Only one process works on a run at a time: DispatchRuns.owner plus a
+    # heartbeat act as a lease that a new process may take over once the
+    # owner is gone or the heartbeat is older than lease_timeout seconds.
+    # An owner on this host is asked directly: while its process is alive
+    # the run stays its own, however old the heartbeat.
+    def __init__(self, db_path, batch_size=50, max_attempts=5, retry_delay=60,
+                 max_retry_delay=3600, lease_timeout=120, retry_interrupted=False):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.lease_timeout = lease_timeout
+        self.retry_interrupted = retry_interrupted
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    @classmethod
+    def from_config(cls, db_path, config, **kwargs):
+        if config.has_section('DISPATCH'):
+            section = config['DISPATCH']
+            kwargs.setdefault("batch_size", section.getint('batch_size', fallback=50))
+            kwargs.setdefault("max_attempts", section.getint('max_attempts', fallback=5))
+            kwargs.setdefault("retry_delay", section.getint('retry_delay', fallback=60))
+            kwargs.setdefault("max_retry_delay", section.getint('max_retry_delay', fallback=3600))
+            kwargs.setdefault("lease_timeout", section.getint('lease_timeout', fallback=120))
+        return cls(db_path, **kwargs)
+
+    def open_run(self, quarter):
+        # Takes over the unfinished run if there is one, otherwise enqueues
+        # a new run. Returns (run_id, quarter, resumed) or None when nobody
+        # has pending changes.
+        with transaction(self.db_path) as conn:
+            row = conn.execute("""
+                SELECT id, quarter, owner, heartbeat_at < datetime('now', ?)
+                FROM DispatchRuns
+                WHERE finished_at IS NULL
+                ORDER BY id
+                LIMIT 1
+            """, (f"-{self.lease_timeout} seconds",)).fetchone()
+            if row is not None:
+                run_id, run_quarter, owner, expired = row
+                if owner and owner != self.owner:
+                    local, alive = self._owner_process(owner)
+                    if (alive if local else not expired):
+                        raise RunInProgress(f"Dispatch run {run_id} is in progress on {owner}")
+                self._take_over(conn, run_id)
+                return run_id, run_quarter, True
+            run_id = self._enqueue(conn, quarter)
+        return (run_id, quarter, False) if run_id is not None else None
+
+    def _owner_process(self, owner):
+        # (owner runs on this host, its process is alive); the liveness of
+        # a process on another host is unknown (None)
+        host, _, pid = owner.rpartition(":")
+        if host == socket.gethostname() and pid.isdigit():
+            return True, process_alive(int(pid))
+        return False, None
+
+    def _take_over(self, conn, run_id):
+        conn.execute(
+            "UPDATE DispatchRuns SET owner = ?, heartbeat_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (self.owner, run_id),
+        )
+        released = conn.execute("""
+            UPDATE NewsletterDispatch SET claimed_at = NULL
+            WHERE run_id = ? AND status = 'pending' AND claimed_at IS NOT NULL AND attempt_started_at IS NULL
+        """, (run_id,)).rowcount
+        if self.retry_interrupted:
+            interrupted = conn.execute("""
+                UPDATE NewsletterDispatch SET claimed_at = NULL, attempt_started_at = NULL
+                WHERE run_id = ? AND status = 'pending' AND attempt_started_at IS NOT NULL
+            """, (run_id,)).rowcount
+        else:
+            interrupted = conn.execute("""
+                UPDATE NewsletterDispatch
+                SET status = 'failed', error_message = ?, claimed_at = NULL
+                WHERE run_id = ? AND status = 'pending' AND attempt_started_at IS NOT NULL
+            """, (INTERRUPTED_MESSAGE, run_id)).rowcount
+        logging.info(
+            f"Resuming dispatch run {run_id}: {released} claims released, "
+            f"{interrupted} interrupted deliveries {'requeued' if self.retry_interrupted else 'marked failed'}"
+        )
+
+    @metrics.timed("db.enqueue")
+    def _enqueue(self, conn, quarter):
+        run_id = conn.execute(
+            "INSERT INTO DispatchRuns (quarter, owner, heartbeat_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
+            (quarter, self.owner),
+        ).lastrowid
+        # Materialized first: the selection itself reads NewsletterDispatch
+        rows = [
+            (run_id, customer["id"], email, ",".join(str(change["id"]) for change in changes), customer["since"])
+            for customer, changes in pending_newsletters(conn)
+            for email in customer["emails"]
+        ]
+        if not rows:
+            conn.execute("DELETE FROM DispatchRuns WHERE id = ?", (run_id,))
+            return None
+        # Rows with the same change set get consecutive ids, so they are
+        # claimed together and can share a message
+        rows.sort(key=lambda row: (row[3], row[1]))
+        conn.executemany(
+            "INSERT INTO NewsletterDispatch (run_id, customer_id, email, change_ids, since, status) "
+            "VALUES (?, ?, ?, ?, ?, 'pending')",
+            rows,
+        )
+        logging.info(f"Dispatch run {run_id} ({quarter}): {len(rows)} recipients enqueued")
+        return run_id
+
+    @metrics.timed("db.claim")
+    def claim(self, run_id):
+        # Next batch of due rows as (id, customer_id, email, change_ids);
+        # also renews the lease
+        with transaction(self.db_path) as conn:
+            rows = conn.execute(CLAIM_SQL, (run_id, self.batch_size)).fetchall()
+            conn.executemany(
+                "UPDATE NewsletterDispatch SET claimed_at = CURRENT_TIMESTAMP WHERE id = ?",
+                [(row[0],) for row in rows],
+            )
+            self.heartbeat(run_id)
+        return rows
+
+    def heartbeat(self, run_id):
+        # False once the lease is no longer ours
+        return get_connection(self.db_path).execute(
+            "UPDATE DispatchRuns SET heartbeat_at = CURRENT_TIMESTAMP WHERE id = ? AND owner = ?",
+            (run_id, self.owner),
+        ).rowcount > 0
+
+    @contextmanager
+    def keep_lease(self, run_id):
+        # Renews the heartbeat four times per lease_timeout while a run is
+        # sent. A throttled batch can take longer than the lease, and claim()
+        # alone would let it look expired.
+        stop = threading.Event()
+
+        def renew():
+            try:
+                while not stop.wait(self.lease_timeout / 4):
+                    try:
+                        if not self.heartbeat(run_id):
+                            logging.error(f"Dispatch run {run_id}: lease lost to another process")
+                    except sqlite3.Error as e:
+                        logging.error(f"Dispatch run {run_id}: heartbeat failed: {e}")
+            finally:
+                close_connection(self.db_path)
+
+        thread = threading.Thread(target=renew, name=f"dispatch-lease-{run_id}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def release(self, dispatch_ids):
+        # Claimed rows that were never handed to the sender
+        with transaction(self.db_path) as conn:
+            conn.executemany(
+                "UPDATE NewsletterDispatch SET claimed_at = NULL WHERE id = ? AND attempt_started_at IS NULL",
+                [(dispatch_id,) for dispatch_id in dispatch_ids],
+            )
+
+    @metrics.timed("db.mark_started")
+    def mark_started(self, *dispatch_ids):
+        # Must be committed before the SMTP transaction begins; all rows of
+        # a shared message in one statement
+        get_connection(self.db_path).execute(
+            "UPDATE NewsletterDispatch SET attempt_started_at = CURRENT_TIMESTAMP, attempts = attempts + 1 "
+            f"WHERE id IN ({','.join('?' * len(dispatch_ids))})",
+            dispatch_ids,
+        )
+
+    @metrics.timed("db.record")
+    def record(self, dispatch_id, error=None):
+        conn = get_connection(self.db_path)
+        if error is None:
+            # sent_at is the run's enqueue time: changes added during the run
+            # are still pending for the next one, including those of the same
+            # second that aren't in change_ids (see DispatchCutoffs)
+            conn.execute("""
+                UPDATE NewsletterDispatch
+                SET status = 'sent', error_message = NULL, claimed_at = NULL,
+                    sent_at = (SELECT started_at FROM DispatchRuns WHERE id = NewsletterDispatch.run_id)
+                WHERE id = ?
+            """, (dispatch_id,))
+            audit_log(self.db_path).record("send", "NewsletterDispatch", dispatch_id)
+            return
+        attempts = conn.execute(
+            "SELECT attempts FROM NewsletterDispatch WHERE id = ?", (dispatch_id,)
+        ).fetchone()[0]
+        if is_transient_error(error) and attempts < self.max_attempts:
+            delay = min(self.retry_delay * 2 ** max(attempts - 1, 0), self.max_retry_delay)
+            conn.execute("""
+                UPDATE NewsletterDispatch
+                SET error_message = ?, claimed_at = NULL, attempt_started_at = NULL,
+                    next_attempt_at = datetime('now', ?)
+                WHERE id = ?
+            """, (str(error), f"+{delay} seconds", dispatch_id))
+            logging.info(f"Dispatch {dispatch_id}: attempt {attempts} failed, retrying in {delay}s")
+        else:
+            conn.execute("""
+                UPDATE NewsletterDispatch
+                SET status = 'failed', error_message = ?, claimed_at = NULL, sent_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            """, (str(error), dispatch_id))
+            audit_log(self.db_path).record("send_failed", "NewsletterDispatch", dispatch_id, {"error": str(error)})
+
+    def outstanding(self, run_id):
+        # (rows handed out and not yet recorded, seconds until the next
+        # retry is due or None when nothing is waiting)
+        claimed, wait = get_connection(self.db_path).execute("""
+            SELECT COUNT(claimed_at),
+                   MIN(CASE WHEN claimed_at IS NULL
+                            THEN MAX(0, strftime('%s', COALESCE(next_attempt_at, 'now')) - strftime('%s', 'now')) END)
+            FROM NewsletterDispatch
+            WHERE run_id = ? AND status = 'pending'
+        """, (run_id,)).fetchone()
+        return claimed, wait
+
+    def close_run(self, run_id):
+        # Gives up the lease; the run is finished once nothing is pending
+        with transaction(self.db_path) as conn:
+            conn.execute("""
+                UPDATE DispatchRuns
+                SET owner = NULL,
+                    finished_at = CASE WHEN EXISTS (
+                        SELECT 1 FROM NewsletterDispatch WHERE run_id = DispatchRuns.id AND status = 'pending'
+                    ) THEN NULL ELSE CURRENT_TIMESTAMP END
+                WHERE id = ? AND owner = ?
+            """, (run_id, self.owner))
+
+    def counts(self, run_id):
+        rows = get_connection(self.db_path).execute(
+            "SELECT status, COUNT(*), COUNT(DISTINCT customer_id) FROM NewsletterDispatch "
+            "WHERE run_id = ? GROUP BY status",
+            (run_id,),
+        )
+        counts = {"sent": 0, "failed": 0, "pending": 0, "customers": 0}
+        for status, messages, customers in rows:
+            counts[status] = messages
+            if status == "sent":
+                counts["customers"] = customers
+        return counts
@@ -1 +1,750 @@
 # email_sender.py - template rendering and email dispatch
+import hashlib
+import logging
+import operator
+import os
+import queue
+import re
+import smtplib
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime
+from email.mime.text import MIMEText
+from email.utils import formataddr
+from markupsafe import Markup, escape
+from core.metrics import metrics
+
+# Placeholders for the per-customer fields in a cached newsletter skeleton
+CUSTOMER_FIELDS = ("customer_name", "customer_email", "quarter")
+FIELD_TOKENS = {field: f"\x00{field}\x00" for field in CUSTOMER_FIELDS}
+TOKEN_PATTERN = re.compile("\x00(" + "|".join(CUSTOMER_FIELDS) + ")\x00")
+THROTTLE_CODES = (421, 451)
+# To header of a message delivered to several recipients at once
+UNDISCLOSED_RECIPIENTS = "undisclosed-recipients:;"
+# Seconds send() waits on a full job queue before checking the workers are alive
+ENQUEUE_TIMEOUT = 1
+
+
+def is_connection_error(error):
+    # SMTPException derives from OSError, so protocol errors (refused
+    # recipients, bad sender) must not be mistaken for a dropped session
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def is_transient_error(error):
+    # Worth retrying later: dropped sessions and 4xx replies (greylisting,
+    # rate limits, full mailbox); 5xx replies are permanent
+    if is_connection_error(error):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return False
+
+
+def is_throttle_error(error):
+    # The relay's answer to exceeding its rate: 421 closes the session,
+    # 451 rejects this message (or recipient) for now
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return any(code in THROTTLE_CODES for code, _ in error.recipients.values())
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code in THROTTLE_CODES
+
+
+def smtp_settings(config):
+    section = config['SMTP']
+    return {
+        "host": section['host'],
+        "port": section.getint('port'),
+        "username": section.get('username', ''),
+        "password": section.get('password', ''),
+        "use_tls": section.getboolean('use_tls', fallback=False),
+        "timeout": section.getfloat('timeout', fallback=30),
+    }
+
+
+def change_fields(change):
+    # Everything of a change the template can show
+    return (change["type"], change["effective_date"], change["added_at"], change["content"], change["category"])
+
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, predicate):
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class NewsletterRenderer:
+    # Renders newsletters in three layers: compiled template (bytecode cached
+    # on disk), one cached HTML fragment per RegulatoryChanges row (the
+    # template's `render_change` macro), and a cached skeleton per change set
+    # into which only the per-customer fields are stitched. Entries are keyed
+    # by change id and keep the fields they were rendered from; an entry
+    # whose change was edited since, wherever the edit was made, is rendered
+    # again. The dicts of a run are shared, so the check is mostly identity.
+    def __init__(self, template_path, cache_dir=None, fragment_cache_size=4096,
+                 skeleton_cache_size=256, subject_template=None):
+        # Imported here so SMTP-only users (GUI start, CLI stats) skip Jinja2
+        from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, meta, select_autoescape
+        directory, self.template_name = os.path.split(template_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.env = Environment(
+            loader=FileSystemLoader(directory or "."),
+            bytecode_cache=FileSystemBytecodeCache(cache_dir) if cache_dir else None,
+            autoescape=select_autoescape(["html"], default_for_string=False),
+        )
+        self.subject_template = self.env.from_string(subject_template) if subject_template else None
+        self.subject_fields = set()
+        if subject_template:
+            self.subject_fields = meta.find_undeclared_variables(self.env.parse(subject_template)) & {"customer_name"}
+        self._fragments = LRUCache(fragment_cache_size)
+        self._skeletons = LRUCache(skeleton_cache_size)
+        self._template = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        kwargs.setdefault("cache_dir", config['APP'].get('template_cache_dir'))
+        kwargs.setdefault("subject_template", config['NEWSLETTER'].get('subject_template'))
+        return cls(config['APP']['template_path'], **kwargs)
+
+    def load_template(self):
+        template = self.env.get_template(self.template_name)
+        if template is not self._template:
+            # First load or the file changed on disk: new version, new fragments
+            with open(template.filename, "rb") as f:
+                version = hashlib.sha1(f.read()).hexdigest()[:12]
+            with self._lock:
+                self._template = template
+                self.version = version
+                self._macro = template.module.render_change
+        return template
+
+    def render_change(self, change):
+        self.load_template()
+        key = (change["id"], self.version)
+        entry = self._fragments.get(key)
+        if entry is None or not (entry[0] is change or entry[1] == change_fields(change)):
+            metrics.count("render.fragment_miss")
+            entry = (change, change_fields(change), Markup(self._macro(change)))
+            self._fragments.put(key, entry)
+        return entry[2]
+
+    def invalidate(self, change_id=None):
+        if change_id is None:
+            self._fragments.discard(lambda key: True)
+        else:
+            self._fragments.discard(lambda key: key[0] == change_id)
+        self._skeletons.discard(lambda key: True)
+
+    def skeleton(self, changes, current_year=None):
+        template = self.load_template()
+        current_year = current_year or datetime.now().year
+        key = (self.version, current_year, tuple(change["id"] for change in changes))
+        entry = self._skeletons.get(key)
+        if entry is not None and (all(map(operator.is_, entry[0], changes)) or all(
+                fields == change_fields(change) for fields, change in zip(entry[1], changes))):
+            skeleton = entry[2]
+        else:
+            metrics.count("render.skeleton_miss")
+            html = template.render(
+                change_blocks=[self.render_change(change) for change in changes],
+                current_year=current_year,
+                **FIELD_TOKENS
+            )
+            # Odd entries are field names, even entries literal HTML
+            skeleton = TOKEN_PATTERN.split(html)
+            if any("\x00" in part for part in skeleton[::2]):
+                # A filter applied to a customer field (e.g. `|upper`) mangles
+                # the token; such templates are rendered in full every time
+                skeleton = False
+            self._skeletons.put(key, (tuple(changes), [change_fields(change) for change in changes], skeleton))
+        return skeleton
+
+    def personal_fields(self, changes, current_year=None):
+        # Customer fields a newsletter with these changes depends on, body
+        # and subject. Recipients that agree on them get identical messages.
+        skeleton = self.skeleton(changes, current_year)
+        fields = set(CUSTOMER_FIELDS) if skeleton is False else set(skeleton[1::2])
+        return (fields | self.subject_fields) - {"quarter"}
+
+    @metrics.timed("render.newsletter")
+    def render(self, quarter, customer_name, customer_email, changes, current_year=None, cache=True):
+        # cache=False leaves the caches alone, e.g. for a test newsletter
+        # with made-up changes
+        skeleton = self.skeleton(changes, current_year) if cache else False
+        if skeleton is False:
+            return self.load_template().render(
+                change_blocks=[self.render_change(change) if cache else Markup(self._macro(change))
+                               for change in changes],
+                current_year=current_year or datetime.now().year,
+                quarter=quarter, customer_name=customer_name, customer_email=customer_email,
+            )
+        values = {
+            "customer_name": escape(customer_name),
+            "customer_email": escape(customer_email),
+            "quarter": escape(quarter),
+        }
+        parts = skeleton[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = values[parts[i]]
+        return "".join(parts)
+
+    def render_subject(self, quarter, customer_name):
+        if self.subject_template is None:
+            return f"ISO 50001 Updates – {quarter}"
+        return self.subject_template.render(quarter=quarter, customer_name=customer_name)
+
+
+@metrics.timed("mime.build")
+def build_message(html, subject, from_email, to_email, from_name=None):
+    msg = MIMEText(html, "html")
+    msg["Subject"] = subject
+    msg["From"] = formataddr((from_name, from_email)) if from_name else from_email
+    msg["To"] = to_email
+    return msg
+
+
+class OutgoingMessage:
+    def __init__(self, from_email, to_email, message, customer_id=None, change_ids=None, dispatch_id=None):
+        self.from_email = from_email
+        self.to_email = to_email
+        self.message = message
+        self.customer_id = customer_id
+        self.change_ids = change_ids
+        # NewsletterDispatch row when sent through the dispatch queue
+        self.dispatch_id = dispatch_id
+
+    @property
+    def members(self):
+        return [self]
+
+    @property
+    def recipients(self):
+        return [self.to_email]
+
+
+class MessageGroup:
+    # One message with identical content for several recipients, delivered
+    # in a single SMTP transaction with one RCPT TO each. The engine reports
+    # the result per member, so every recipient keeps its own outcome.
+    def __init__(self, members):
+        self.members = members
+        self.from_email = members[0].from_email
+        self.message = members[0].message
+
+    @property
+    def recipients(self):
+        return [member.to_email for member in self.members]
+
+    @property
+    def to_email(self):
+        # For log lines
+        return ", ".join(self.recipients)
+
+
+class SMTPConnectionPool:
+    # Keeps up to `size` authenticated SMTP sessions open and hands them out
+    # to workers, so TCP + STARTTLS + AUTH is paid once per session instead
+    # of once per recipient.
+    def __init__(self, host, port, username="", password="", use_tls=False,
+                 size=4, timeout=30, max_idle=60):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        settings = smtp_settings(config)
+        settings["size"] = config['SMTP'].getint('pool_size', fallback=4)
+        settings.update(kwargs)
+        return cls(**settings)
+
+    @metrics.timed("smtp.connect")
+    def open(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        server.ehlo()
+        if self.use_tls:
+            server.starttls()
+            server.ehlo()
+        if self.username:
+            server.login(self.username, self.password)
+        return server
+
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    server, idle_since = self._idle.get_nowait()
+                except queue.Empty:
+                    return self.open()
+                # Relays drop idle sessions, check before handing an old one out
+                if time.monotonic() - idle_since < self.max_idle or self._is_alive(server):
+                    return server
+                self._discard(server)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, server, broken=False):
+        try:
+            if broken or self._closed:
+                self._discard(server)
+            else:
+                self._idle.put((server, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def reconnect(self, server):
+        self._discard(server)
+        return self.open()
+
+    def recycle(self, server):
+        # Orderly QUIT and a fresh session, for relays that cap messages per connection
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            self._discard(server)
+        return self.open()
+
+    @contextmanager
+    def connection(self):
+        server = self.acquire()
+        try:
+            yield server
+        except BaseException as e:
+            self.release(server, broken=is_connection_error(e))
+            raise
+        else:
+            self.release(server)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                server, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                server.close()
+
+    def _is_alive(self, server):
+        try:
+            return server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _discard(self, server):
+        try:
+            server.close()
+        except OSError:
+            pass
+
+
+class TokenBucket:
+    # `rate` tokens per minute, at most `burst` saved up. Callers reserve a
+    # token and sleep off the debt, so concurrent workers are served in order.
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # Takes a token and returns the seconds to wait before using it
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate / 60)
+            self.updated = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens * 60 / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def set_rate(self, rate):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate / 60)
+            self.updated = now
+            self.rate = rate
+
+
+class AdaptiveRateLimiter:
+    # Host-wide token bucket, AIMD: each accepted message adds `increase`
+    # messages/minute up to the limit, a throttle reply multiplies the rate
+    # by `decrease`, at most once per `cooldown` seconds. Without a limit
+    # nothing is paced until the first throttle.
+    def __init__(self, rate=None, burst=5, min_rate=6, increase=1, decrease=0.5, cooldown=10):
+        self.max_rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.last_decrease = None
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self.bucket.rate if self.bucket else None
+
+    def acquire(self):
+        bucket = self.bucket
+        if bucket:
+            bucket.acquire()
+
+    def success(self):
+        with self._lock:
+            if self.bucket is None:
+                return
+            rate = self.bucket.rate + self.increase
+            if self.max_rate:
+                rate = min(rate, self.max_rate)
+            self.bucket.set_rate(rate)
+
+    def throttled(self, started, observed_rate=None):
+        # started: time.monotonic() when the throttled message was sent;
+        # observed_rate: messages/minute delivered when the relay pushed back
+        with self._lock:
+            now = time.monotonic()
+            if self.last_decrease is not None and (
+                started < self.last_decrease or now - self.last_decrease < self.cooldown
+            ):
+                return
+            self.last_decrease = now
+            current = self.bucket.rate if self.bucket else (observed_rate or self.min_rate)
+            rate = max(self.min_rate, current * self.decrease)
+            if self.bucket is None:
+                self.bucket = TokenBucket(rate, self.burst)
+            else:
+                self.bucket.set_rate(rate)
+        logging.info(f"SMTP relay throttled, sending at {rate:.0f} messages/minute")
+
+
+class SendStats:
+    # Live figures for a run: totals, delivered messages per minute over the
+    # last `window` seconds and the ETA for the remaining messages when the
+    # total is known. Failures are fast and are left out of the throughput.
+    def __init__(self, total=None, window=60):
+        self.total = total
+        self.window = window
+        self.sent = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.recent = deque()
+
+    def add(self, error):
+        if error is not None:
+            self.failed += 1
+            return
+        self.sent += 1
+        now = time.monotonic()
+        self.recent.append(now)
+        while self.recent and now - self.recent[0] > self.window:
+            self.recent.popleft()
+
+    def rate(self):
+        # Messages per minute
+        if not self.recent:
+            return 0.0
+        # At least a second, so the first few messages don't read as a huge rate
+        elapsed = max(min(time.monotonic() - self.started, self.window), 1.0)
+        return len(self.recent) * 60 / elapsed
+
+    def eta(self):
+        rate = self.rate()
+        if self.total is None or not rate:
+            return None
+        return max(self.total - self.sent - self.failed, 0) * 60 / rate
+
+    def snapshot(self, limit=None):
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "total": self.total,
+            "rate": self.rate(),
+            "limit": limit,
+            "eta": self.eta(),
+            "elapsed": time.monotonic() - self.started,
+        }
+
+
+def format_progress(snapshot):
+    done = snapshot["sent"] + snapshot["failed"]
+    text = f"{done}/{snapshot['total']}" if snapshot["total"] is not None else f"{done}"
+    text += f" ({snapshot['failed']} failed), {snapshot['rate']:.0f}/min"
+    if snapshot["limit"]:
+        text += f", limit {snapshot['limit']:.0f}/min"
+    if snapshot["eta"] is not None:
+        minutes, seconds = divmod(int(snapshot["eta"]), 60)
+        text += f", ETA {minutes}m{seconds:02d}s"
+    return text
+
+
+class DispatchError(Exception):
+    pass
+
+
+class DispatchEngine:
+    # Sends a stream of OutgoingMessage objects with `workers` threads. Each
+    # worker keeps one pooled session for the whole run and reconnects on its
+    # own when the relay drops the connection.
+    def __init__(self, pool, workers=None, reconnect_attempts=2, limiter=None, connection_rate=None,
+                 messages_per_connection=None, throttle_retries=3, throttle_delay=1.0, progress_interval=10):
+        self.pool = pool
+        self.workers = workers or pool.size
+        self.reconnect_attempts = reconnect_attempts
+        self.throttle_retries = throttle_retries
+        self.throttle_delay = throttle_delay
+        self.limiter = limiter or AdaptiveRateLimiter()
+        self.connection_rate = connection_rate
+        self.messages_per_connection = messages_per_connection
+        self.progress_interval = progress_interval
+        self.stats = SendStats()
+
+    @classmethod
+    def from_config(cls, pool, config, workers=None, **kwargs):
+        section = config['SMTP']
+        kwargs.setdefault("limiter", AdaptiveRateLimiter(
+            rate=section.getfloat('rate_limit', fallback=0) or None,
+            burst=section.getint('rate_burst', fallback=5),
+            min_rate=section.getfloat('rate_limit_min', fallback=6),
+            increase=section.getfloat('rate_increase', fallback=1),
+            decrease=section.getfloat('rate_decrease', fallback=0.5),
+            cooldown=section.getfloat('rate_cooldown', fallback=10),
+        ))
+        kwargs.setdefault("connection_rate", section.getfloat('connection_rate_limit', fallback=0) or None)
+        kwargs.setdefault("messages_per_connection", section.getint('messages_per_connection', fallback=0) or None)
+        return cls(pool, workers, **kwargs)
+
+    def send(self, messages, on_result=None, before_send=None, total=None, on_progress=None):
+        # before_send(job) runs on the worker right before the SMTP
+        # transaction; if it raises, the job is reported failed unsent.
+        # on_progress(snapshot) gets the live figures every progress_interval
+        # seconds and once at the end.
+        jobs = queue.Queue(maxsize=self.workers * 4)
+        results = []
+        lock = threading.Lock()
+        self.stats = SendStats(total)
+        last_progress = [time.monotonic()]
+
+        def progress():
+            snapshot = self.stats.snapshot(self.limiter.rate)
+            logging.info(f"Dispatch progress: {format_progress(snapshot)}")
+            if on_progress:
+                on_progress(snapshot)
+
+        def report(job, error):
+            with lock:
+                results.append((job, error))
+                self.stats.add(error)
+                # A failing callback, e.g. a locked database while recording
+                # the result, must not take the worker down with it
+                try:
+                    if on_result:
+                        on_result(job, error)
+                    if time.monotonic() - last_progress[0] >= self.progress_interval:
+                        last_progress[0] = time.monotonic()
+                        progress()
+                except Exception as e:
+                    logging.error(f"Recording the result for {job.to_email} failed: {e}")
+
+        threads = [
+            threading.Thread(target=self._worker, args=(jobs, report, before_send), daemon=True)
+            for _ in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        def enqueue(item):
+            # False once no worker is left to take it, instead of blocking forever
+            while True:
+                try:
+                    jobs.put(item, timeout=ENQUEUE_TIMEOUT)
+                    return True
+                except queue.Full:
+                    if not any(thread.is_alive() for thread in threads):
+                        return False
+
+        try:
+            for job in messages:
+                if not enqueue(job):
+                    raise DispatchError("All dispatch workers stopped")
+        finally:
+            for _ in threads:
+                if not enqueue(None):
+                    break
+            for thread in threads:
+                thread.join()
+        progress()
+        return results
+
+    def _worker(self, jobs, report, before_send=None):
+        session = {"server": None, "messages": 0}
+        # Each worker holds one session at a time, so its bucket is the
+        # per-connection limit
+        bucket = TokenBucket(self.connection_rate) if self.connection_rate else None
+        try:
+            while True:
+                job = jobs.get()
+                if job is None:
+                    break
+                if before_send:
+                    try:
+                        before_send(job)
+                    except Exception as e:
+                        logging.error(f"Not sending email to {job.to_email}: {e}")
+                        for member in job.members:
+                            report(member, e)
+                        continue
+                try:
+                    refused = self._send_paced(session, bucket, job)
+                except OSError as e:
+                    logging.error(f"Failed to send email to {job.to_email}: {e}")
+                    for member in job.members:
+                        report(member, e)
+                    continue
+                except Exception as e:
+                    # Anything else fails this job only; the session may be
+                    # mid-transaction, so the next job starts a fresh one
+                    logging.exception(f"Failed to send email to {job.to_email}: {e}")
+                    if session["server"] is not None:
+                        self.pool.release(session["server"], broken=True)
+                        session["server"] = None
+                    for member in job.members:
+                        report(member, e)
+                    continue
+                for member in job.members:
+                    if member.to_email in refused:
+                        # The relay took the message for the others only
+                        error = refused[member.to_email]
+                        if not isinstance(error, Exception):
+                            error = smtplib.SMTPRecipientsRefused({member.to_email: error})
+                        logging.error(f"Failed to send email to {member.to_email}: {error}")
+                        report(member, error)
+                    else:
+                        report(member, None)
+        finally:
+            if session["server"] is not None:
+                self.pool.release(session["server"])
+
+    def _send_paced(self, session, bucket, job):
+        # Waits for a per-connection and a host token; a throttle reply slows
+        # the host rate down and the message is retried after 1, 2, 4 ...
+        # times throttle_delay seconds. Returns the refused recipients when
+        # the relay accepted the message for the others.
+        for attempt in range(self.throttle_retries + 1):
+            with metrics.timer("smtp.pacing"):
+                if bucket:
+                    bucket.acquire()
+                self.limiter.acquire()
+            started = time.monotonic()
+            try:
+                self._open_session(session)
+                session["server"], refused = self._deliver(session["server"], job)
+            except OSError as e:
+                if session["server"] is not None and (is_connection_error(e) or getattr(e, "smtp_code", None) == 421):
+                    # Reconnect budget exhausted or the relay closed the
+                    # session, the next message starts with a fresh one
+                    self.pool.release(session["server"], broken=True)
+                    session["server"] = None
+                if not is_throttle_error(e):
+                    raise
+                metrics.count("smtp.throttled")
+                self.limiter.throttled(started, self.stats.rate())
+                if attempt == self.throttle_retries:
+                    raise
+                time.sleep(self.throttle_delay * 2 ** attempt)
+            else:
+                self.limiter.success()
+                return refused
+
+    def _open_session(self, session):
+        if session["server"] is None:
+            session["server"] = self.pool.acquire()
+            session["messages"] = 0
+        elif self.messages_per_connection and session["messages"] >= self.messages_per_connection:
+            session["server"] = self.pool.recycle(session["server"])
+            session["messages"] = 0
+        session["messages"] += 1
+
+    def _deliver(self, server, job):
+        with metrics.timer("mime.serialize"):
+            data = job.message.as_string()
+        recipients = job.recipients
+        server, rejected = self._transaction(server, job.from_email, recipients, data)
+        refused = {}
+        while True:
+            # 452 for some recipients while others were accepted is the
+            # relay's recipients-per-message limit: the rest go out right
+            # away in the next transaction
+            over_limit = [email for email, (code, _) in rejected.items() if code == 452]
+            refused.update((email, reply) for email, reply in rejected.items() if reply[0] != 452)
+            if not over_limit or len(over_limit) == len(recipients):
+                refused.update((email, rejected[email]) for email in over_limit)
+                return server, refused
+            metrics.count("smtp.recipient_limit")
+            recipients = over_limit
+            try:
+                server, rejected = self._transaction(server, job.from_email, recipients, data)
+            except OSError as e:
+                # The others have the message already; a failure now must
+                # not fail them too, nor resend to them on a throttle retry
+                refused.update((email, e) for email in recipients)
+                return server, refused
+
+    def _transaction(self, server, from_email, recipients, data):
+        for attempt in range(self.reconnect_attempts + 1):
+            try:
+                with metrics.timer("smtp.send"):
+                    return server, server.sendmail(from_email, recipients, data)
+            except OSError as e:
+                if not is_connection_error(e) or attempt == self.reconnect_attempts:
+                    raise
+                metrics.count("smtp.reconnects")
+                logging.info(f"SMTP connection lost, reconnecting to {self.pool.host}")
+                server = self.pool.reconnect(server)
@@ -0,0 +1,88 @@
+# events.py - in-process data-change bus: writers publish row-level changes, open views apply them
+#
+#   events.publish("CustomerEmails", INSERT, email_id, customer_id=12, email="a@b.example")
+#   unsubscribe = events.subscribe(callback, "Customers", "CustomerEmails")
+#
+# Changes published inside transaction() are held until it commits and
+# dropped if it rolls back, so a subscriber never hears of a row the
+# database doesn't have; outside a transaction they go out right away.
+# Subscribers get the changes of one transaction as a list, on the thread
+# that committed it (ui/changes.py hands them to the GUI thread). Bulk
+# writes publish a single RELOAD for the table instead of one change per
+# row. Only this process is notified: writes by cli.py show up in an open
+# window after its next full load.
+import collections
+import logging
+import threading
+
+INSERT = "insert"
+UPDATE = "update"
+DELETE = "delete"
+# Too many rows changed to list them; reread the table
+RELOAD = "reload"
+
+# values: the columns the writer knows, e.g. customer_id of an email row
+Change = collections.namedtuple("Change", "table action row_id values")
+
+
+class ChangeBus:
+    def __init__(self):
+        # Replaced, never mutated, so delivery can iterate without the lock
+        self._subscribers = ()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def subscribe(self, callback, *tables):
+        # callback(changes) for changes to `tables`, or to any table if none
+        # are given. Returns a function that unsubscribes again.
+        entry = (frozenset(tables), callback)
+        with self._lock:
+            self._subscribers += (entry,)
+
+        def unsubscribe():
+            with self._lock:
+                self._subscribers = tuple(item for item in self._subscribers if item is not entry)
+
+        return unsubscribe
+
+    def publish(self, table, action, row_id=None, **values):
+        change = Change(table, action, row_id, values)
+        pending = getattr(self._local, "pending", None)
+        if pending is not None:
+            pending.append(change)
+        else:
+            self._deliver([change])
+
+    def begin(self):
+        # Called by transaction(); holds this thread's changes until commit()
+        self._local.pending = []
+
+    def commit(self):
+        pending, self._local.pending = self._local.pending, None
+        if pending:
+            self._deliver(pending)
+
+    def discard(self):
+        self._local.pending = None
+
+    def _deliver(self, changes):
+        for tables, callback in self._subscribers:
+            selected = [change for change in changes if change.table in tables] if tables else changes
+            if not selected:
+                continue
+            try:
+                callback(selected)
+            except Exception as e:
+                # A broken view must not fail the write that was already committed
+                logging.error(f"Change subscriber {callback!r} failed: {e}")
+
+
+def by_table(changes):
+    # {table: [changes]}, in publishing order
+    grouped = {}
+    for change in changes:
+        grouped.setdefault(change.table, []).append(change)
+    return grouped
+
+
+events = ChangeBus()
@@ -0,0 +1,266 @@
+# metrics.py - per-stage timers, counters and latency histograms, slow-query tracing, JSON-lines log sink
+import atexit
+import copy
+import functools
+import json
+import logging
+import logging.handlers
+import math
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+# Histogram buckets grow by 5%, so a reported percentile is within 5% of
+# the real value whatever the latency range
+BUCKET_GROWTH = 1.05
+# Everything below one microsecond lands in bucket 0
+BUCKET_BASE = 1e-6
+# Attributes every LogRecord has; anything else came in through `extra`
+RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class Histogram:
+    # Log-bucketed latency histogram: constant memory and O(1) per sample
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        index = 0 if seconds <= BUCKET_BASE else int(math.log(seconds / BUCKET_BASE, BUCKET_GROWTH)) + 1
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the requested rank, capped at max
+        rank = fraction * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(BUCKET_BASE * BUCKET_GROWTH ** index, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total_ms": round(self.total * 1000, 3),
+            "mean_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(0.50) * 1000, 3),
+            "p95_ms": round(self.percentile(0.95) * 1000, 3),
+            "p99_ms": round(self.percentile(0.99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+class Metrics:
+    # Thread-safe registry of stage latencies and counters. Stage names are
+    # dotted, '<area>.<operation>', e.g. 'smtp.send' or 'db.claim'.
+    def __init__(self):
+        self.enabled = True
+        self.slow_query_ms = 0
+        self._stages = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram()
+            histogram.add(seconds)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    @contextmanager
+    def timer(self, stage):
+        # Failed calls are timed too, under '<stage>.error'
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(f"{stage}.error", time.perf_counter() - started)
+            raise
+        self.observe(stage, time.perf_counter() - started)
+
+    def timed(self, stage):
+        def decorate(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "stages": {stage: histogram.summary() for stage, histogram in sorted(self._stages.items())},
+                "counters": dict(sorted(self._counters.items())),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+
+    def log_summary(self, label):
+        # One readable line per stage in app.log; the full snapshot goes to
+        # the JSON-lines sink as the `metrics` field
+        snapshot = self.snapshot()
+        logging.info(f"{label}: {format_summary(snapshot)}", extra={"metrics": snapshot})
+        return snapshot
+
+    def install_tracer(self, conn):
+        if self.enabled and self.slow_query_ms:
+            SlowQueryTracer(self, self.slow_query_ms / 1000).install(conn)
+
+
+def format_summary(snapshot):
+    parts = [
+        f"{stage} n={figures['count']} total={figures['total_ms'] / 1000:.1f}s "
+        f"p50={figures['p50_ms']:.1f}ms p95={figures['p95_ms']:.1f}ms p99={figures['p99_ms']:.1f}ms"
+        for stage, figures in sorted(snapshot["stages"].items(), key=lambda item: -item[1]["total_ms"])
+    ]
+    parts += [f"{name}={value}" for name, value in snapshot["counters"].items()]
+    return "; ".join(parts) or "no samples"
+
+
+class SlowQueryTracer:
+    # Python's sqlite3 only reports when a statement starts (trace callback),
+    # so the progress handler stamps the last moment the statement was seen
+    # executing. A statement's duration is taken from its start to that last
+    # step when the next one begins; a statement that is still running past
+    # the threshold is logged right away. Resolution is `interval` VM steps.
+    def __init__(self, metrics, threshold, interval=1000):
+        self.metrics = metrics
+        self.threshold = threshold
+        self.interval = interval
+        self.sql = None
+        self.started = 0.0
+        self.last_step = 0.0
+        self.reported = False
+
+    def install(self, conn):
+        conn.set_trace_callback(self.statement)
+        conn.set_progress_handler(self.progress, self.interval)
+
+    def statement(self, sql):
+        if sql.startswith("--"):
+            # Trigger bodies are traced as '-- TRIGGER ...' within their statement
+            return
+        self.finish()
+        self.sql = sql
+        self.started = self.last_step = time.perf_counter()
+        self.reported = False
+
+    def progress(self):
+        self.last_step = time.perf_counter()
+        if not self.reported and self.last_step - self.started > self.threshold:
+            self.reported = True
+            logging.warning(
+                f"Slow query still running after {(self.last_step - self.started) * 1000:.0f} ms: {shorten(self.sql)}",
+                extra={"sql": self.sql},
+            )
+        # Non-zero would abort the statement
+        return 0
+
+    def finish(self):
+        if self.sql is None:
+            return
+        elapsed = self.last_step - self.started
+        if elapsed > self.threshold:
+            self.metrics.observe("db.slow_query", elapsed)
+            logging.warning(
+                f"Slow query took {elapsed * 1000:.0f} ms: {shorten(self.sql)}",
+                extra={"sql": self.sql, "duration_ms": round(elapsed * 1000, 3)},
+            )
+        self.sql = None
+
+
+def shorten(sql, limit=300):
+    sql = " ".join(sql.split())
+    return sql if len(sql) <= limit else sql[:limit] + "…"
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TracebackQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler.prepare() folds the traceback into the message and drops
+    # exc_info; keep the message plain and pass the traceback on as an
+    # extra field, formatted here while exc_info is still available.
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exception = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = record.exc_text = None
+        return record
+
+
+def start_json_log(path, level=logging.INFO):
+    # Adds a JSON-lines copy of every log record. Callers only put the record
+    # on a queue; a listener thread formats and writes it, so a slow disk
+    # never stalls a sender thread. Flushed and stopped at exit.
+    records = queue.SimpleQueue()
+    handler = TracebackQueueHandler(records)
+    handler.setLevel(level)
+    file_handler = logging.FileHandler(path, encoding="utf-8")
+    file_handler.setFormatter(JsonLinesFormatter())
+    listener = logging.handlers.QueueListener(records, file_handler, respect_handler_level=True)
+    listener.start()
+    logging.getLogger().addHandler(handler)
+
+    def stop():
+        atexit.unregister(stop)
+        logging.getLogger().removeHandler(handler)
+        listener.stop()
+        file_handler.close()
+
+    atexit.register(stop)
+    return stop
+
+
+def configure_metrics(config):
+    # [METRICS] section of config.ini, all keys optional
+    if not config.has_section('METRICS'):
+        return
+    section = config['METRICS']
+    metrics.enabled = section.getboolean('enabled', fallback=True)
+    metrics.slow_query_ms = section.getfloat('slow_query_ms', fallback=0)
+    json_log = section.get('json_log', fallback='').strip()
+    if json_log:
+        start_json_log(json_log)
+
+
+metrics = Metrics()
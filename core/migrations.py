@@ -0,0 +1,198 @@
+# migrations.py - versioned schema upgrades on top of data/db_init.py
+import logging
+import sqlite3
+
+CHANGE_SEARCH_SCHEMA = (
+    # Standalone FTS5 table keyed by RegulatoryChanges.id; the category text
+    # is copied in so one MATCH covers content, scope and description
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS RegulatoryChangesSearch USING fts5(
+        content, category, tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    INSERT INTO RegulatoryChangesSearch (rowid, content, category)
+    SELECT r.id, r.content, c.scope || ' ' || c.description
+    FROM RegulatoryChanges r
+    LEFT JOIN Categories c ON c.id = r.category_id
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS changes_search_insert AFTER INSERT ON RegulatoryChanges BEGIN
+        INSERT INTO RegulatoryChangesSearch (rowid, content, category)
+        VALUES (new.id, new.content,
+                (SELECT scope || ' ' || description FROM Categories WHERE id = new.category_id));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS changes_search_delete AFTER DELETE ON RegulatoryChanges BEGIN
+        DELETE FROM RegulatoryChangesSearch WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS changes_search_update AFTER UPDATE OF content, category_id ON RegulatoryChanges
+    BEGIN
+        UPDATE RegulatoryChangesSearch
+        SET content = new.content,
+            category = (SELECT scope || ' ' || description FROM Categories WHERE id = new.category_id)
+        WHERE rowid = new.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS categories_search_update AFTER UPDATE OF scope, description ON Categories
+    BEGIN
+        UPDATE RegulatoryChangesSearch SET category = new.scope || ' ' || new.description
+        WHERE rowid IN (SELECT id FROM RegulatoryChanges WHERE category_id = new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS categories_search_delete AFTER DELETE ON Categories BEGIN
+        UPDATE RegulatoryChangesSearch SET category = NULL
+        WHERE rowid IN (SELECT id FROM RegulatoryChanges WHERE category_id = old.id);
+    END
+    """,
+)
+
+
+def fts5_available(conn):
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+    except sqlite3.OperationalError:
+        return False
+    conn.execute("DROP TABLE temp.fts5_probe")
+    return True
+
+
+def create_change_search(conn):
+    # SQLite builds without FTS5 keep working; search falls back to LIKE
+    if not fts5_available(conn):
+        logging.warning("SQLite has no FTS5, full-text search over changes is disabled")
+        return
+    for statement in CHANGE_SEARCH_SCHEMA:
+        conn.execute(statement)
+
+
+# MIGRATIONS[n] upgrades a database from PRAGMA user_version n to n + 1.
+# Only ever append; released entries must not change. A step is a tuple of
+# SQL statements or callables taking the connection.
+MIGRATIONS = [
+    # 1: secondary indexes and the mapping uniqueness constraint
+    (
+        """
+        DELETE FROM CustomerCategoryMapping
+        WHERE id NOT IN (
+            SELECT MIN(id) FROM CustomerCategoryMapping GROUP BY customer_id, category_id
+        )
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_mapping_customer_category "
+        "ON CustomerCategoryMapping(customer_id, category_id)",
+        "CREATE INDEX IF NOT EXISTS idx_mapping_category ON CustomerCategoryMapping(category_id)",
+        "CREATE INDEX IF NOT EXISTS idx_customer_emails_customer ON CustomerEmails(customer_id)",
+        "CREATE INDEX IF NOT EXISTS idx_dispatch_customer_sent ON NewsletterDispatch(customer_id, sent_at)",
+        "CREATE INDEX IF NOT EXISTS idx_changes_added ON RegulatoryChanges(added_at)",
+        "CREATE INDEX IF NOT EXISTS idx_changes_category_added ON RegulatoryChanges(category_id, added_at)",
+    ),
+    # 2: keyset paging of the customer list by (name, id)
+    (
+        "CREATE INDEX IF NOT EXISTS idx_customers_name ON Customers(name)",
+    ),
+    # 3: persistent dispatch queue, one NewsletterDispatch row per recipient
+    (
+        """
+        CREATE TABLE IF NOT EXISTS DispatchRuns (
+            id INTEGER PRIMARY KEY,
+            quarter TEXT,
+            started_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            finished_at DATETIME,
+            owner TEXT,
+            heartbeat_at DATETIME
+        )
+        """,
+        "ALTER TABLE NewsletterDispatch ADD COLUMN run_id INTEGER REFERENCES DispatchRuns(id)",
+        "ALTER TABLE NewsletterDispatch ADD COLUMN email TEXT",
+        "ALTER TABLE NewsletterDispatch ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE NewsletterDispatch ADD COLUMN next_attempt_at DATETIME",
+        "ALTER TABLE NewsletterDispatch ADD COLUMN claimed_at DATETIME",
+        "ALTER TABLE NewsletterDispatch ADD COLUMN attempt_started_at DATETIME",
+        # Where the content of a row starts, for an address that never got
+        # one through (see DispatchCutoffs)
+        "ALTER TABLE NewsletterDispatch ADD COLUMN since DATETIME",
+        "CREATE INDEX IF NOT EXISTS idx_dispatch_queue ON NewsletterDispatch(run_id, status, next_attempt_at)",
+    ),
+    # 4: full-text search over RegulatoryChanges, kept in sync by triggers
+    (
+        create_change_search,
+        "CREATE INDEX IF NOT EXISTS idx_changes_effective ON RegulatoryChanges(effective_date)",
+    ),
+    # 5: change browser keyset paging by type and effective date, type filter
+    (
+        "CREATE INDEX IF NOT EXISTS idx_changes_type ON RegulatoryChanges(type)",
+        "CREATE INDEX IF NOT EXISTS idx_changes_type_added ON RegulatoryChanges(type, added_at)",
+        "CREATE INDEX IF NOT EXISTS idx_changes_effective_key ON RegulatoryChanges(IFNULL(effective_date, ''))",
+    ),
+    # 6: audit trail lookups by user, table and row, newest first
+    (
+        "CREATE INDEX IF NOT EXISTS idx_audit_user ON AuditLog(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_audit_table ON AuditLog(table_name)",
+        "CREATE INDEX IF NOT EXISTS idx_audit_row ON AuditLog(table_name, row_id)",
+    ),
+    # 7: bounce suppression. The partial index holds only deliverable
+    # addresses, in the customer order the dispatch selection reads them;
+    # bounces find an address by its lowercase form
+    (
+        "ALTER TABLE CustomerEmails ADD COLUMN suppressed_at DATETIME",
+        "ALTER TABLE CustomerEmails ADD COLUMN bounce_reason TEXT",
+        "ALTER TABLE CustomerEmails ADD COLUMN soft_bounces INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_customer_emails_deliverable ON CustomerEmails(customer_id) "
+        "WHERE suppressed_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS idx_customer_emails_address ON CustomerEmails(lower(email))",
+        """
+        CREATE TABLE IF NOT EXISTS BounceMailboxes (
+            path TEXT PRIMARY KEY,
+            position INTEGER NOT NULL DEFAULT 0,
+            marker TEXT,
+            checked_at DATETIME
+        )
+        """,
+    ),
+    # 8: Maildir messages already read, by unique name per mailbox
+    (
+        """
+        CREATE TABLE IF NOT EXISTS BounceMaildirFiles (
+            mailbox TEXT NOT NULL,
+            name TEXT NOT NULL,
+            PRIMARY KEY (mailbox, name)
+        ) WITHOUT ROWID
+        """,
+    ),
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    # Cheap when up to date: a single PRAGMA read
+    if schema_version(conn) >= SCHEMA_VERSION:
+        return
+    for version in range(SCHEMA_VERSION):
+        # Each step in its own write transaction; the version is re-read
+        # under the lock in case another connection migrated meanwhile
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if schema_version(conn) > version:
+                conn.rollback()
+                continue
+            for statement in MIGRATIONS[version]:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        logging.info(f"Migrated database schema to version {version + 1}")
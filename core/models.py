@@ -1 +1,411 @@
 # models.py - DB query logic
+import html
+import re
+import threading
+from core.audit import audit_log
+from core.db import transaction
+from core.events import DELETE, INSERT, events
+
+INSERT_MAPPING_SQL = "INSERT OR IGNORE INTO CustomerCategoryMapping (customer_id, category_id) VALUES (?, ?)"
+DELETE_MAPPING_SQL = "DELETE FROM CustomerCategoryMapping WHERE customer_id = ? AND category_id = ?"
+# (id, label) of every category, as listed by the views
+CATEGORIES_SQL = "SELECT id, scope || ' – ' || description FROM Categories ORDER BY scope, description"
+# Values allowed by the RegulatoryChanges.type CHECK constraint
+CHANGE_TYPES = ("change", "frist", "note", "news")
+# Selection rows read per block; the details of a block's new changes are
+# loaded together, at most DETAILS_CHUNK ids per query
+SELECTION_BLOCK = 5000
+DETAILS_CHUNK = 500
+
+
+def active_recipients(conn):
+    # One row per deliverable address of every active customer, in send order
+    return conn.execute("""
+        SELECT c.id, c.name, e.email
+        FROM Customers c
+        JOIN CustomerEmails e ON e.customer_id = c.id
+        WHERE c.active = 1 AND e.suppressed_at IS NULL
+        ORDER BY c.id, e.id
+    """)
+
+
+class DispatchCutoffs:
+    # What each address already received, from NewsletterDispatch. An
+    # address's cutoff is (time, change ids): changes added after the time
+    # are pending, and so are changes added in that very second unless the
+    # listed ids carried them. Successful rows are stamped with their run's
+    # enqueue time; the ids settle changes added in the same second after
+    # the enqueue.
+    #
+    # The cutoff is the address's last successful dispatch, or the last one
+    # to the whole customer from before dispatches were per address (email
+    # NULL). An address that was tried but never reached starts at the since
+    # of its first row, so what failed is sent again. An address never tried,
+    # e.g. one just added, continues from the customer's last dispatch
+    # instead of getting every change ever made.
+    def __init__(self, conn):
+        self.delivered = {}
+        self.customers = {}
+        for customer_id, email, sent_at, change_ids in conn.execute("""
+            SELECT customer_id, lower(email), MAX(sent_at), change_ids
+            FROM NewsletterDispatch
+            WHERE status = 'sent' AND sent_at IS NOT NULL
+            GROUP BY customer_id, lower(email)
+        """):
+            cutoff = self.delivered[(customer_id, email)] = (sent_at, change_ids or "")
+            self.customers[customer_id] = max(self.customers.get(customer_id, cutoff), cutoff)
+        self.attempted = {
+            (customer_id, email): since
+            for customer_id, email, since in conn.execute("""
+                SELECT customer_id, lower(email), MIN(since)
+                FROM NewsletterDispatch
+                WHERE since IS NOT NULL
+                GROUP BY customer_id, lower(email)
+            """)
+        }
+        self.known = set(self.customers) | {customer_id for customer_id, _ in self.attempted}
+
+    def customer(self, customer_id):
+        return self.customers.get(customer_id, ("", ""))
+
+    def address(self, customer_id, email):
+        key = (customer_id, email.lower())
+        own = self.delivered.get(key)
+        legacy = self.delivered.get((customer_id, None))
+        if own or legacy:
+            return max(cutoff for cutoff in (own, legacy) if cutoff)
+        if key in self.attempted:
+            return self.attempted[key], ""
+        return self.customer(customer_id)
+
+    def lower_bounds(self, conn):
+        # (customer id, earliest cutoff time of its addresses) for customers
+        # with dispatch history; the others start at the beginning anyway
+        bounds = {}
+        for customer_id, email in conn.execute("""
+            SELECT e.customer_id, e.email
+            FROM CustomerEmails e
+            JOIN Customers c ON c.id = e.customer_id
+            WHERE c.active = 1 AND e.suppressed_at IS NULL
+        """):
+            if customer_id in self.known:
+                since = self.address(customer_id, email)[0]
+                bounds[customer_id] = min(bounds.get(customer_id, since), since)
+        for customer_id in self.known:
+            bounds.setdefault(customer_id, self.customer(customer_id)[0])
+        return [(customer_id, since) for customer_id, since in bounds.items() if since]
+
+
+def after_cutoff(change, cutoff):
+    since, change_ids = cutoff
+    added_at = change["added_at"] or ""
+    return added_at > since or (added_at == since and str(change["id"]) not in change_ids.split(","))
+
+
+def pending_newsletters(conn):
+    # Streams (customer, changes) for every active customer that has
+    # RegulatoryChanges in a mapped category its addresses haven't received
+    # yet (see DispatchCutoffs). Addresses of one customer that are at
+    # different points get separate entries; customer["since"] is their
+    # cutoff time. Timestamps compare as text, so sent_at must be stored
+    # like CURRENT_TIMESTAMP ('YYYY-MM-DD HH:MM:SS').
+    #
+    # The earliest cutoff of each customer goes into a temporary table, so
+    # one ordered scan finds the candidates of all customers; it is merged
+    # with a scan of the addresses and the details of the changes are loaded
+    # in blocks, so the number of queries doesn't grow with the number of
+    # customers. The sorted scan carries ids only; a change's details are
+    # read once and the same dict is shared by every customer it goes to.
+    # CROSS JOIN pins the order customer -> mapping -> change so each
+    # mapping is one range on a (category_id, added_at) index; left to
+    # itself SQLite may walk an effective_date index once per customer
+    # instead.
+    cutoffs = DispatchCutoffs(conn)
+    conn.execute("DROP TABLE IF EXISTS temp.pending_since")
+    conn.execute("CREATE TEMP TABLE pending_since (customer_id INTEGER PRIMARY KEY, since TEXT)")
+    try:
+        conn.executemany("INSERT INTO temp.pending_since (customer_id, since) VALUES (?, ?)",
+                         cutoffs.lower_bounds(conn))
+        pending = conn.execute("""
+            SELECT c.id, c.name, r.id
+            FROM Customers c
+            CROSS JOIN CustomerCategoryMapping m ON m.customer_id = c.id
+            CROSS JOIN RegulatoryChanges r ON r.category_id = m.category_id AND r.added_at >= IFNULL((
+                SELECT since FROM temp.pending_since WHERE customer_id = c.id
+            ), '')
+            WHERE c.active = 1
+            ORDER BY c.id, r.effective_date, r.id
+        """)
+        for customer, changes in group_by_customer(conn, pending):
+            groups = {}
+            for email in customer["emails"]:
+                groups.setdefault(cutoffs.address(customer["id"], email), []).append(email)
+            if not groups:
+                groups[cutoffs.customer(customer["id"])] = []
+            for cutoff, emails in groups.items():
+                selected = [change for change in changes if after_cutoff(change, cutoff)]
+                if selected:
+                    yield dict(customer, emails=emails, since=cutoff[0]), selected
+    finally:
+        conn.execute("DROP TABLE IF EXISTS temp.pending_since")
+
+
+def quarter_newsletters(conn, start, end):
+    # Streams (customer, changes) for every active customer with changes in
+    # a mapped category added in [start, end), whatever was sent: the
+    # newsletter content of a past or current period, e.g. for the archive
+    changes = conn.execute("""
+        SELECT c.id, c.name, r.id
+        FROM Customers c
+        CROSS JOIN CustomerCategoryMapping m ON m.customer_id = c.id
+        CROSS JOIN RegulatoryChanges r ON r.category_id = m.category_id AND r.added_at >= ? AND r.added_at < ?
+        WHERE c.active = 1
+        ORDER BY c.id, r.effective_date, r.id
+    """, (start, end))
+    yield from group_by_customer(conn, changes)
+
+
+def group_by_customer(conn, rows):
+    # rows: (customer id, name, change id) ordered by customer id. Merged
+    # with an ordered scan of the active customers' addresses; bounced ones
+    # are left out by walking idx_customer_emails_deliverable, which only
+    # holds the others.
+    emails = conn.execute("""
+        SELECT e.customer_id, e.email
+        FROM CustomerEmails e
+        JOIN Customers c ON c.id = e.customer_id
+        WHERE c.active = 1 AND e.suppressed_at IS NULL
+        ORDER BY e.customer_id, e.id
+    """)
+
+    details = {}
+    email_row = emails.fetchone()
+    customer = None
+    while True:
+        block = rows.fetchmany(SELECTION_BLOCK)
+        if not block:
+            break
+        load_change_details(conn, {change_id for _, _, change_id in block} - details.keys(), details)
+        for customer_id, name, change_id in block:
+            if customer is None or customer["id"] != customer_id:
+                if customer is not None:
+                    yield customer, customer.pop("changes")
+                customer = {"id": customer_id, "name": name, "emails": [], "changes": []}
+                while email_row is not None and email_row[0] < customer_id:
+                    email_row = emails.fetchone()
+                while email_row is not None and email_row[0] == customer_id:
+                    customer["emails"].append(email_row[1])
+                    email_row = emails.fetchone()
+            elif customer["changes"][-1]["id"] == change_id:
+                # Duplicate mapping rows yield the same change twice in a row
+                continue
+            customer["changes"].append(details[change_id])
+    if customer is not None:
+        yield customer, customer.pop("changes")
+
+
+def load_change_details(conn, change_ids, details):
+    # Adds {id: change dict} for change_ids to details. A change whose
+    # category was deleted gets an empty category.
+    change_ids = list(change_ids)
+    for start in range(0, len(change_ids), DETAILS_CHUNK):
+        chunk = change_ids[start:start + DETAILS_CHUNK]
+        for change_id, change_type, effective_date, added_at, content, category in conn.execute(f"""
+            SELECT r.id, r.type, r.effective_date, r.added_at, r.content,
+                   IFNULL(cat.scope || ' – ' || cat.description, '')
+            FROM RegulatoryChanges r
+            LEFT JOIN Categories cat ON cat.id = r.category_id
+            WHERE r.id IN ({','.join('?' * len(chunk))})
+        """, chunk):
+            details[change_id] = {
+                "id": change_id,
+                "type": change_type,
+                "effective_date": effective_date,
+                "added_at": added_at,
+                "content": content,
+                "category": category,
+            }
+
+
+def write_mappings(conn, changes):
+    # changes: iterable of ((customer_id, category_id), checked)
+    changes = list(changes)
+    conn.executemany(INSERT_MAPPING_SQL, [key for key, checked in changes if checked])
+    conn.executemany(DELETE_MAPPING_SQL, [key for key, checked in changes if not checked])
+    for (customer_id, category_id), checked in changes:
+        events.publish("CustomerCategoryMapping", INSERT if checked else DELETE,
+                       customer_id=customer_id, category_id=category_id)
+
+
+def audit_mappings(db_path, changes, **details):
+    # Logged against the customer, so a customer's history shows its
+    # subscriptions; the category is in the details
+    log = audit_log(db_path)
+    for (customer_id, category_id), checked in changes:
+        log.record("map_category" if checked else "unmap_category", "Customers", customer_id,
+                   dict(details, category_id=category_id))
+
+
+def match_expression(query):
+    # Every word of the input as a quoted prefix term, so user input can't
+    # produce FTS5 syntax errors: 'energie audit' -> '"energie"* "audit"*'
+    return " ".join(f'"{term}"*' for term in re.findall(r"\w+", query))
+
+
+def highlight(text):
+    # snippet() marks hits with \x02...\x03; escape first, then turn the
+    # markers into tags for the dashboard's HTML delegate
+    return html.escape(text).replace("\x02", "<b>").replace("\x03", "</b>")
+
+
+# ORDER BY expressions the change browser can page on, each followed by
+# r.id as tie-breaker. effective_date may be NULL, which row values can't
+# compare, so it sorts as ''. Relevance is only available with a search query.
+CHANGE_SORT_KEYS = {
+    "id": "r.id",
+    "added_at": "r.added_at",
+    "type": "r.type",
+    "effective_date": "IFNULL(r.effective_date, '')",
+    "relevance": "bm25(RegulatoryChangesSearch, 1.0, 0.5)",
+}
+
+
+def change_page(conn, after=None, limit=100, sort="added_at", descending=True, query="",
+                category_id=None, change_type=None, date_from=None, date_to=None):
+    # One page of RegulatoryChanges as (id, added_at, type, effective_date,
+    # category, content_html, sort_value). `after` is (sort_value, id) of the
+    # last row of the previous page, so every page is an index range scan
+    # instead of an OFFSET. With a query only matching changes are listed and
+    # content_html is a snippet with the hits in <b>. Dates are 'YYYY-MM-DD'.
+    conditions = []
+    params = []
+    expression = match_expression(query)
+    searchable = expression and conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'RegulatoryChangesSearch'"
+    ).fetchone()
+    if searchable:
+        source = "RegulatoryChangesSearch s JOIN RegulatoryChanges r ON r.id = s.rowid"
+        content = "snippet(RegulatoryChangesSearch, 0, char(2), char(3), '…', 16)"
+        conditions.append("RegulatoryChangesSearch MATCH ?")
+        params.append(expression)
+    else:
+        source = "RegulatoryChanges r"
+        content = "substr(r.content, 1, 300)"
+        # No FTS5 in this SQLite build
+        for term in re.findall(r"\w+", query) if expression else ():
+            conditions.append("r.content LIKE ?")
+            params.append(f"%{term}%")
+        if sort == "relevance":
+            sort, descending = "added_at", True
+    if category_id is not None:
+        conditions.append("r.category_id = ?")
+        params.append(category_id)
+    if change_type:
+        conditions.append("r.type = ?")
+        params.append(change_type)
+    if date_from:
+        conditions.append("r.effective_date >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("r.effective_date <= ?")
+        params.append(date_to)
+
+    key = CHANGE_SORT_KEYS[sort]
+    if sort == "effective_date" and (date_from or date_to):
+        # The date range already excludes NULLs; the plain column lets one
+        # index serve both the range and the order
+        key = "r.effective_date"
+    direction = "DESC" if descending else "ASC"
+    if after is not None:
+        # Same as ({key}, r.id) < (?, ?), but written so SQLite can use the
+        # leading term for an index range scan, which it doesn't do for a row
+        # value compared against an expression
+        op = "<" if descending else ">"
+        conditions.append(f"{key} {op}= ? AND ({key} {op} ? OR r.id {op} ?)")
+        params.extend((after[0], after[0], after[1]))
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    rows = conn.execute(f"""
+        SELECT r.id, r.added_at, r.type, r.effective_date, c.scope || ' – ' || c.description,
+               {content}, {key}
+        FROM {source}
+        LEFT JOIN Categories c ON c.id = r.category_id{where}
+        ORDER BY {key} {direction}, r.id {direction}
+        LIMIT ?
+    """, params + [limit])
+    return [row[:5] + (highlight(row[5] or ""), row[6]) for row in rows]
+
+
+class MappingChangeBuffer:
+    # Write-behind buffer for CustomerCategoryMapping edits. Toggles are
+    # coalesced per (customer, category) until flush(), so an on/off pair
+    # never reaches the database; every flushed batch is one transaction and
+    # is kept for undo(). set() is called on the GUI thread, flush() and
+    # undo() on worker threads: batches are taken and written one writer at
+    # a time, so they reach the database in click order.
+    def __init__(self, db_path, undo_limit=50):
+        self.db_path = db_path
+        self.undo_limit = undo_limit
+        self.pending = {}
+        self.original = {}
+        self.undo_stack = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.RLock()
+
+    def set(self, customer_id, category_id, checked):
+        key = (customer_id, category_id)
+        with self._lock:
+            if key not in self.pending:
+                # Callers only report real changes, so the stored state is the opposite
+                self.original[key] = not checked
+            if self.original[key] == checked:
+                del self.pending[key]
+                del self.original[key]
+            else:
+                self.pending[key] = checked
+
+    def __len__(self):
+        return len(self.pending)
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                if not self.pending:
+                    return []
+                batch = list(self.pending.items())
+                self.pending.clear()
+                self.original.clear()
+            try:
+                with transaction(self.db_path) as conn:
+                    write_mappings(conn, batch)
+            except Exception:
+                # Back into the buffer for the next flush, unless clicked again meanwhile
+                with self._lock:
+                    for key, checked in batch:
+                        if key not in self.pending:
+                            self.pending[key] = checked
+                            self.original[key] = not checked
+                raise
+            audit_mappings(self.db_path, batch)
+            with self._lock:
+                self.undo_stack.append(batch)
+                del self.undo_stack[:-self.undo_limit]
+            return batch
+
+    def undo(self):
+        # Reverts the most recently flushed batch; returns the changes applied
+        with self._write_lock:
+            self.flush()
+            with self._lock:
+                if not self.undo_stack:
+                    return []
+                batch = self.undo_stack.pop()
+            inverse = [(key, not checked) for key, checked in batch]
+            try:
+                with transaction(self.db_path) as conn:
+                    write_mappings(conn, inverse)
+            except Exception:
+                with self._lock:
+                    self.undo_stack.append(batch)
+                raise
+            audit_mappings(self.db_path, inverse, undo=True)
+            return inverse
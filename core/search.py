@@ -0,0 +1,186 @@
+# search.py - in-memory search index for customer, category and email lookups
+import bisect
+import unicodedata
+
+UMLAUTS = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+NGRAM = 3
+# Delay after the last keystroke before a search input is applied
+DEBOUNCE_MS = 150
+
+
+def strip_accents(text):
+    if text.isascii():
+        return text
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+def fold(text):
+    # "Müller", "MUELLER" and "mueller" all fold to "mueller"
+    return strip_accents(unicodedata.normalize("NFC", text).casefold().translate(UMLAUTS))
+
+
+def index_key(text):
+    # Both spellings are indexed so "muller" finds "Müller" as well
+    folded = fold(text)
+    plain = strip_accents(text.casefold())
+    return folded if plain == folded else f"{folded}\n{plain}"
+
+
+def ngrams(text):
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+class SearchIndex:
+    # Trigram index over precomputed folded keys. A query is split into terms
+    # that must all occur as substrings. Posting lists are built on first use
+    # of a trigram and then cached, so building the index only costs the key
+    # normalization; a query that extends the previous one only re-checks the
+    # previous hits. update() and discard() change single entries in place,
+    # so an open index follows edits without being rebuilt.
+    def __init__(self, entries=()):
+        self.ids = []
+        self.keys = []
+        self.positions = {}
+        self.postings = {}
+        self._last_query = None
+        self._last_hits = None
+        for entry_id, text in entries:
+            self.add(entry_id, text)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def add(self, entry_id, text):
+        position = len(self.ids)
+        key = index_key(text)
+        self.ids.append(entry_id)
+        self.keys.append(key)
+        self.positions[entry_id] = position
+        if self.postings:
+            for gram in ngrams(key):
+                posting = self.postings.get(gram)
+                if posting is not None:
+                    posting.append(position)
+        self._last_query = None
+
+    def update(self, entry_id, text):
+        # Replaces the text of an entry, keeping its place in the order; new
+        # ids are appended. Posting lists may keep positions whose key no
+        # longer has the trigram, the substring check skips them.
+        position = self.positions.get(entry_id)
+        if position is None:
+            self.add(entry_id, text)
+            return
+        key = index_key(text)
+        self.keys[position] = key
+        for gram in ngrams(key):
+            posting = self.postings.get(gram)
+            if posting is not None:
+                i = bisect.bisect_left(posting, position)
+                if i == len(posting) or posting[i] != position:
+                    posting.insert(i, position)
+        self._last_query = None
+
+    def discard(self, entry_id):
+        # The slot stays, with a key nothing matches, so positions don't shift
+        position = self.positions.pop(entry_id, None)
+        if position is None:
+            return
+        self.ids[position] = None
+        self.keys[position] = ""
+        self._last_query = None
+
+    def search(self, query):
+        # Returns matching ids in insertion order
+        query = fold(query).strip()
+        terms = query.split()
+        if not terms:
+            self._last_query = None
+            return list(self.positions)
+
+        if self._last_query is not None and query.startswith(self._last_query):
+            candidates = self._last_hits
+        else:
+            candidates = self._candidates(terms)
+
+        keys = self.keys
+        if len(terms) == 1:
+            term = terms[0]
+            hits = [i for i in candidates if term in keys[i]]
+        else:
+            hits = [i for i in candidates if all(term in keys[i] for term in terms)]
+        self._last_query = query
+        self._last_hits = hits
+        return [self.ids[i] for i in hits]
+
+    def posting(self, gram):
+        posting = self.postings.get(gram)
+        if posting is None:
+            posting = self.postings[gram] = [i for i, key in enumerate(self.keys) if gram in key]
+        return posting
+
+    def _candidates(self, terms):
+        grams = set()
+        for term in terms:
+            grams |= ngrams(term)
+        if not grams:
+            return range(len(self.ids))
+        # Narrow down with the smallest posting list already known; compute
+        # at most one new one. The substring check does the rest.
+        known = [self.postings[gram] for gram in grams if gram in self.postings]
+        if known:
+            return min(known, key=len)
+        return self.posting(max(grams))
+
+
+def customer_entries(conn, active_only=False, customer_ids=None):
+    # (id, searchable text) of customers: name plus all email addresses
+    conditions = []
+    params = []
+    if active_only:
+        conditions.append("c.active = 1")
+    if customer_ids is not None:
+        conditions.append(f"c.id IN ({','.join('?' * len(customer_ids))})")
+        params.extend(customer_ids)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    rows = conn.execute(f"""
+        SELECT c.id, c.name, group_concat(e.email, ' ')
+        FROM Customers c
+        LEFT JOIN CustomerEmails e ON e.customer_id = c.id
+        {where}
+        GROUP BY c.id
+        ORDER BY c.name, c.id
+    """, params)
+    return [(customer_id, f"{name} {emails or ''}") for customer_id, name, emails in rows]
+
+
+def customer_index(conn, active_only=False):
+    # In name order
+    return SearchIndex(customer_entries(conn, active_only))
+
+
+def changed_customer_entries(conn, customer_ids, active_only=False):
+    # customer_entries() of the given customers, read in chunks; run on a
+    # worker thread, the result goes to refresh_customers()
+    customer_ids = list(customer_ids)
+    entries = []
+    for start in range(0, len(customer_ids), 500):
+        entries += customer_entries(conn, active_only, customer_ids[start:start + 500])
+    return customer_ids, entries
+
+
+def refresh_customers(index, customer_ids, entries):
+    # Brings the entries of changed customers up to date: their text is
+    # replaced, customers gone (or no longer active) are dropped
+    found = set()
+    for customer_id, text in entries:
+        index.update(customer_id, text)
+        found.add(customer_id)
+    for customer_id in customer_ids:
+        if customer_id not in found:
+            index.discard(customer_id)
+
+
+def category_index(conn):
+    rows = conn.execute("SELECT id, scope, description FROM Categories ORDER BY scope, description")
+    return SearchIndex((category_id, f"{scope} – {description}") for category_id, scope, description in rows)
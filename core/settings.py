@@ -0,0 +1,64 @@
+# settings.py - config.ini, logging/metrics/audit, the newsletter renderer and link tracker, each set up once on first use
+import configparser
+import logging
+import threading
+from core.audit import configure_audit
+from core.metrics import configure_metrics
+
+CONFIG_PATH = "config.ini"
+LOG_FORMAT = '%(asctime)s %(message)s'
+
+
+class Settings:
+    # Nothing is read at import time: the login window can appear before
+    # config.ini is parsed, and Jinja2 is only imported (and the template
+    # compiled) when the first newsletter is rendered.
+    def __init__(self, path=CONFIG_PATH):
+        self.path = path
+        self._config = None
+        self._renderer = None
+        self._tracker = None
+        self._lock = threading.Lock()
+
+    @property
+    def config(self):
+        if self._config is None:
+            with self._lock:
+                if self._config is None:
+                    config = configparser.ConfigParser()
+                    config.read(self.path)
+                    logging.basicConfig(
+                        filename=config['APP']['log_file'], level=logging.INFO, format=LOG_FORMAT
+                    )
+                    configure_metrics(config)
+                    configure_audit(config)
+                    self._config = config
+        return self._config
+
+    @property
+    def db_path(self):
+        return self.config['APP']['db_path']
+
+    @property
+    def renderer(self):
+        if self._renderer is None:
+            config = self.config
+            with self._lock:
+                if self._renderer is None:
+                    from core.email_sender import NewsletterRenderer
+                    self._renderer = NewsletterRenderer.from_config(config)
+        return self._renderer
+
+    @property
+    def tracker(self):
+        # LinkTracker, or None unless [TRACKING] is enabled
+        if self._tracker is None:
+            config = self.config
+            with self._lock:
+                if self._tracker is None:
+                    from core.tracking import LinkTracker
+                    self._tracker = LinkTracker.from_config(config) or False
+        return self._tracker or None
+
+
+settings = Settings()
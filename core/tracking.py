@@ -0,0 +1,305 @@
+# tracking.py - open/click tracking: link rewriting at render time, pixel/redirect HTTP endpoint, batched ingestion
+#
+#   python cli.py track        serves [TRACKING] host:port until Ctrl+C
+#
+# Every sent newsletter gets a 1x1 pixel and its links point at the endpoint,
+# each URL carrying the NewsletterDispatch row id and an HMAC of it, so hits
+# can't be forged for other recipients and the redirect can't be abused as an
+# open redirect. The first open and the first click per recipient end up in
+# NewsletterDispatch.opened_at / clicked_at.
+import asyncio
+import base64
+import concurrent.futures
+import hashlib
+import hmac
+import html
+import logging
+import os
+import re
+import secrets
+import threading
+import time
+from urllib.parse import parse_qs, quote, urlsplit
+from core.db import transaction
+from core.metrics import metrics
+
+# Transparent 1x1 GIF
+PIXEL = base64.b64decode("R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7")
+LINK_PATTERN = re.compile(r'href="(https?://[^"]+)"', re.IGNORECASE)
+BODY_END_PATTERN = re.compile(r"</body>", re.IGNORECASE)
+# Reserved and unreserved URL characters that pass through the Location header
+LOCATION_SAFE = ":/?#[]@!$&'()*+,;=%~"
+REASONS = {200: "OK", 302: "Found", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+
+
+def signature(secret, message):
+    digest = hmac.new(secret, message.encode(), hashlib.sha256).digest()[:12]
+    return base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+
+def load_secret(section):
+    # [TRACKING] secret, or a random key kept next to the database so the
+    # sender and the endpoint on the same machine agree without setup
+    secret = section.get('secret', fallback='').strip()
+    if secret:
+        return secret.encode()
+    path = section.get('key_file', fallback='data/tracking.key')
+    if not os.path.exists(path):
+        with open(path, "w", encoding="ascii") as f:
+            f.write(secrets.token_hex(32))
+        logging.info(f"Created tracking key {path}")
+    with open(path, encoding="ascii") as f:
+        return f.read().strip().encode()
+
+
+class LinkTracker:
+    # Signs and checks tracking URLs and rewrites rendered newsletters
+    def __init__(self, base_url, secret):
+        self.base_url = base_url.rstrip("/")
+        self.secret = secret
+        # Link signatures don't depend on the recipient, so each URL of a
+        # run is signed once
+        self._link_suffixes = {}
+
+    @classmethod
+    def from_config(cls, config):
+        # None unless [TRACKING] enabled = yes
+        if not config.getboolean('TRACKING', 'enabled', fallback=False):
+            return None
+        section = config['TRACKING']
+        return cls(section['base_url'], load_secret(section))
+
+    def token(self, dispatch_id):
+        return f"{dispatch_id}-{signature(self.secret, f'r:{dispatch_id}')}"
+
+    def dispatch_id(self, token):
+        # Row id of a valid token, otherwise None
+        dispatch_id, _, sig = token.partition("-")
+        if not dispatch_id.isdigit() or not hmac.compare_digest(sig, signature(self.secret, f"r:{dispatch_id}")):
+            return None
+        return int(dispatch_id)
+
+    def link_signature(self, url):
+        return signature(self.secret, f"u:{url}")
+
+    def rewrite(self, body, dispatch_id):
+        # Links through the redirect, pixel before </body>
+        token = self.token(dispatch_id)
+
+        def tracked(match):
+            url = html.unescape(match.group(1))
+            if url.startswith(self.base_url):
+                return match.group(0)
+            suffix = self._link_suffixes.get(url)
+            if suffix is None:
+                suffix = self._link_suffixes[url] = html.escape(f"?u={quote(url, safe='')}&s={self.link_signature(url)}")
+            return f'href="{self.base_url}/c/{token}{suffix}"'
+
+        body = LINK_PATTERN.sub(tracked, body)
+        pixel = f'<img src="{self.base_url}/o/{token}.gif" width="1" height="1" alt="" style="display:none">'
+        body, found = BODY_END_PATTERN.subn(lambda match: pixel + match.group(0), body, count=1)
+        return body if found else body + pixel
+
+
+def utc_now():
+    # Same format and clock as CURRENT_TIMESTAMP
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+
+class HitBuffer:
+    # First open and first click per row since the last flush. Rows already
+    # written are remembered, so repeated hits (mail clients reload pixels,
+    # people click twice) never reach the database. Written in transactions
+    # of at most batch_size rows: the write lock is held for milliseconds
+    # at a time and GUI writes get in between.
+    def __init__(self, db_path, batch_size=500, remember=1_000_000):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.remember = remember
+        self.opens = {}
+        self.clicks = {}
+        self.recorded_opens = set()
+        self.recorded_clicks = set()
+        self._lock = threading.Lock()
+
+    def open(self, dispatch_id):
+        # Called on the event loop while flush() runs on the writer thread
+        with self._lock:
+            if dispatch_id not in self.recorded_opens and dispatch_id not in self.opens:
+                self.opens[dispatch_id] = utc_now()
+
+    def click(self, dispatch_id):
+        with self._lock:
+            if dispatch_id not in self.recorded_clicks and dispatch_id not in self.clicks:
+                self.clicks[dispatch_id] = utc_now()
+
+    def __len__(self):
+        return len(self.opens) + len(self.clicks)
+
+    def flush(self):
+        # The lock only covers the swap and the bookkeeping, never the
+        # database, so hits keep coming in while a batch is written
+        with self._lock:
+            opens, self.opens = self.opens, {}
+            clicks, self.clicks = self.clicks, {}
+        # A click without a recorded open (images blocked) counts as one
+        updates = [("open", dispatch_id, seen) for dispatch_id, seen in opens.items()]
+        updates += [("click", dispatch_id, seen) for dispatch_id, seen in clicks.items()]
+        for start in range(0, len(updates), self.batch_size):
+            batch = updates[start:start + self.batch_size]
+            try:
+                with metrics.timer("db.tracking_flush"), transaction(self.db_path) as conn:
+                    conn.executemany(
+                        "UPDATE NewsletterDispatch SET opened_at = ? WHERE id = ? AND opened_at IS NULL",
+                        [(seen, dispatch_id) for kind, dispatch_id, seen in batch if kind == "open"],
+                    )
+                    conn.executemany(
+                        "UPDATE NewsletterDispatch SET clicked_at = ?, opened_at = COALESCE(opened_at, ?) "
+                        "WHERE id = ? AND clicked_at IS NULL",
+                        [(seen, seen, dispatch_id) for kind, dispatch_id, seen in batch if kind == "click"],
+                    )
+            except Exception:
+                # Back into the buffer for the next flush
+                with self._lock:
+                    for kind, dispatch_id, seen in updates[start:]:
+                        (self.opens if kind == "open" else self.clicks).setdefault(dispatch_id, seen)
+                raise
+            with self._lock:
+                for kind, dispatch_id, _ in batch:
+                    (self.recorded_opens if kind == "open" else self.recorded_clicks).add(dispatch_id)
+        with self._lock:
+            if len(self.recorded_opens) + len(self.recorded_clicks) > self.remember:
+                self.recorded_opens.clear()
+                self.recorded_clicks.clear()
+        return len(updates)
+
+
+class TrackingServer:
+    # Minimal HTTP/1.1 server on asyncio: GET/HEAD of the pixel and the
+    # redirect, keep-alive, nothing else. Hits only touch the in-memory
+    # buffer; a single writer thread flushes it every flush_interval seconds
+    # or as soon as batch_size hits are waiting.
+    def __init__(self, tracker, buffer, host="127.0.0.1", port=8025, flush_interval=2.0, idle_timeout=15):
+        self.tracker = tracker
+        self.buffer = buffer
+        self.host = host
+        self.port = port
+        self.flush_interval = flush_interval
+        self.idle_timeout = idle_timeout
+        self._writer = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="TrackingFlush")
+        self._flush_now = None
+
+    @classmethod
+    def from_config(cls, tracker, db_path, config):
+        section = config['TRACKING']
+        buffer = HitBuffer(db_path, section.getint('batch_size', fallback=500))
+        return cls(
+            tracker, buffer, section.get('host', fallback='127.0.0.1'), section.getint('port', fallback=8025),
+            section.getfloat('flush_interval', fallback=2.0),
+        )
+
+    def route(self, target):
+        # (status, headers, body)
+        parts = urlsplit(target)
+        if parts.path.startswith("/o/") and parts.path.endswith(".gif"):
+            dispatch_id = self.tracker.dispatch_id(parts.path[3:-4])
+            if dispatch_id is not None:
+                metrics.count("tracking.open")
+                self.record(self.buffer.open, dispatch_id)
+            # The pixel either way; a broken image looks worse than a lost hit
+            return 200, [("Content-Type", "image/gif"), ("Cache-Control", "no-store, private")], PIXEL
+        if parts.path.startswith("/c/"):
+            query = parse_qs(parts.query)
+            url = query.get("u", [""])[0]
+            sig = query.get("s", [""])[0]
+            if not url or not hmac.compare_digest(sig, self.tracker.link_signature(url)):
+                return 400, [], b"Invalid link\n"
+            dispatch_id = self.tracker.dispatch_id(parts.path[3:])
+            if dispatch_id is not None:
+                metrics.count("tracking.click")
+                self.record(self.buffer.click, dispatch_id)
+            # Header values go out as latin-1; anything else is percent-encoded,
+            # escapes already in the URL stay as they are
+            location = quote(url, safe=LOCATION_SAFE)
+            return 302, [("Location", location), ("Cache-Control", "no-store, private")], b""
+        return 404, [], b"Not found\n"
+
+    def record(self, hit, dispatch_id):
+        hit(dispatch_id)
+        if len(self.buffer) >= self.buffer.batch_size:
+            self._flush_now.set()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                parts = request_line.decode("latin-1").split()
+                if len(parts) != 3:
+                    writer.write(self.response(400, [], b"Bad request\n", False))
+                    break
+                method, target, version = parts
+                if method in ("GET", "HEAD"):
+                    status, extra, body = self.route(target)
+                else:
+                    status, extra, body = 405, [("Allow", "GET, HEAD")], b""
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                writer.write(self.response(status, extra, b"" if method == "HEAD" else body, keep_alive, len(body)))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            # Idle keep-alive connection, client gone, or an oversized line
+            pass
+        finally:
+            writer.close()
+
+    def response(self, status, headers, body, keep_alive, length=None):
+        lines = [f"HTTP/1.1 {status} {REASONS[status]}"]
+        lines += [f"{name}: {value}" for name, value in headers]
+        lines.append(f"Content-Length: {len(body) if length is None else length}")
+        lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+    async def flusher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            if len(self.buffer):
+                try:
+                    await loop.run_in_executor(self._writer, self.buffer.flush)
+                except Exception as e:
+                    logging.error(f"Writing tracking hits failed: {e}")
+
+    async def serve(self):
+        self._flush_now = asyncio.Event()
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        logging.info(f"Tracking endpoint listening on {self.host}:{self.port}")
+        flusher = asyncio.create_task(self.flusher())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            flusher.cancel()
+            # Whatever arrived since the last flush
+            await asyncio.get_running_loop().run_in_executor(self._writer, self.buffer.flush)
+            self._writer.shutdown()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
@@ -1,10 +1,13 @@
+import os
 import sqlite3
+import sys
 
-db_path = "data/iso_newsletter_app.db"
-conn = sqlite3.connect(db_path)
-cur = conn.cursor()
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core.migrations import migrate
 
-cur.executescript("""
+DB_PATH = "data/iso_newsletter_app.db"
+
+SCHEMA = """
 CREATE TABLE IF NOT EXISTS Users (
     id INTEGER PRIMARY KEY,
     username TEXT UNIQUE NOT NULL,
@@ -73,9 +76,17 @@ CREATE TABLE IF NOT EXISTS AuditLog (
 -- Insert default user: admin / admin
 INSERT OR IGNORE INTO Users (username, password_hash, full_name)
 VALUES ('admin', 'admin', 'Admin User');
-""")
+"""
+
+
+def init_db(db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    conn.commit()
+    migrate(conn)
+    conn.close()
 
-conn.commit()
-conn.close()
 
-print("✅ Database initialized.")
+if __name__ == '__main__':
+    init_db()
+    print("✅ Database initialized.")
@@ -0,0 +1,212 @@
+# generate_data.py - seeded synthetic database at configurable scale for benchmarks
+#
+# Creates a new database with the data/db_init.py schema and fills it with
+# customers, addresses, categories, mappings, changes and past dispatches.
+# The same seed and options always produce the same rows. Run from the
+# repository root, e.g. at the scale of a large installation:
+#
+#   python data/generate_data.py --db data/bench.db --customers 100000 --categories 1000 --changes 50000
+#
+# Category popularity follows a Zipf distribution, so a few categories are
+# mapped to many customers; a flatter one decides which categories get the
+# most changes.
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.db_init import init_db
+
+SCOPES = [
+    "EU", "Deutschland", "Österreich", "Schweiz", "Bayern", "Baden-Württemberg", "Nordrhein-Westfalen",
+    "Hessen", "Niedersachsen", "Sachsen", "Berlin", "Hamburg", "International",
+]
+TOPICS = [
+    "Strom", "Gas", "Wärme", "Kälte", "Druckluft", "Beleuchtung", "Gebäude", "Fuhrpark", "Emissionshandel",
+    "Energieaudit", "Energiemanagement", "Eigenerzeugung", "Photovoltaik", "KWK", "Netzentgelte",
+    "Stromsteuer", "Energiesteuer", "Förderprogramme", "Berichtspflichten", "Messwesen",
+]
+WORDS = (
+    "Energie Audit Energieaudit Pflicht Frist Nachweis Anlage Betrieb Änderung Gesetz Verordnung Norm ISO "
+    "Effizienz Management Bericht Daten Messung Verbrauch Einsparung Maßnahme Unternehmen Zertifizierung "
+    "Übergangsfrist Behörde Meldung Förderung Antrag Grenzwert Kennzahl Baseline Leistung Zähler Strom Gas "
+    "Wärme Abwärme Emissionen CO2 Preis Umlage Entlastung Spitzenausgleich Rechenzentrum Lieferant"
+).split()
+COMPANY_FORMS = ["GmbH", "AG", "GmbH & Co. KG", "KG", "SE", "e.K."]
+CHANGE_TYPES = [("change", 5), ("frist", 2), ("note", 2), ("news", 3)]
+BATCH = 10000
+
+
+def zipf_weights(n, exponent=1.1):
+    return [1 / (rank + 1) ** exponent for rank in range(n)]
+
+
+def around(rng, mean):
+    # At least 1, geometric tail; the expected value is `mean`
+    count = 1
+    while rng.random() < 1 - 1 / mean:
+        count += 1
+    return count
+
+
+def batched(rows, size=BATCH):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def stamp(moment):
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def generate(conn, args):
+    rng = random.Random(args.seed)
+    end = datetime.strptime(args.end_date, "%Y-%m-%d") if args.end_date else datetime.now().replace(microsecond=0)
+    start = end - timedelta(days=args.days)
+    counts = {}
+
+    categories = [
+        (i + 1, SCOPES[i % len(SCOPES)], TOPICS[i // len(SCOPES) % len(TOPICS)]
+         + (f" {i // (len(SCOPES) * len(TOPICS)) + 1}" if i >= len(SCOPES) * len(TOPICS) else ""))
+        for i in range(args.categories)
+    ]
+    conn.executemany("INSERT INTO Categories (id, scope, description) VALUES (?, ?, ?)", categories)
+    counts["categories"] = len(categories)
+    # Popularity rank is independent of the id order
+    ranked = [category_id for category_id, _, _ in categories]
+    rng.shuffle(ranked)
+    weights = zipf_weights(len(ranked))
+    # Changes follow their own, flatter popularity: the categories most
+    # customers subscribe to are not necessarily the busiest ones
+    change_ranked = ranked[:]
+    rng.shuffle(change_ranked)
+    change_weights = zipf_weights(len(ranked), 0.6)
+
+    def customers():
+        for customer_id in range(1, args.customers + 1):
+            name = f"{rng.choice(WORDS)} {rng.choice(TOPICS)} {customer_id} {rng.choice(COMPANY_FORMS)}"
+            active = 0 if rng.random() < args.inactive else 1
+            yield customer_id, name, active, stamp(start - timedelta(days=rng.randint(0, 1000)))
+
+    for batch in batched(customers()):
+        conn.executemany("INSERT INTO Customers (id, name, active, created_at) VALUES (?, ?, ?, ?)", batch)
+    counts["customers"] = args.customers
+
+    def emails():
+        for customer_id in range(1, args.customers + 1):
+            for n in range(around(rng, args.emails)):
+                yield customer_id, f"kontakt{n}.{customer_id}@kunde{customer_id % 997}.example"
+
+    counts["emails"] = 0
+    for batch in batched(emails()):
+        conn.executemany("INSERT INTO CustomerEmails (customer_id, email) VALUES (?, ?)", batch)
+        counts["emails"] += len(batch)
+
+    def mappings():
+        for customer_id in range(1, args.customers + 1):
+            wanted = min(around(rng, args.mappings), len(ranked))
+            chosen = set()
+            while len(chosen) < wanted:
+                chosen.update(rng.choices(ranked, weights, k=wanted - len(chosen)))
+            for category_id in sorted(chosen):
+                yield customer_id, category_id
+
+    counts["mappings"] = 0
+    for batch in batched(mappings()):
+        conn.executemany("INSERT INTO CustomerCategoryMapping (customer_id, category_id) VALUES (?, ?)", batch)
+        counts["mappings"] += len(batch)
+
+    types = [change_type for change_type, _ in CHANGE_TYPES]
+    type_weights = [weight for _, weight in CHANGE_TYPES]
+    seconds = int((end - start).total_seconds())
+
+    def changes():
+        # In added_at order, like changes entered over time
+        moments = sorted(rng.randrange(seconds) for _ in range(args.changes))
+        for change_id, offset in enumerate(moments, 1):
+            added_at = start + timedelta(seconds=offset)
+            effective_date = None
+            if rng.random() > 0.1:
+                effective_date = (added_at + timedelta(days=rng.randint(-30, 365))).strftime("%Y-%m-%d")
+            content = " ".join(rng.choice(WORDS) for _ in range(rng.randint(15, 80))) + "."
+            yield (change_id, stamp(added_at), effective_date, rng.choices(types, type_weights)[0],
+                   rng.choices(change_ranked, change_weights)[0], content)
+
+    for batch in batched(changes()):
+        conn.executemany(
+            "INSERT INTO RegulatoryChanges (id, added_at, added_by_user_id, effective_date, type, category_id, content) "
+            "VALUES (?, ?, 1, ?, ?, ?, ?)",
+            batch,
+        )
+    counts["changes"] = args.changes
+
+    def dispatches():
+        # Most customers got their last newsletter within the last
+        # --sent-days, so only changes added since then are pending for them;
+        # the rest never got one and are sent the whole history
+        recent = args.sent_days * 86400
+        for customer_id in range(1, args.customers + 1):
+            if rng.random() < args.sent:
+                sent_at = stamp(end - timedelta(seconds=rng.randrange(recent)))
+                yield customer_id, sent_at
+
+    counts["dispatches"] = 0
+    for batch in batched(dispatches()):
+        conn.executemany(
+            "INSERT INTO NewsletterDispatch (customer_id, sent_at, change_ids, status) VALUES (?, ?, '', 'sent')",
+            batch,
+        )
+        counts["dispatches"] += len(batch)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic newsletter database")
+    parser.add_argument("--db", default="data/bench.db", help="database file to create")
+    parser.add_argument("--force", action="store_true", help="replace the database if it exists")
+    parser.add_argument("--seed", type=int, default=50001)
+    parser.add_argument("--customers", type=int, default=1000)
+    parser.add_argument("--categories", type=int, default=100)
+    parser.add_argument("--changes", type=int, default=5000)
+    parser.add_argument("--emails", type=float, default=1.5, help="average addresses per customer")
+    parser.add_argument("--mappings", type=float, default=8, help="average categories per customer")
+    parser.add_argument("--inactive", type=float, default=0.05, help="share of inactive customers")
+    parser.add_argument("--sent", type=float, default=0.95, help="share of customers with a past dispatch")
+    parser.add_argument("--sent-days", type=int, default=90, help="past dispatches lie within this many days")
+    parser.add_argument("--days", type=int, default=730, help="history covered by added_at")
+    parser.add_argument("--end-date", help="YYYY-MM-DD the history ends at (default: now)")
+    args = parser.parse_args()
+
+    if os.path.exists(args.db):
+        if not args.force:
+            print(f"{args.db} exists, use --force to replace it", file=sys.stderr)
+            return 1
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+
+    started = time.perf_counter()
+    init_db(args.db)
+    conn = sqlite3.connect(args.db)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = OFF")
+    with conn:
+        counts = generate(conn, args)
+    conn.execute("ANALYZE")
+    conn.close()
+    print(", ".join(f"{count} {table}" for table, count in counts.items())
+          + f" written to {args.db} in {time.perf_counter() - started:.1f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+# conftest.py - shared fixtures: a fresh database, a local SMTP sink and Settings pointing at both
+import functools
+import os
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from bench.smtp_sink import SMTPSink
+from core.db import close_connection
+from core.settings import Settings
+from data.db_init import init_db
+
+CONFIG = """
+[APP]
+db_path = {db_path}
+template_path = {root}/templates/newsletter_template.html
+template_cache_dir =
+log_file = {tmp}/app.log
+
+[SMTP]
+host = 127.0.0.1
+port = {port}
+username =
+password =
+use_tls = no
+pool_size = 2
+
+[NEWSLETTER]
+from_email = newsletter@example.com
+subject_template = Updates {{{{quarter}}}} for {{{{customer_name}}}}
+
+[DISPATCH]
+max_recipients = 1
+lease_timeout = {lease_timeout}
+
+[METRICS]
+enabled = no
+
+[AUDIT]
+enabled = no
+"""
+
+
+def seed_data(db_path, customers=3, emails=1, changes=2):
+    # Customers 1..n, each with `emails` addresses and mapped to category 1,
+    # which has `changes` regulatory changes; nothing sent yet
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute("INSERT INTO Categories (id, scope, description) VALUES (1, 'ISO 50001', 'Energie')")
+        for customer_id in range(1, customers + 1):
+            conn.execute("INSERT INTO Customers (id, name) VALUES (?, ?)", (customer_id, f"Kunde {customer_id}"))
+            conn.execute("INSERT INTO CustomerCategoryMapping (customer_id, category_id) VALUES (?, 1)",
+                         (customer_id,))
+            for n in range(emails):
+                conn.execute("INSERT INTO CustomerEmails (customer_id, email) VALUES (?, ?)",
+                             (customer_id, f"kunde{customer_id}-{n}@example.com"))
+        for n in range(changes):
+            conn.execute(
+                "INSERT INTO RegulatoryChanges (added_at, added_by_user_id, effective_date, type, category_id, content) "
+                "VALUES ('2025-01-01 00:00:00', 1, '2025-07-01', 'change', 1, ?)",
+                (f"Änderung {n}",),
+            )
+    conn.close()
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "test.db")
+    init_db(path)
+    yield path
+    close_connection(path)
+
+
+@pytest.fixture
+def seed(db_path):
+    return functools.partial(seed_data, db_path)
+
+
+@pytest.fixture
+def sink():
+    server = SMTPSink().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def make_settings(tmp_path, db_path, sink):
+    def make(lease_timeout=120):
+        path = tmp_path / "config.ini"
+        path.write_text(CONFIG.format(db_path=db_path, root=ROOT, tmp=tmp_path, port=sink.port,
+                                      lease_timeout=lease_timeout), encoding="utf-8")
+        return Settings(str(path))
+    return make
@@ -0,0 +1,18 @@
+# test_archive.py - files written by atomic_write
+import os
+import stat
+
+import pytest
+
+from core.archive import atomic_write
+
+
+@pytest.mark.skipif(not hasattr(os, "fchmod"), reason="POSIX permissions")
+@pytest.mark.parametrize("umask", [0o022, 0o077, 0o002])
+def test_atomic_write_follows_umask(tmp_path, monkeypatch, umask):
+    monkeypatch.setattr("core.archive.FILE_MODE", 0o666 & ~umask)
+    path = tmp_path / "12.html"
+    atomic_write(str(path), b"<html></html>")
+    assert path.read_bytes() == b"<html></html>"
+    assert stat.S_IMODE(path.stat().st_mode) == 0o666 & ~umask
+    assert os.listdir(tmp_path) == ["12.html"]
@@ -0,0 +1,72 @@
+# test_bounces.py - process_mailbox on the mbox and Maildir fixtures
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+from core.bounces import process_mailbox
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "bounces")
+
+
+def email_states(db_path):
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute("SELECT email, suppressed_at IS NOT NULL, soft_bounces FROM CustomerEmails ORDER BY email")
+    states = {email: (bool(suppressed), soft_bounces) for email, suppressed, soft_bounces in rows}
+    conn.close()
+    return states
+
+
+@pytest.fixture
+def maildir(tmp_path):
+    path = tmp_path / "maildir"
+    shutil.copytree(os.path.join(FIXTURES, "maildir"), path)
+    (path / "tmp").mkdir()
+    return path
+
+
+@pytest.mark.parametrize("mailbox", ["bounces.mbox", "maildir"])
+def test_hard_soft_and_unknown(db_path, seed, tmp_path, mailbox):
+    seed(customers=3)
+    path = tmp_path / mailbox
+    if mailbox == "maildir":
+        shutil.copytree(os.path.join(FIXTURES, mailbox), path)
+    else:
+        shutil.copy(os.path.join(FIXTURES, mailbox), path)
+    summary = process_mailbox(db_path, str(path))
+    assert {key: summary[key] for key in ("messages", "bounces", "hard", "soft", "suppressed", "unknown")} == {
+        "messages": 4, "bounces": 3, "hard": 2, "soft": 1, "suppressed": 1, "unknown": 1,
+    }
+    assert email_states(db_path) == {
+        "kunde1-0@example.com": (True, 0),
+        "kunde2-0@example.com": (False, 1),
+        "kunde3-0@example.com": (False, 0),
+    }
+    # Nothing new on the next run
+    assert process_mailbox(db_path, str(path))["messages"] == 0
+
+
+def test_maildir_message_with_older_mtime_is_read(db_path, seed, maildir):
+    seed(customers=3)
+    assert process_mailbox(db_path, str(maildir))["messages"] == 4
+    # Delivered after the first run, but with a time from before it
+    late = maildir / "new" / "1751875000.M5P100.mx"
+    shutil.copy(os.path.join(FIXTURES, "late.eml"), late)
+    os.utime(late, (1_000_000_000, 1_000_000_000))
+    summary = process_mailbox(db_path, str(maildir))
+    assert (summary["messages"], summary["hard"], summary["suppressed"]) == (1, 1, 1)
+    assert email_states(db_path)["kunde3-0@example.com"] == (True, 0)
+
+
+def test_maildir_message_moved_to_cur_is_not_read_again(db_path, seed, maildir):
+    seed(customers=3)
+    process_mailbox(db_path, str(maildir))
+    # A mail client marks it read: new/ -> cur/ with flags
+    os.rename(maildir / "new" / "1751875200.M1P100.mx", maildir / "cur" / "1751875200.M1P100.mx:2,S")
+    os.remove(maildir / "new" / "1751875320.M3P100.mx")
+    assert process_mailbox(db_path, str(maildir))["messages"] == 0
+    conn = sqlite3.connect(db_path)
+    names = {name for name, in conn.execute("SELECT name FROM BounceMaildirFiles")}
+    conn.close()
+    assert names == {"1751875200.M1P100.mx", "1751875260.M2P100.mx", "1751875500.M4P100.mx"}
@@ -0,0 +1,50 @@
+# test_bulk_io.py - export/import round trip, the import's own connection
+import sqlite3
+
+from core.bulk_io import export_customers, import_customers
+from core.db import get_connection
+
+
+def suppressed(db_path):
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute("SELECT email FROM CustomerEmails WHERE suppressed_at IS NOT NULL ORDER BY email").fetchall()
+    conn.close()
+    return [row[0] for row in rows]
+
+
+def test_export_and_replace_import_keep_suppression(db_path, seed, tmp_path):
+    seed(customers=2, emails=2)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute("UPDATE CustomerEmails SET suppressed_at = '2025-01-01 00:00:00', bounce_reason = '550' "
+                     "WHERE email = 'kunde1-1@example.com'")
+    conn.close()
+    path = str(tmp_path / "customers.csv")
+    assert export_customers(db_path, path) == 2
+    summary = import_customers(db_path, path, replace=True)
+    assert (summary["emails_added"], summary["emails_removed"], summary["emails_suppressed"]) == (0, 0, 0)
+    assert suppressed(db_path) == ["kunde1-1@example.com"]
+
+
+def test_import_suppresses_listed_addresses(db_path, seed, tmp_path):
+    seed(customers=2)
+    path = tmp_path / "customers.csv"
+    path.write_text("id;emails;suppressed\n"
+                    "1;;kunde1-0@example.com\n"
+                    "2;neu@example.com;alt@example.com\n", encoding="utf-8")
+    summary = import_customers(db_path, str(path))
+    assert summary["invalid"] == 0
+    assert (summary["emails_added"], summary["emails_suppressed"]) == (2, 1)
+    assert suppressed(db_path) == ["alt@example.com", "kunde1-0@example.com"]
+
+
+def test_import_leaves_shared_connection_alone(db_path, seed, tmp_path):
+    seed(customers=1)
+    conn = get_connection(db_path)
+    conn.execute("CREATE TEMP TABLE pending_since (customer_id INTEGER PRIMARY KEY, since TEXT)")
+    conn.execute("INSERT INTO temp.pending_since VALUES (1, '2025-01-01')")
+    path = tmp_path / "customers.csv"
+    path.write_text("name;emails\nNeukunde AG;kontakt@neukunde.example\n", encoding="utf-8")
+    assert import_customers(db_path, str(path))["customers_added"] == 1
+    assert conn.execute("SELECT COUNT(*) FROM temp.pending_since").fetchone()[0] == 1
+    assert conn.execute("PRAGMA temp_store").fetchone()[0] == 2
@@ -0,0 +1,28 @@
+# test_dispatch.py - a queued run renders and sends every claimed row
+import sqlite3
+
+from core.db import get_connection
+from core.dispatch import run_dispatch
+
+
+def test_change_without_category_is_still_sent(db_path, seed, sink, make_settings):
+    seed(customers=3, changes=2)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        # Foreign keys are off on a plain connection, as in older databases
+        conn.execute("DELETE FROM Categories WHERE id = 1")
+    conn.close()
+
+    bodies = []
+    summary = run_dispatch(
+        make_settings(), quarter="Q1 2025",
+        on_result=lambda job, error: bodies.append(job.message.get_payload(decode=True).decode()),
+    )
+
+    assert (summary["sent"], summary["failed"]) == (3, 0)
+    assert sink.counts()["messages"] == 3
+    assert all("Änderung 0" in body and "Änderung 1" in body for body in bodies)
+    change_ids = get_connection(db_path).execute(
+        "SELECT DISTINCT change_ids FROM NewsletterDispatch WHERE status = 'sent'"
+    ).fetchall()
+    assert change_ids == [("1,2",)]
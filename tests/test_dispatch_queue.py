@@ -0,0 +1,68 @@
+# test_dispatch_queue.py - the run lease: a slow run keeps it, a second dispatcher never sends the same rows
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from core.db import get_connection
+from core.dispatch import run_dispatch
+from core.dispatch_queue import DispatchQueue, RunInProgress
+
+
+def sent_rows(db_path):
+    return get_connection(db_path).execute(
+        "SELECT email, COUNT(*) FROM NewsletterDispatch WHERE status = 'sent' GROUP BY email"
+    ).fetchall()
+
+
+def test_slow_batch_keeps_its_lease(db_path, seed, sink, make_settings, monkeypatch):
+    seed(customers=24)
+    settings = make_settings(lease_timeout=2)
+    # One batch of 24 messages at 0.25 s each outlasts the 2 s lease, and
+    # the claiming generator waits on the full job queue most of that time
+    sink.delay = 0.25
+    first = threading.Thread(target=run_dispatch, args=(settings,), kwargs={"quarter": "Q1 2025", "workers": 1})
+    first.start()
+    time.sleep(3)
+
+    # A dispatcher on another host only has the heartbeat to go by
+    monkeypatch.setattr(socket, "gethostname", lambda: "other-host")
+    second = DispatchQueue(db_path, lease_timeout=2)
+    with pytest.raises(RunInProgress):
+        second.open_run("Q1 2025")
+    first.join()
+
+    assert sink.counts()["messages"] == 24
+    assert sorted(sent_rows(db_path)) == sorted((f"kunde{n}-0@example.com", 1) for n in range(1, 25))
+
+
+def test_live_owner_on_this_host_keeps_expired_run(db_path, seed):
+    seed()
+    first = DispatchQueue(db_path, lease_timeout=2)
+    run_id, _, _ = first.open_run("Q1 2025")
+    get_connection(db_path).execute(
+        "UPDATE DispatchRuns SET heartbeat_at = datetime('now', '-1 hour') WHERE id = ?", (run_id,)
+    )
+    second = DispatchQueue(db_path, lease_timeout=2)
+    second.owner = f"{socket.gethostname()}:0"
+    with pytest.raises(RunInProgress):
+        second.open_run("Q1 2025")
+
+
+def test_dead_owner_on_this_host_is_taken_over(db_path, seed):
+    seed()
+    first = DispatchQueue(db_path)
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    first.owner = f"{socket.gethostname()}:{process.pid}"
+    run_id, _, _ = first.open_run("Q1 2025")
+    first.claim(run_id)
+
+    second = DispatchQueue(db_path)
+    assert second.open_run("Q1 2025") == (run_id, "Q1 2025", True)
+    assert get_connection(db_path).execute(
+        "SELECT COUNT(*) FROM NewsletterDispatch WHERE run_id = ? AND claimed_at IS NOT NULL", (run_id,)
+    ).fetchone() == (0,)
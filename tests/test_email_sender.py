@@ -0,0 +1,125 @@
+# test_email_sender.py - DispatchEngine.send against the SMTP sink: sessions, throttling, recipient limits
+import time
+
+import pytest
+
+from core.email_sender import (
+    AdaptiveRateLimiter, DispatchEngine, MessageGroup, OutgoingMessage, SMTPConnectionPool, build_message,
+)
+
+
+def outgoing(count, start=0):
+    messages = []
+    for n in range(start, start + count):
+        to_email = f"kunde{n}@example.com"
+        message = build_message(f"<p>Newsletter {n}</p>", "Updates", "newsletter@example.com", to_email)
+        messages.append(OutgoingMessage("newsletter@example.com", to_email, message, customer_id=n))
+    return messages
+
+
+@pytest.fixture
+def pool(sink):
+    pool = SMTPConnectionPool("127.0.0.1", sink.port, size=2, timeout=5)
+    yield pool
+    pool.close()
+
+
+def engine(pool, **kwargs):
+    # Backoff down to 6000/min and short retry sleeps keep throttle tests fast
+    kwargs.setdefault("limiter", AdaptiveRateLimiter(min_rate=6000, burst=100, cooldown=0))
+    kwargs.setdefault("workers", 2)
+    return DispatchEngine(pool, throttle_delay=0.01, **kwargs)
+
+
+def failures(results):
+    return [(job.to_email, error) for job, error in results if error is not None]
+
+
+def test_sessions_are_reused(sink, pool):
+    results = engine(pool).send(outgoing(40))
+    assert len(results) == 40 and not failures(results)
+    counts = sink.counts()
+    assert counts["messages"] == 40
+    # At most one session per worker for the whole run
+    assert counts["connections"] <= 2
+
+
+def test_messages_per_connection_recycles_sessions(sink, pool):
+    results = engine(pool, workers=1, messages_per_connection=5).send(outgoing(20))
+    assert not failures(results)
+    assert sink.counts()["connections"] == 4
+
+
+def test_throttled_messages_are_retried(sink, pool):
+    sink.throttle_every = 4
+    sending = engine(pool)
+    results = sending.send(outgoing(30))
+    assert len(results) == 30 and not failures(results)
+    counts = sink.counts()
+    assert counts["throttled"] > 0
+    assert counts["messages"] == 30
+    # The first 451 started pacing
+    assert sending.limiter.rate is not None
+
+
+def test_421_reconnects_and_retries(sink, pool):
+    sink.throttle_every = 5
+    sink.throttle_reply = "421 4.7.0 Too many messages, closing connection"
+    results = engine(pool).send(outgoing(20))
+    assert not failures(results)
+    counts = sink.counts()
+    assert counts["messages"] == 20
+    assert counts["connections"] > 2
+
+
+def test_throttle_retries_run_out(sink, pool):
+    sink.throttle_every = 1
+    results = engine(pool, workers=1, throttle_retries=2).send(outgoing(1))
+    assert [getattr(error, "smtp_code", None) for _, error in results] == [451]
+    assert sink.counts()["throttled"] == 3
+
+
+def test_recipient_limit_splits_the_transaction(sink, pool):
+    sink.max_recipients = 2
+    group = MessageGroup(outgoing(5))
+    results = engine(pool).send([group])
+    assert sorted(job.to_email for job, _ in results) == sorted(group.recipients)
+    assert not failures(results)
+    counts = sink.counts()
+    # 2 + 2 + 1 recipients, one DATA each
+    assert (counts["messages"], counts["recipients"]) == (3, 5)
+
+
+def test_limiter_backs_off_and_recovers():
+    limiter = AdaptiveRateLimiter(rate=600, min_rate=60, increase=10, decrease=0.5, cooldown=10)
+    started = time.monotonic()
+    limiter.throttled(started)
+    assert limiter.rate == 300
+    # Within the cooldown, and for messages sent before the last decrease
+    limiter.throttled(time.monotonic())
+    limiter.throttled(started)
+    assert limiter.rate == 300
+    limiter.success()
+    assert limiter.rate == 310
+    limiter.last_decrease -= 10
+    limiter.throttled(time.monotonic())
+    assert limiter.rate == 155
+    for _ in range(100):
+        limiter.success()
+    # Never above the configured limit
+    assert limiter.rate == 600
+
+
+def test_limiter_without_rate_starts_pacing_at_the_observed_rate():
+    limiter = AdaptiveRateLimiter(min_rate=6)
+    assert limiter.rate is None
+    limiter.throttled(time.monotonic(), observed_rate=1200)
+    assert limiter.rate == 600
+    limiter.last_decrease -= 10
+    for _ in range(3):
+        limiter.throttled(time.monotonic())
+        limiter.last_decrease -= 10
+    assert limiter.rate == 75
+    limiter.success()
+    # No upper limit
+    assert limiter.rate == 76
@@ -0,0 +1,48 @@
+# test_tracking.py - hit buffer under concurrent hits, redirect headers
+import sqlite3
+import threading
+from urllib.parse import quote
+
+from core.tracking import HitBuffer, LinkTracker, TrackingServer
+
+
+def test_hits_during_flush_are_not_lost(db_path, seed):
+    seed(customers=1)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany("INSERT INTO NewsletterDispatch (id, customer_id, status) VALUES (?, 1, 'sent')",
+                         [(n,) for n in range(1, 5001)])
+    buffer = HitBuffer(db_path, batch_size=50)
+    done = threading.Event()
+
+    def writer():
+        # What the flusher does on its executor thread, as often as it can
+        while not done.is_set():
+            buffer.flush()
+        buffer.flush()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    for dispatch_id in range(1, 5001):
+        buffer.open(dispatch_id)
+        if dispatch_id % 2:
+            buffer.click(dispatch_id)
+    done.set()
+    thread.join()
+    opened, clicked = conn.execute(
+        "SELECT COUNT(opened_at), COUNT(clicked_at) FROM NewsletterDispatch").fetchone()
+    conn.close()
+    assert (opened, clicked) == (5000, 2500)
+
+
+def test_redirect_to_non_latin1_url():
+    tracker = LinkTracker("http://localhost:8025", b"secret")
+    server = TrackingServer(tracker, HitBuffer(":memory:"))
+    url = "https://example.com/Änderungen/übersicht?q=€&x=a%20b#teil"
+    target = f"/c/{tracker.token(7)}?u={quote(url, safe='')}&s={tracker.link_signature(url)}"
+    status, headers, body = server.route(target)
+    assert status == 302
+    location = dict(headers)["Location"]
+    assert location == "https://example.com/%C3%84nderungen/%C3%BCbersicht?q=%E2%82%AC&x=a%20b#teil"
+    response = server.response(status, headers, body, True)
+    assert f"Location: {location}\r\n".encode("latin-1") in response
@@ -1,21 +1,76 @@
+from PySide6.QtCore import QTimer
 from PySide6.QtWidgets import (
-    QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton, QTableWidget,
-    QTableWidgetItem, QComboBox, QCheckBox, QHBoxLayout, QMessageBox
+    QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton, QTableWidget, QTableView,
+    QTableWidgetItem, QComboBox, QCheckBox, QHBoxLayout, QMessageBox, QHeaderView
 )
-import sqlite3
+import bisect
+from core.db import get_connection
+from core.events import INSERT, RELOAD, by_table
+from core.models import MappingChangeBuffer, CATEGORIES_SQL
+from core.search import customer_index, category_index, changed_customer_entries, refresh_customers, DEBOUNCE_MS
+from ui.changes import ChangeForwarder
+from ui.matrix_view import MatrixModel, CheckBoxDelegate
+from ui.tasks import TaskRunner
+
+# Toggles are written to the database this long after the last click
+FLUSH_DELAY_MS = 500
+
+CUSTOMERS_SQL = "SELECT id, name FROM Customers WHERE active = 1 ORDER BY name"
+
+
+def fetch_selection_items(db_path, mode):
+    return get_connection(db_path).execute(CUSTOMERS_SQL if mode == "Customer View" else CATEGORIES_SQL).fetchall()
+
+
+def fetch_checklist(db_path, mode, selected_id):
+    conn = get_connection(db_path)
+    if mode == "Customer View":
+        items = conn.execute(CATEGORIES_SQL).fetchall()
+        cur = conn.execute("SELECT category_id FROM CustomerCategoryMapping WHERE customer_id = ?", (selected_id,))
+    else:
+        items = conn.execute(CUSTOMERS_SQL).fetchall()
+        cur = conn.execute("SELECT customer_id FROM CustomerCategoryMapping WHERE category_id = ?", (selected_id,))
+    return items, {row[0] for row in cur}
+
+
+def after_flush(changes, fn, *args):
+    # Clicks not written yet are part of what fn reads
+    changes.flush()
+    return fn(*args)
+
+
+def read_customer_entries(db_path, customer_ids):
+    return changed_customer_entries(get_connection(db_path), customer_ids, active_only=True)
+
+
+def build_search_index(db_path, kind):
+    conn = get_connection(db_path)
+    return category_index(conn) if kind == "categories" else customer_index(conn, active_only=True)
+
 
 class CategoryMatrixTab(QWidget):
-    def __init__(self, db_path):
+    def __init__(self, db_path, tasks=None):
         super().__init__()
         self.db_path = db_path
+        self.tasks = tasks or TaskRunner(self)
+        self.generation = 0
         self.all_items = []
+        self.filtered_items = []
+        self.item_labels = {}
         self.mapped_ids = set()
+        self.indexes = {}
+
+        self.changes = MappingChangeBuffer(db_path)
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(FLUSH_DELAY_MS)
+        self.flush_timer.timeout.connect(self.flush_pending)
 
         self.layout = QVBoxLayout()
         self.setLayout(self.layout)
 
         self.mode_selector = QComboBox()
-        self.mode_selector.addItems(["Customer View", "Category View"])
+        self.mode_selector.addItems(["Customer View", "Category View", "Matrix View"])
         self.mode_selector.currentIndexChanged.connect(self.refresh_ui)
         self.layout.addWidget(QLabel("Select Mode:"))
         self.layout.addWidget(self.mode_selector)
@@ -26,33 +81,103 @@ class CategoryMatrixTab(QWidget):
 
         self.search_input = QLineEdit()
         self.search_input.setPlaceholderText("Search...")
-        self.search_input.textChanged.connect(self.filter_checklist)
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(DEBOUNCE_MS)
+        self.search_timer.timeout.connect(self.filter_checklist)
+        self.search_input.textChanged.connect(lambda _: self.search_timer.start())
         self.layout.addWidget(self.search_input)
 
+        self.select_all_btn = QPushButton("Select All (filtered)")
+        self.select_all_btn.clicked.connect(lambda: self.set_filtered(True))
+        self.select_none_btn = QPushButton("Select None (filtered)")
+        self.select_none_btn.clicked.connect(lambda: self.set_filtered(False))
+        self.undo_btn = QPushButton("Undo")
+        self.undo_btn.setEnabled(False)
+        self.undo_btn.clicked.connect(self.undo)
+        button_layout = QHBoxLayout()
+        button_layout.addWidget(self.select_all_btn)
+        button_layout.addWidget(self.select_none_btn)
+        button_layout.addStretch()
+        button_layout.addWidget(self.undo_btn)
+        self.layout.addLayout(button_layout)
+
         self.check_table = QTableWidget()
         self.layout.addWidget(self.check_table)
 
+        self.matrix_model = MatrixModel(db_path)
+        self.matrix_model.toggled.connect(self.save_mapping)
+        self.matrix_view = QTableView()
+        self.matrix_view.setModel(self.matrix_model)
+        self.matrix_view.setItemDelegate(CheckBoxDelegate(self.matrix_view))
+        self.matrix_view.setSelectionMode(QTableView.NoSelection)
+        for header, size in ((self.matrix_view.horizontalHeader(), 120), (self.matrix_view.verticalHeader(), 24)):
+            header.setSectionResizeMode(QHeaderView.Fixed)
+            header.setDefaultSectionSize(size)
+        self.matrix_view.hide()
+        self.layout.addWidget(self.matrix_view)
+
+        self.change_events = ChangeForwarder(
+            "Customers", "CustomerEmails", "CustomerCategoryMapping", "Categories", parent=self
+        )
+        self.change_events.changed.connect(self.apply_changes)
+
         self.refresh_ui()
 
     def get_db_connection(self):
-        return sqlite3.connect(self.db_path)
+        return get_connection(self.db_path)
+
+    def submit_load(self, name, fn, on_done, *args):
+        # Only the most recently requested load is applied
+        self.generation += 1
+        generation = self.generation
+
+        def apply(result):
+            if generation == self.generation:
+                on_done(result)
+
+        self.tasks.submit(name, after_flush, self.changes, fn, *args, on_done=apply)
+
+    def search_index(self, kind):
+        # Built in the background on first use, kept until the next
+        # refresh_ui(); filter_checklist() runs again once it is ready
+        index = self.indexes.get(kind)
+        if kind not in self.indexes:
+            self.indexes[kind] = None
+
+            def ready(index, indexes=self.indexes):
+                indexes[kind] = index
+                if indexes is self.indexes:
+                    self.filter_checklist()
+
+            self.tasks.submit("Building search index", build_search_index, self.db_path, kind, on_done=ready)
+        return index
 
     def refresh_ui(self):
+        self.flush_pending()
+        self.indexes = {}
         mode = self.mode_selector.currentText()
-        conn = self.get_db_connection()
-        cur = conn.cursor()
-
-        if mode == "Customer View":
-            cur.execute("SELECT id, name FROM Customers WHERE active = 1 ORDER BY name")
+        matrix_mode = mode == "Matrix View"
+        self.select_all_btn.setVisible(not matrix_mode)
+        self.select_none_btn.setVisible(not matrix_mode)
+        self.selection_box.setVisible(not matrix_mode)
+        self.check_table.setVisible(not matrix_mode)
+        self.matrix_view.setVisible(matrix_mode)
+        if matrix_mode:
+            self.submit_load("Loading category matrix", MatrixModel.fetch, self.show_matrix, self.db_path)
         else:
-            cur.execute("SELECT id, scope || ' – ' || description FROM Categories ORDER BY scope, description")
+            self.submit_load("Loading selection", fetch_selection_items, self.show_selection_items, self.db_path, mode)
+
+    def show_matrix(self, data):
+        self.matrix_model.apply(data)
+        self.filter_checklist()
 
-        items = cur.fetchall()
+    def show_selection_items(self, items):
+        self.selection_box.blockSignals(True)
         self.selection_box.clear()
         for item in items:
             self.selection_box.addItem(item[1], item[0])
-
-        conn.close()
+        self.selection_box.blockSignals(False)
         self.render_checklist()
 
     def render_checklist(self):
@@ -61,61 +186,179 @@ class CategoryMatrixTab(QWidget):
         if selected_id is None:
             return
 
-        conn = self.get_db_connection()
-        cur = conn.cursor()
-
-        if mode == "Customer View":
-            cur.execute("SELECT id, scope || ' – ' || description FROM Categories ORDER BY scope, description")
-            self.all_items = cur.fetchall()
-            cur.execute("SELECT category_id FROM CustomerCategoryMapping WHERE customer_id = ?", (selected_id,))
-            self.mapped_ids = {row[0] for row in cur.fetchall()}
-        else:
-            cur.execute("SELECT id, name FROM Customers WHERE active = 1 ORDER BY name")
-            self.all_items = cur.fetchall()
-            cur.execute("SELECT customer_id FROM CustomerCategoryMapping WHERE category_id = ?", (selected_id,))
-            self.mapped_ids = {row[0] for row in cur.fetchall()}
+        self.flush_pending()
+        self.submit_load("Loading mappings", fetch_checklist, self.show_checklist, self.db_path, mode, selected_id)
 
-        conn.close()
+    def show_checklist(self, result):
+        self.all_items, self.mapped_ids = result
+        self.item_labels = dict(self.all_items)
         self.filter_checklist()
 
     def filter_checklist(self):
-        search_text = self.search_input.text().lower()
+        self.search_timer.stop()
+        search_text = self.search_input.text()
         mode = self.mode_selector.currentText()
         selected_id = self.selection_box.currentData()
 
-        filtered_items = [item for item in self.all_items if search_text in item[1].lower()]
+        if mode == "Matrix View":
+            rows = None
+            index = self.search_index("customers") if search_text.strip() else None
+            if index is not None:
+                row_of = self.matrix_model.customer_rows
+                rows = [row_of[i] for i in index.search(search_text) if i in row_of]
+            self.matrix_model.set_visible_rows(rows)
+            return
+
+        index = None
+        if search_text.strip():
+            index = self.search_index("categories" if mode == "Customer View" else "customers")
+        if index is not None:
+            items_by_id = self.item_labels
+            filtered_items = [
+                (item_id, items_by_id[item_id])
+                for item_id in index.search(search_text)
+                if item_id in items_by_id
+            ]
+        else:
+            filtered_items = self.all_items
+        self.filtered_items = filtered_items
 
         self.check_table.setRowCount(len(filtered_items))
         self.check_table.setColumnCount(2)
         self.check_table.setHorizontalHeaderLabels(["Name", "Mapped"])
 
         for i, (item_id, label) in enumerate(filtered_items):
-            self.check_table.setItem(i, 0, QTableWidgetItem(label))
-            checkbox = QCheckBox()
-            checkbox.setChecked(item_id in self.mapped_ids)
-            checkbox.stateChanged.connect(self.get_checkbox_handler(mode, selected_id, item_id))
-            self.check_table.setCellWidget(i, 1, checkbox)
+            self.set_check_row(i, mode, selected_id, item_id, label)
+
+    def set_check_row(self, i, mode, selected_id, item_id, label):
+        self.check_table.setItem(i, 0, QTableWidgetItem(label))
+        checkbox = QCheckBox()
+        checkbox.setChecked(item_id in self.mapped_ids)
+        checkbox.stateChanged.connect(self.get_checkbox_handler(mode, selected_id, item_id))
+        self.check_table.setCellWidget(i, 1, checkbox)
+
+    def mapping_key(self, mode, selected_id, target_id):
+        if mode == "Customer View":
+            return selected_id, target_id
+        return target_id, selected_id
 
     def get_checkbox_handler(self, mode, selected_id, target_id):
         def handler(state):
-            conn = self.get_db_connection()
-            cur = conn.cursor()
-            if mode == "Customer View":
-                customer_id, category_id = selected_id, target_id
+            checked = state == 2
+            if checked:
+                self.mapped_ids.add(target_id)
             else:
-                customer_id, category_id = target_id, selected_id
+                self.mapped_ids.discard(target_id)
+            self.save_mapping(*self.mapping_key(mode, selected_id, target_id), checked)
+        return handler
+
+    def set_filtered(self, checked):
+        mode = self.mode_selector.currentText()
+        selected_id = self.selection_box.currentData()
+        if mode == "Matrix View" or selected_id is None:
+            return
+        for item_id, _ in self.filtered_items:
+            if (item_id in self.mapped_ids) != checked:
+                self.changes.set(*self.mapping_key(mode, selected_id, item_id), checked)
+                if checked:
+                    self.mapped_ids.add(item_id)
+                else:
+                    self.mapped_ids.discard(item_id)
+        self.flush_pending()
+        self.filter_checklist()
+
+    def save_mapping(self, customer_id, category_id, checked):
+        self.changes.set(customer_id, category_id, checked)
+        self.flush_timer.start()
+
+    def flush_pending(self):
+        # Written on a worker; a failed batch stays buffered for the next flush
+        self.flush_timer.stop()
+        if len(self.changes):
+            self.tasks.submit("Saving mappings", self.changes.flush, on_done=self.mappings_written)
 
-            if state == 2:
-                cur.execute(
-                    "INSERT OR IGNORE INTO CustomerCategoryMapping (customer_id, category_id) VALUES (?, ?)",
-                    (customer_id, category_id)
-                )
+    def undo(self):
+        # The reverted mappings come back through apply_changes()
+        self.undo_btn.setEnabled(False)
+        self.tasks.submit("Undoing mapping changes", self.changes.undo, on_done=self.mappings_written,
+                          on_error=self.mappings_written)
+
+    def mappings_written(self, _):
+        self.undo_btn.setEnabled(bool(self.changes.undo_stack))
+
+    def apply_changes(self, changes):
+        # Mapping changes and new customers are applied to what is shown;
+        # renames, deactivations, deletions, category edits and bulk
+        # imports load the view again
+        tables = by_table(changes)
+        if "Categories" in tables or any(
+                change.action == RELOAD or (change.table == "Customers" and change.action != INSERT)
+                for change in changes):
+            if set(tables) == {"CustomerEmails"}:
+                # Addresses are only in the search index
+                self.indexes.pop("customers", None)
             else:
-                cur.execute(
-                    "DELETE FROM CustomerCategoryMapping WHERE customer_id = ? AND category_id = ?",
-                    (customer_id, category_id)
-                )
-            conn.commit()
-            conn.close()
-        return handler
+                self.refresh_ui()
+            return
+        mode = self.mode_selector.currentText()
+        for change in tables.get("Customers", ()):
+            if change.values["active"]:
+                self.add_customer(mode, change.row_id, change.values["name"])
+        for change in tables.get("CustomerCategoryMapping", ()):
+            self.apply_mapping(mode, change.values["customer_id"], change.values["category_id"],
+                               change.action == INSERT)
+        index = self.indexes.get("customers")
+        if index is not None and ("Customers" in tables or "CustomerEmails" in tables):
+            customer_ids = {change.row_id for change in tables.get("Customers", ())}
+            customer_ids.update(change.values["customer_id"] for change in tables.get("CustomerEmails", ()))
+            self.tasks.submit(
+                "Updating search index", read_customer_entries, self.db_path, customer_ids,
+                on_done=lambda result: self.refresh_search_index(index, *result),
+            )
+
+    def refresh_search_index(self, index, customer_ids, entries):
+        # Only if the index is still the one in use
+        if self.indexes.get("customers") is index:
+            refresh_customers(index, customer_ids, entries)
 
+    def add_customer(self, mode, customer_id, name):
+        if mode == "Matrix View":
+            self.matrix_model.add_customer(customer_id, name)
+            return
+        if mode == "Customer View":
+            names = [self.selection_box.itemText(i) for i in range(self.selection_box.count())]
+            self.selection_box.blockSignals(True)
+            self.selection_box.insertItem(bisect.bisect_right(names, name), name, customer_id)
+            self.selection_box.blockSignals(False)
+            return
+        # Category View lists customers to check; without a search the new
+        # one gets its row, with a search it shows up on the next keystroke
+        position = bisect.bisect_right([label for _, label in self.all_items], name)
+        self.all_items.insert(position, (customer_id, name))
+        self.item_labels[customer_id] = name
+        if self.search_input.text().strip():
+            return
+        # Unfiltered, filtered_items is all_items itself
+        self.check_table.insertRow(position)
+        self.set_check_row(position, mode, self.selection_box.currentData(), customer_id, name)
+
+    def apply_mapping(self, mode, customer_id, category_id, checked):
+        if mode == "Matrix View":
+            self.matrix_model.set_checked(customer_id, category_id, checked)
+            return
+        selected_id = self.selection_box.currentData()
+        selected, target_id = (customer_id, category_id) if mode == "Customer View" else (category_id, customer_id)
+        if selected != selected_id or (target_id in self.mapped_ids) == checked:
+            # Another selection, or a click made here
+            return
+        if checked:
+            self.mapped_ids.add(target_id)
+        else:
+            self.mapped_ids.discard(target_id)
+        for i, (item_id, _) in enumerate(self.filtered_items):
+            if item_id == target_id:
+                checkbox = self.check_table.cellWidget(i, 1)
+                checkbox.blockSignals(True)
+                checkbox.setChecked(checked)
+                checkbox.blockSignals(False)
+                break
@@ -0,0 +1,270 @@
+# ChangeBrowser - all RegulatoryChanges, paged by keyset as the view scrolls, sorted and filtered in SQL
+from PySide6.QtCore import Qt, QAbstractTableModel, QModelIndex, QTimer, QDate
+from PySide6.QtWidgets import (
+    QWidget, QVBoxLayout, QHBoxLayout, QLineEdit, QComboBox, QDateEdit, QTableView, QHeaderView
+)
+from core.db import get_connection
+from core.events import DELETE
+from core.models import change_page, CHANGE_TYPES, CATEGORIES_SQL
+from core.search import DEBOUNCE_MS
+from ui.changes import ChangeForwarder
+from ui.html_delegate import HtmlDelegate
+from ui.tasks import TaskRunner
+
+PAGE_SIZE = 200
+HEADERS = ["ID", "Added", "Type", "Effective Date", "Category", "Content"]
+CONTENT_COLUMN = 5
+# change_page sort key per column; Category can't be sorted. Content sorts
+# by relevance while a search is active, otherwise it isn't sortable either.
+SORT_KEYS = {0: "id", 1: "added_at", 2: "type", 3: "effective_date"}
+DEFAULT_SORT = (1, Qt.DescendingOrder)
+# Dates at the minimum of a QDateEdit mean "no limit"
+NO_DATE = QDate(1900, 1, 1)
+
+
+def date_filter(label):
+    edit = QDateEdit()
+    edit.setCalendarPopup(True)
+    edit.setDisplayFormat("yyyy-MM-dd")
+    edit.setMinimumDate(NO_DATE)
+    edit.setSpecialValueText(f"{label}: any")
+    edit.setDate(NO_DATE)
+    return edit
+
+
+def fetch_page(db_path, **kwargs):
+    return change_page(get_connection(db_path), **kwargs)
+
+
+def fetch_categories(db_path):
+    return get_connection(db_path).execute(CATEGORIES_SQL).fetchall()
+
+
+def date_value(edit):
+    return None if edit.date() == NO_DATE else edit.date().toString("yyyy-MM-dd")
+
+
+class ChangeBrowserModel(QAbstractTableModel):
+    # Holds only the pages scrolled to so far. Each page continues after the
+    # (sort value, id) of the last loaded row, so page 500 costs the same as
+    # page 1. Pages are read on the task runner, one at a time; pages
+    # requested before the last reload() are dropped.
+    def __init__(self, db_path, tasks=None, page_size=PAGE_SIZE):
+        super().__init__()
+        self.db_path = db_path
+        self.tasks = tasks or TaskRunner(self)
+        self.page_size = page_size
+        self.rows = []
+        self.exhausted = False
+        self.loading = False
+        self.generation = 0
+        self.query = ""
+        self.filters = {}
+        self.sort_key = SORT_KEYS[DEFAULT_SORT[0]]
+        self.descending = DEFAULT_SORT[1] == Qt.DescendingOrder
+
+    def reload(self):
+        self.beginResetModel()
+        self.rows = []
+        self.exhausted = False
+        self.loading = False
+        self.generation += 1
+        self.endResetModel()
+
+    def apply_changes(self, changes):
+        # Deleted changes are dropped from the loaded pages. Anything else can
+        # move rows across page boundaries, so the pages are read again; the
+        # view asks for the first one only, whatever the table size.
+        for change in changes:
+            if change.table != "RegulatoryChanges" or change.action != DELETE:
+                self.reload()
+                return
+        for change in changes:
+            for row, loaded in enumerate(self.rows):
+                if loaded[0] == change.row_id:
+                    self.beginRemoveRows(QModelIndex(), row, row)
+                    del self.rows[row]
+                    self.endRemoveRows()
+                    break
+
+    def set_query(self, query, category_id=None, change_type=None, date_from=None, date_to=None):
+        self.query = query
+        self.filters = {
+            "category_id": category_id,
+            "change_type": change_type,
+            "date_from": date_from,
+            "date_to": date_to,
+        }
+        if self.sort_key == "relevance" and not query.strip():
+            self.sort_key, self.descending = SORT_KEYS[DEFAULT_SORT[0]], True
+        self.reload()
+
+    def sortable(self, column):
+        return column in SORT_KEYS or (column == CONTENT_COLUMN and bool(self.query.strip()))
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        if not self.sortable(column):
+            return
+        self.sort_key = SORT_KEYS.get(column, "relevance")
+        # bm25() is lower for better matches
+        self.descending = (order == Qt.DescendingOrder) != (self.sort_key == "relevance")
+        self.reload()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return HEADERS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        value = self.rows[index.row()][index.column()]
+        return "" if value is None else str(value)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.exhausted and not self.loading
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.loading or self.exhausted:
+            return
+        after = (self.rows[-1][6], self.rows[-1][0]) if self.rows else None
+        self.loading = True
+        generation = self.generation
+        self.tasks.submit(
+            "Loading changes", fetch_page, self.db_path, after=after, limit=self.page_size, sort=self.sort_key,
+            descending=self.descending, query=self.query, **self.filters,
+            on_done=lambda page: self.add_page(generation, page),
+            on_error=lambda _: self.page_failed(generation),
+        )
+
+    def page_failed(self, generation):
+        # Tried again on the next scroll
+        if generation == self.generation:
+            self.loading = False
+
+    def add_page(self, generation, page):
+        if generation != self.generation:
+            return
+        self.loading = False
+        if len(page) < self.page_size:
+            self.exhausted = True
+        if page:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(page) - 1)
+            self.rows.extend(page)
+            self.endInsertRows()
+
+
+class ChangeBrowser(QWidget):
+    def __init__(self, db_path, tasks=None):
+        super().__init__()
+        self.db_path = db_path
+        self.tasks = tasks or TaskRunner(self)
+
+        # Full-text search over all changes; empty search lists every change
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("Search changes, e.g. Energieaudit...")
+        self.category_filter = QComboBox()
+        self.category_filter.addItem("All categories", None)
+        self.type_filter = QComboBox()
+        self.type_filter.addItem("All types", None)
+        for change_type in CHANGE_TYPES:
+            self.type_filter.addItem(change_type.capitalize(), change_type)
+        self.from_filter = date_filter("From")
+        self.to_filter = date_filter("To")
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(DEBOUNCE_MS)
+        self.search_timer.timeout.connect(self.apply_filters)
+        self.search_input.textChanged.connect(lambda _: self.search_timer.start())
+        self.category_filter.currentIndexChanged.connect(self.apply_filters)
+        self.type_filter.currentIndexChanged.connect(self.apply_filters)
+        self.from_filter.dateChanged.connect(lambda _: self.search_timer.start())
+        self.to_filter.dateChanged.connect(lambda _: self.search_timer.start())
+
+        self.model = ChangeBrowserModel(db_path, self.tasks)
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.setItemDelegateForColumn(CONTENT_COLUMN, HtmlDelegate(self.table))
+        self.table.verticalHeader().setVisible(False)
+        # Fixed three-line rows: sizing rows to their contents would lay out
+        # every loaded row again after each page
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.table.verticalHeader().setDefaultSectionSize(self.table.fontMetrics().lineSpacing() * 3 + 6)
+        header = self.table.horizontalHeader()
+        header.setSectionResizeMode(CONTENT_COLUMN, QHeaderView.Stretch)
+        header.setSortIndicator(*DEFAULT_SORT)
+        header.setSortIndicatorShown(True)
+        header.setSectionsClickable(True)
+        header.sortIndicatorChanged.connect(self.sort_changed)
+
+        search_row = QHBoxLayout()
+        search_row.addWidget(self.search_input, 1)
+        search_row.addWidget(self.category_filter)
+        search_row.addWidget(self.type_filter)
+        search_row.addWidget(self.from_filter)
+        search_row.addWidget(self.to_filter)
+
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addLayout(search_row)
+        layout.addWidget(self.table)
+        self.setLayout(layout)
+
+        self.change_events = ChangeForwarder("RegulatoryChanges", "Categories", parent=self)
+        self.change_events.changed.connect(self.apply_changes)
+
+        self.load_categories()
+
+    def apply_changes(self, changes):
+        self.model.apply_changes(changes)
+        if any(change.table == "Categories" for change in changes):
+            self.load_categories()
+
+    def load_categories(self):
+        self.tasks.submit("Loading categories", fetch_categories, self.db_path, on_done=self.show_categories)
+
+    def show_categories(self, categories):
+        selected = self.category_filter.currentData()
+        self.category_filter.blockSignals(True)
+        self.category_filter.clear()
+        self.category_filter.addItem("All categories", None)
+        for category_id, label in categories:
+            self.category_filter.addItem(label, category_id)
+        self.category_filter.setCurrentIndex(max(self.category_filter.findData(selected), 0))
+        self.category_filter.blockSignals(False)
+
+    def apply_filters(self):
+        self.search_timer.stop()
+        self.model.set_query(
+            self.search_input.text(),
+            category_id=self.category_filter.currentData(),
+            change_type=self.type_filter.currentData(),
+            date_from=date_value(self.from_filter),
+            date_to=date_value(self.to_filter),
+        )
+        self.sync_sort_indicator()
+
+    def sort_changed(self, column, order):
+        if self.model.sortable(column):
+            self.model.sort(column, order)
+        else:
+            self.sync_sort_indicator()
+
+    def sync_sort_indicator(self):
+        # Puts the header arrow back on the column the model actually sorts by
+        if self.model.sort_key == "relevance":
+            column = CONTENT_COLUMN
+            descending = not self.model.descending
+        else:
+            column = next(column for column, key in SORT_KEYS.items() if key == self.model.sort_key)
+            descending = self.model.descending
+        header = self.table.horizontalHeader()
+        header.blockSignals(True)
+        header.setSortIndicator(column, Qt.DescendingOrder if descending else Qt.AscendingOrder)
+        header.blockSignals(False)
@@ -0,0 +1,16 @@
+# ChangeForwarder - hands data-change events from core.events to a view on the GUI thread
+from PySide6.QtCore import QObject, Signal
+from core.events import events
+
+
+class ChangeForwarder(QObject):
+    # changed(list of Change) for the tables given. Changes committed by a
+    # worker thread arrive queued, like the task signals in ui/tasks.py.
+    changed = Signal(object)
+
+    def __init__(self, *tables, parent=None):
+        super().__init__(parent)
+        self._unsubscribe = events.subscribe(self.changed.emit, *tables)
+
+    def close(self):
+        self._unsubscribe()
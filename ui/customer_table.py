@@ -0,0 +1,228 @@
+# CustomerTableModel - paged customer list with a painted "Manage Emails" action
+from PySide6.QtCore import Qt, QAbstractTableModel, QModelIndex, QEvent, Signal
+from PySide6.QtWidgets import QApplication, QStyle, QStyledItemDelegate, QStyleOptionButton
+from core.db import get_connection
+from core.events import INSERT, UPDATE, DELETE, RELOAD
+from ui.tasks import TaskRunner
+
+PAGE_SIZE = 500
+HEADERS = ["ID", "Name", "# Emails", "Active", ""]
+ACTION_COLUMN = 4
+
+# One page of customers by (name, id) keyset, email counts aggregated for the
+# page in the same statement
+FIRST_PAGE_SQL = """
+    SELECT c.id, c.name, COUNT(e.id), c.active
+    FROM (SELECT id, name, active FROM Customers ORDER BY name, id LIMIT ?) c
+    LEFT JOIN CustomerEmails e ON e.customer_id = c.id
+    GROUP BY c.id
+    ORDER BY c.name, c.id
+"""
+NEXT_PAGE_SQL = """
+    SELECT c.id, c.name, COUNT(e.id), c.active
+    FROM (SELECT id, name, active FROM Customers
+          WHERE (name, id) > (?, ?) ORDER BY name, id LIMIT ?) c
+    LEFT JOIN CustomerEmails e ON e.customer_id = c.id
+    GROUP BY c.id
+    ORDER BY c.name, c.id
+"""
+# A page of an explicit id list, e.g. search results
+IDS_PAGE_SQL = """
+    SELECT c.id, c.name, COUNT(e.id), c.active
+    FROM Customers c
+    LEFT JOIN CustomerEmails e ON e.customer_id = c.id
+    WHERE c.id IN ({})
+    GROUP BY c.id
+"""
+
+
+def fetch_page(db_path, page_size, chunk=None, after=None):
+    # A page of the id list chunk in its order, otherwise the page after the
+    # (name, id) of the last loaded row
+    conn = get_connection(db_path)
+    if chunk is not None:
+        found = {row[0]: row for row in conn.execute(IDS_PAGE_SQL.format(",".join("?" * len(chunk))), chunk)}
+        return [found[customer_id] for customer_id in chunk if customer_id in found]
+    if after is not None:
+        return conn.execute(NEXT_PAGE_SQL, (after[1], after[0], page_size)).fetchall()
+    return conn.execute(FIRST_PAGE_SQL, (page_size,)).fetchall()
+
+
+class CustomerTableModel(QAbstractTableModel):
+    # Pages are read on the task runner; one page is in flight at a time and
+    # pages requested before the last reload() are dropped
+    def __init__(self, db_path, tasks=None, page_size=PAGE_SIZE):
+        super().__init__()
+        self.db_path = db_path
+        self.tasks = tasks or TaskRunner(self)
+        self.page_size = page_size
+        self.rows = []
+        self.exhausted = False
+        self.loading = False
+        self.generation = 0
+        self.filter_ids = None
+        self.filter_offset = 0
+
+    def reload(self):
+        self.beginResetModel()
+        self.rows = []
+        self.exhausted = False
+        self.loading = False
+        self.generation += 1
+        self.filter_offset = 0
+        self.endResetModel()
+
+    def set_filter(self, ids):
+        # ids: customer ids to show in this order, or None for all customers
+        self.filter_ids = ids
+        self.reload()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return HEADERS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        if index.column() == ACTION_COLUMN:
+            return "Manage Emails"
+        return str(self.rows[index.row()][index.column()])
+
+    def row_of(self, customer_id):
+        for row, customer in enumerate(self.rows):
+            if customer[0] == customer_id:
+                return row
+        return None
+
+    def insert_position(self, name, customer_id):
+        # Position in the loaded (name, id) order
+        low, high = 0, len(self.rows)
+        while low < high:
+            middle = (low + high) // 2
+            if (self.rows[middle][1], self.rows[middle][0]) < (name, customer_id):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def apply_changes(self, changes):
+        # Patches the loaded rows for Customers and CustomerEmails changes
+        # instead of reloading; rows not loaded yet are read when paged in
+        for change in changes:
+            if change.action == RELOAD:
+                self.reload()
+                return
+        for change in changes:
+            if change.table == "CustomerEmails":
+                if change.action in (INSERT, DELETE):
+                    self.add_email_count(change.values["customer_id"], 1 if change.action == INSERT else -1)
+            elif change.action == INSERT:
+                self.insert_customer(change.row_id, change.values)
+            elif change.action == UPDATE:
+                self.update_customer(change.row_id, change.values)
+            elif change.action == DELETE:
+                row = self.row_of(change.row_id)
+                if row is not None:
+                    self.beginRemoveRows(QModelIndex(), row, row)
+                    del self.rows[row]
+                    self.endRemoveRows()
+
+    def insert_customer(self, customer_id, values):
+        # A search result list only changes with a new search
+        if self.filter_ids is not None or self.row_of(customer_id) is not None:
+            return
+        row = self.insert_position(values["name"], customer_id)
+        if row == len(self.rows) and not self.exhausted:
+            # Sorts after the loaded pages; the next page brings it
+            return
+        self.beginInsertRows(QModelIndex(), row, row)
+        # Its addresses follow as CustomerEmails inserts
+        self.rows.insert(row, (customer_id, values["name"], 0, values["active"]))
+        self.endInsertRows()
+
+    def update_customer(self, customer_id, values):
+        row = self.row_of(customer_id)
+        if row is None:
+            return
+        _, name, emails, active = self.rows[row]
+        self.rows[row] = (customer_id, values.get("name", name), emails, values.get("active", active))
+        self.dataChanged.emit(self.index(row, 0), self.index(row, len(HEADERS) - 1), [Qt.DisplayRole])
+
+    def add_email_count(self, customer_id, delta):
+        row = self.row_of(customer_id)
+        if row is None:
+            return
+        customer_id, name, emails, active = self.rows[row]
+        self.rows[row] = (customer_id, name, emails + delta, active)
+        index = self.index(row, 2)
+        self.dataChanged.emit(index, index, [Qt.DisplayRole])
+
+    def customer_at(self, row):
+        customer_id, name, _, _ = self.rows[row]
+        return customer_id, name
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.exhausted and not self.loading
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.loading or self.exhausted:
+            return
+        chunk = after = None
+        if self.filter_ids is not None:
+            chunk = self.filter_ids[self.filter_offset:self.filter_offset + self.page_size]
+        elif self.rows:
+            after = self.rows[-1][:2]
+        self.loading = True
+        generation = self.generation
+        self.tasks.submit(
+            "Loading customers", fetch_page, self.db_path, self.page_size, chunk, after,
+            on_done=lambda page: self.add_page(generation, chunk, page),
+            on_error=lambda _: self.page_failed(generation),
+        )
+
+    def page_failed(self, generation):
+        # Tried again on the next scroll
+        if generation == self.generation:
+            self.loading = False
+
+    def add_page(self, generation, chunk, page):
+        if generation != self.generation:
+            return
+        self.loading = False
+        if chunk is not None:
+            self.filter_offset += len(chunk)
+            self.exhausted = self.filter_offset >= len(self.filter_ids)
+        elif len(page) < self.page_size:
+            self.exhausted = True
+        if page:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(page) - 1)
+            self.rows.extend(page)
+            self.endInsertRows()
+
+
+class ButtonDelegate(QStyledItemDelegate):
+    # Paints a push button instead of creating a QPushButton per row
+    clicked = Signal(QModelIndex)
+
+    def paint(self, painter, option, index):
+        button = QStyleOptionButton()
+        button.rect = option.rect.adjusted(2, 2, -2, -2)
+        button.text = index.data()
+        button.state = QStyle.State_Enabled | QStyle.State_Raised
+        if option.state & QStyle.State_MouseOver:
+            button.state |= QStyle.State_MouseOver
+        style = option.widget.style() if option.widget else QApplication.style()
+        style.drawControl(QStyle.CE_PushButton, button, painter, option.widget)
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QEvent.MouseButtonRelease and option.rect.contains(event.position().toPoint()):
+            self.clicked.emit(index)
+            return True
+        return super().editorEvent(event, model, option, index)
@@ -3,11 +3,52 @@ from PySide6.QtWidgets import (
     QDialog, QVBoxLayout, QLabel, QLineEdit, QPushButton,
     QTableWidget, QTableWidgetItem, QHBoxLayout, QMessageBox
 )
-import sqlite3
+from core.audit import audit_log
+from core.bounces import reactivate
+from core.db import get_connection, transaction
+from core.events import INSERT, DELETE, RELOAD, events
+from ui.changes import ChangeForwarder
+from ui.tasks import TaskRunner
+
+EMAILS_SQL = "SELECT id, email, suppressed_at, bounce_reason FROM CustomerEmails"
+
+
+def fetch_emails(db_path, customer_id):
+    return get_connection(db_path).execute(f"{EMAILS_SQL} WHERE customer_id = ?", (customer_id,)).fetchall()
+
+
+def fetch_email_rows(db_path, email_ids):
+    # By id; addresses deleted meanwhile are missing
+    conn = get_connection(db_path)
+    rows = conn.execute(f"{EMAILS_SQL} WHERE id IN ({','.join('?' * len(email_ids))})", email_ids)
+    return {row[0]: row for row in rows}
+
+
+def insert_email(db_path, customer_id, email):
+    with transaction(db_path) as conn:
+        cur = conn.execute("INSERT INTO CustomerEmails (customer_id, email) VALUES (?, ?)", (customer_id, email))
+        events.publish("CustomerEmails", INSERT, cur.lastrowid, customer_id=customer_id, email=email)
+    audit_log(db_path).record(
+        "insert", "CustomerEmails", cur.lastrowid, {"customer_id": customer_id, "email": email}
+    )
+
+
+def remove_email(db_path, customer_id, email_id):
+    with transaction(db_path) as conn:
+        row = conn.execute("SELECT email FROM CustomerEmails WHERE id = ?", (email_id,)).fetchone()
+        conn.execute("DELETE FROM CustomerEmails WHERE id = ?", (email_id,))
+        if row:
+            events.publish("CustomerEmails", DELETE, email_id, customer_id=customer_id, email=row[0])
+    if row:
+        audit_log(db_path).record(
+            "delete", "CustomerEmails", email_id, {"customer_id": customer_id, "email": row[0]}
+        )
+
 
 class EmailManagementDialog(QDialog):
-    def __init__(self, customer_id, customer_name, db_path):
+    def __init__(self, customer_id, customer_name, db_path, tasks=None):
         super().__init__()
+        self.tasks = tasks or TaskRunner(self)
         self.setWindowTitle(f"Manage Emails for {customer_name}")
         self.customer_id = customer_id
         self.db_path = db_path
@@ -26,48 +67,108 @@ class EmailManagementDialog(QDialog):
         self.layout.addLayout(input_layout)
 
         self.email_table = QTableWidget()
-        self.email_table.setColumnCount(2)
-        self.email_table.setHorizontalHeaderLabels(["Email", ""])
+        self.email_table.setColumnCount(4)
+        self.email_table.setHorizontalHeaderLabels(["Email", "Status", "", ""])
         self.layout.addWidget(self.email_table)
 
+        self.rows = []
+        self.change_events = ChangeForwarder("CustomerEmails", parent=self)
+        self.change_events.changed.connect(self.apply_changes)
+
         self.load_emails()
 
+    def done(self, result):
+        self.change_events.close()
+        super().done(result)
+
     def get_db_connection(self):
-        return sqlite3.connect(self.db_path)
+        return get_connection(self.db_path)
 
     def load_emails(self):
-        conn = self.get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT id, email FROM CustomerEmails WHERE customer_id = ?", (self.customer_id,))
-        rows = cur.fetchall()
-        conn.close()
+        self.tasks.submit("Loading emails", fetch_emails, self.db_path, self.customer_id, on_done=self.show_emails)
 
+    def show_emails(self, rows):
+        self.rows = list(rows)
         self.email_table.setRowCount(len(rows))
-        for i, (email_id, email) in enumerate(rows):
-            self.email_table.setItem(i, 0, QTableWidgetItem(email))
-            delete_btn = QPushButton("Delete")
-            delete_btn.clicked.connect(lambda _, eid=email_id: self.delete_email(eid))
-            self.email_table.setCellWidget(i, 1, delete_btn)
+        for i, row in enumerate(self.rows):
+            self.set_email_row(i, row)
+
+    def set_email_row(self, i, row):
+        email_id, email, suppressed_at, bounce_reason = row
+        self.email_table.setItem(i, 0, QTableWidgetItem(email))
+        # Bounced addresses get no newsletters until reactivated
+        status = QTableWidgetItem(f"Bounced {suppressed_at[:10]}" if suppressed_at else "")
+        status.setToolTip(bounce_reason or "")
+        self.email_table.setItem(i, 1, status)
+        if suppressed_at:
+            reactivate_btn = QPushButton("Reactivate")
+            reactivate_btn.clicked.connect(lambda _, eid=email_id: self.reactivate_email(eid))
+            self.email_table.setCellWidget(i, 2, reactivate_btn)
+        else:
+            self.email_table.removeCellWidget(i, 2)
+        delete_btn = QPushButton("Delete")
+        delete_btn.clicked.connect(lambda _, eid=email_id: self.delete_email(eid))
+        self.email_table.setCellWidget(i, 3, delete_btn)
+
+    def apply_changes(self, changes):
+        # Only this customer's rows are touched; inserted and updated
+        # addresses are read again by id on the task runner
+        if any(change.action == RELOAD for change in changes):
+            self.load_emails()
+            return
+        changes = [change for change in changes if change.values.get("customer_id") == self.customer_id]
+        email_ids = [change.row_id for change in changes if change.action != DELETE]
+        if not email_ids:
+            self.apply_rows(changes, {})
+            return
+        self.tasks.submit(
+            "Loading emails", fetch_email_rows, self.db_path, email_ids,
+            on_done=lambda rows: self.apply_rows(changes, rows),
+        )
+
+    def apply_rows(self, changes, rows):
+        for change in changes:
+            position = next((i for i, row in enumerate(self.rows) if row[0] == change.row_id), None)
+            if change.action == DELETE:
+                if position is not None:
+                    del self.rows[position]
+                    self.email_table.removeRow(position)
+                continue
+            row = rows.get(change.row_id)
+            if row is None:
+                continue
+            if position is None:
+                if change.action != INSERT:
+                    continue
+                position = len(self.rows)
+                self.rows.append(row)
+                self.email_table.insertRow(position)
+            else:
+                self.rows[position] = row
+            self.set_email_row(position, row)
 
     def add_email(self):
         email = self.email_input.text().strip()
         if not email:
             QMessageBox.warning(self, "Validation Error", "Email address cannot be empty.")
             return
+        self.add_email_button.setEnabled(False)
+        self.tasks.submit(
+            "Adding email", insert_email, self.db_path, self.customer_id, email,
+            on_done=self.email_added, on_error=self.email_failed,
+        )
 
-        conn = self.get_db_connection()
-        cur = conn.cursor()
-        cur.execute("INSERT INTO CustomerEmails (customer_id, email) VALUES (?, ?)", (self.customer_id, email))
-        conn.commit()
-        conn.close()
-
+    def email_added(self, _):
+        self.add_email_button.setEnabled(True)
         self.email_input.clear()
-        self.load_emails()
+
+    def email_failed(self, error):
+        self.add_email_button.setEnabled(True)
+        QMessageBox.critical(self, "Error", f"Failed to update email addresses: {error}")
 
     def delete_email(self, email_id):
-        conn = self.get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM CustomerEmails WHERE id = ?", (email_id,))
-        conn.commit()
-        conn.close()
-        self.load_emails()
+        self.tasks.submit("Deleting email", remove_email, self.db_path, self.customer_id, email_id,
+                          on_error=self.email_failed)
+
+    def reactivate_email(self, email_id):
+        self.tasks.submit("Reactivating email", reactivate, self.db_path, email_id, on_error=self.email_failed)
@@ -0,0 +1,40 @@
+# HtmlDelegate - renders an item's text as rich text, e.g. search snippets with <b> hits
+from PySide6.QtCore import QSize
+from PySide6.QtGui import QAbstractTextDocumentLayout, QPalette, QTextDocument
+from PySide6.QtWidgets import QApplication, QStyle, QStyledItemDelegate, QStyleOptionViewItem
+
+
+class HtmlDelegate(QStyledItemDelegate):
+    def paint(self, painter, option, index):
+        options = QStyleOptionViewItem(option)
+        self.initStyleOption(options, index)
+        style = options.widget.style() if options.widget else QApplication.style()
+        document = self.document(options)
+
+        # Background, selection and focus as usual, then the text on top
+        options.text = ""
+        style.drawControl(QStyle.CE_ItemViewItem, options, painter, options.widget)
+        text_rect = style.subElementRect(QStyle.SE_ItemViewItemText, options, options.widget)
+        context = QAbstractTextDocumentLayout.PaintContext()
+        if option.state & QStyle.State_Selected:
+            context.palette.setColor(QPalette.Text, option.palette.color(QPalette.HighlightedText))
+        painter.save()
+        painter.translate(text_rect.topLeft())
+        painter.setClipRect(text_rect.translated(-text_rect.topLeft()))
+        document.documentLayout().draw(painter, context)
+        painter.restore()
+
+    def sizeHint(self, option, index):
+        options = QStyleOptionViewItem(option)
+        self.initStyleOption(options, index)
+        document = self.document(options)
+        return QSize(int(document.idealWidth()), int(document.size().height()))
+
+    def document(self, options):
+        document = QTextDocument()
+        document.setDocumentMargin(2)
+        document.setDefaultFont(options.font)
+        document.setHtml(options.text)
+        if options.rect.width() > 0:
+            document.setTextWidth(options.rect.width())
+        return document
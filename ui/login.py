@@ -1,23 +1,11 @@
 from PySide6.QtWidgets import (
     QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton, QMessageBox
 )
-from ui.main_window import MainWindow
-import sqlite3
-import configparser
+from core.audit import audit_log
+from core.db import get_connection
+from core.settings import settings
 import logging
 
-# Read config
-config = configparser.ConfigParser()
-config.read('config.ini')
-db_path = config['APP']['db_path']
-log_file = config['APP']['log_file']
-
-# Setup logging (fallback if not set in main)
-logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s %(message)s')
-
-def get_db_connection():
-    return sqlite3.connect(db_path)
-
 class LoginWindow(QWidget):
     def __init__(self):
         super().__init__()
@@ -42,19 +30,24 @@ class LoginWindow(QWidget):
         username = self.user_input.text()
         password = self.pass_input.text()
 
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT id, password_hash FROM Users WHERE username = ?", (username,))
-        row = cur.fetchone()
-        conn.close()
+        conn = get_connection(settings.db_path)
+        row = conn.execute("SELECT id, password_hash FROM Users WHERE username = ?", (username,)).fetchone()
 
         if row and password == row[1]:  # Replace with hash check in prod
             logging.info(f"User {username} logged in.")
+            log = audit_log(settings.db_path)
+            # Everything audited in this session is attributed to this user
+            log.user_id = row[0]
+            log.record("login", "Users", row[0])
             self.accept_login(row[0], username)
         else:
+            audit_log(settings.db_path).record("login_failed", "Users", row[0] if row else None, {"username": username})
             QMessageBox.warning(self, "Login Failed", "Invalid credentials")
 
     def accept_login(self, user_id, username):
+        # The main window pulls in most of the app; importing it only after
+        # a successful login keeps the login window quick to appear
+        from ui.main_window import MainWindow
         self.main_window = MainWindow(user_id, username)
         self.main_window.show()
         self.close()
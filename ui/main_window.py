@@ -1,39 +1,61 @@
 # MainWindow - entry point after login
+from PySide6.QtCore import QTimer
 from PySide6.QtWidgets import (
-    QWidget, QVBoxLayout, QTabWidget, QPushButton, QTableWidget,
-    QTableWidgetItem, QLineEdit, QLabel, QCheckBox, QHBoxLayout, QMessageBox
+    QWidget, QVBoxLayout, QTabWidget, QPushButton, QTableView,
+    QLineEdit, QLabel, QCheckBox, QMessageBox, QHeaderView, QHBoxLayout, QFileDialog
 )
 from ui.email_dialog import EmailManagementDialog
-import sqlite3
-import configparser
+from ui.customer_table import CustomerTableModel, ButtonDelegate, ACTION_COLUMN
+from ui.change_browser import ChangeBrowser
+from ui.changes import ChangeForwarder
 import logging
-from datetime import datetime
-from jinja2 import Environment, FileSystemLoader
-from email.mime.text import MIMEText
-import smtplib
-from ui.category_matrix import CategoryMatrixTab
-
-# Config and logging
-config = configparser.ConfigParser()
-config.read('config.ini')
-db_path = config['APP']['db_path']
-template_path = config['APP']['template_path']
-log_file = config['APP']['log_file']
-
-smtp_host = config['SMTP']['host']
-smtp_port = int(config['SMTP']['port'])
-smtp_user = config['SMTP']['username']
-smtp_pass = config['SMTP']['password']
-smtp_tls = config['SMTP'].getboolean('use_tls')
-
-logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s %(message)s')
-
-# Jinja2 setup
-env = Environment(loader=FileSystemLoader(template_path.rsplit("/", 1)[0]))
-template = env.get_template(template_path.rsplit("/", 1)[1])
-
-def get_db_connection():
-    return sqlite3.connect(db_path)
+from ui.category_matrix import CategoryMatrixTab, after_flush
+from ui.tasks import TaskRunner, TaskStatusBar
+from core.audit import audit_log
+from core.bulk_io import import_customers, export_customers
+from core.db import get_connection, transaction
+from core.events import INSERT, RELOAD, events
+from core.search import customer_index, changed_customer_entries, refresh_customers, DEBOUNCE_MS
+from core.email_sender import SMTPConnectionPool, DispatchEngine, OutgoingMessage, build_message
+from core.settings import settings
+
+
+def send_messages(messages, task):
+    sent = []
+
+    def progress(job, error):
+        sent.append(job)
+        task.report(len(sent), len(messages))
+
+    def until_cancelled():
+        for message in messages:
+            if task.is_cancelled:
+                break
+            yield message
+
+    pool = SMTPConnectionPool.from_config(settings.config)
+    try:
+        return DispatchEngine.from_config(pool, settings.config).send(until_cancelled(), on_result=progress)
+    finally:
+        pool.close()
+
+
+def insert_customer(db_path, name, email, active):
+    with transaction(db_path) as conn:
+        cur = conn.execute("INSERT INTO Customers (name, active) VALUES (?, ?)", (name, active))
+        customer_id = cur.lastrowid
+        events.publish("Customers", INSERT, customer_id, name=name, active=active)
+        if email:
+            cur = conn.execute(
+                "INSERT INTO CustomerEmails (customer_id, email) VALUES (?, ?)", (customer_id, email)
+            )
+            events.publish("CustomerEmails", INSERT, cur.lastrowid, customer_id=customer_id, email=email)
+    audit_log(db_path).record(
+        "insert", "Customers", customer_id, {"name": name, "active": active, "email": email or None}
+    )
+    logging.info(f"Added customer: {name}")
+    return customer_id
+
 
 class MainWindow(QWidget):
     def __init__(self, user_id, username):
@@ -42,46 +64,49 @@ class MainWindow(QWidget):
         self.username = username
         self.setWindowTitle(f"ISO 50001 Newsletter – Logged in as {username}")
 
+        self.tasks = TaskRunner(self)
         self.tabs = QTabWidget()
         self.tab_dashboard = QWidget()
         self.tab_customers = QWidget()
-        self.tab_categories = CategoryMatrixTab(db_path)
+        self.tab_categories = CategoryMatrixTab(settings.db_path, self.tasks)
         self.tabs.addTab(self.tab_categories, "Categories & Matrix")
 
 
         self.tabs.addTab(self.tab_dashboard, "Dashboard")
         self.tabs.addTab(self.tab_customers, "Customers")
 
+        self.tabs.currentChanged.connect(self.tab_categories.flush_pending)
+
+        self.status_bar = TaskStatusBar(self.tasks)
+
         layout = QVBoxLayout()
         layout.addWidget(self.tabs)
+        layout.addWidget(self.status_bar)
         self.setLayout(layout)
 
         self.init_dashboard()
         self.init_customers()
 
+    def closeEvent(self, event):
+        for forwarder in (self.customer_events, self.tab_categories.change_events, self.change_browser.change_events):
+            forwarder.close()
+        self.tasks.cancel_all()
+        # Queued after the cancel, so unsaved matrix clicks are still written
+        self.tab_categories.flush_pending()
+        self.tasks.wait(5000)
+        # Also flushed at exit; doing it here keeps the window's last edits
+        # safe should the event loop be torn down abruptly
+        audit_log(settings.db_path).flush()
+        super().closeEvent(event)
+
     def init_dashboard(self):
         layout = QVBoxLayout()
         self.send_btn = QPushButton("Send Test Newsletter")
         self.send_btn.clicked.connect(self.send_test_newsletter)
-        self.table = QTableWidget()
+        self.change_browser = ChangeBrowser(settings.db_path, self.tasks)
         layout.addWidget(self.send_btn)
-        layout.addWidget(self.table)
+        layout.addWidget(self.change_browser)
         self.tab_dashboard.setLayout(layout)
-        self.load_recent_changes()
-
-    def load_recent_changes(self):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT id, content, effective_date FROM RegulatoryChanges ORDER BY added_at DESC LIMIT 10")
-        rows = cur.fetchall()
-        conn.close()
-
-        self.table.setRowCount(len(rows))
-        self.table.setColumnCount(3)
-        self.table.setHorizontalHeaderLabels(["ID", "Content", "Effective Date"])
-        for i, row in enumerate(rows):
-            for j, value in enumerate(row):
-                self.table.setItem(i, j, QTableWidgetItem(str(value)))
 
     def init_customers(self):
         layout = QVBoxLayout()
@@ -90,7 +115,23 @@ class MainWindow(QWidget):
         self.customer_email_input = QLineEdit()
         self.customer_active_input = QCheckBox("Active")
         self.add_customer_btn = QPushButton("Add Customer")
-        self.customer_table = QTableWidget()
+        self.customer_search_input = QLineEdit()
+        self.customer_search_input.setPlaceholderText("Search name or email...")
+        self.customer_search_timer = QTimer(self)
+        self.customer_search_timer.setSingleShot(True)
+        self.customer_search_timer.setInterval(DEBOUNCE_MS)
+        self.customer_search_timer.timeout.connect(self.filter_customers)
+        self.customer_search_input.textChanged.connect(lambda _: self.customer_search_timer.start())
+        self.customer_index = None
+
+        self.customer_model = CustomerTableModel(settings.db_path, self.tasks)
+        self.customer_table = QTableView()
+        self.customer_table.setModel(self.customer_model)
+        self.manage_delegate = ButtonDelegate(self.customer_table)
+        self.manage_delegate.clicked.connect(self.open_email_dialog_at)
+        self.customer_table.setItemDelegateForColumn(ACTION_COLUMN, self.manage_delegate)
+        self.customer_table.setMouseTracking(True)
+        self.customer_table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
 
         form_layout = QVBoxLayout()
         form_layout.addWidget(QLabel("Customer Name:"))
@@ -100,35 +141,80 @@ class MainWindow(QWidget):
         form_layout.addWidget(self.customer_active_input)
         form_layout.addWidget(self.add_customer_btn)
 
+        self.import_btn = QPushButton("Import...")
+        self.import_btn.clicked.connect(self.import_customer_file)
+        self.export_btn = QPushButton("Export...")
+        self.export_btn.clicked.connect(self.export_customer_file)
+        file_layout = QHBoxLayout()
+        file_layout.addWidget(self.import_btn)
+        file_layout.addWidget(self.export_btn)
+        file_layout.addStretch()
+
         layout.addLayout(form_layout)
+        layout.addLayout(file_layout)
+        layout.addWidget(self.customer_search_input)
         layout.addWidget(self.customer_table)
         self.tab_customers.setLayout(layout)
 
         self.add_customer_btn.clicked.connect(self.add_customer)
+        self.customer_events = ChangeForwarder("Customers", "CustomerEmails", parent=self)
+        self.customer_events.changed.connect(self.apply_customer_changes)
         self.load_customers()
 
     def load_customers(self):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT id, name, active FROM Customers ORDER BY name")
-        rows = cur.fetchall()
-        self.customer_table.setRowCount(len(rows))
-        self.customer_table.setColumnCount(5)
-        self.customer_table.setHorizontalHeaderLabels(["ID", "Name", "# Emails", "Active", ""])
-        for i, row in enumerate(rows):
-            cur.execute("SELECT COUNT(*) FROM CustomerEmails WHERE customer_id = ?", (row[0],))
-            email_count = cur.fetchone()[0]
-            for j, value in enumerate([row[0], row[1], email_count, row[2]]):
-                self.customer_table.setItem(i, j, QTableWidgetItem(str(value)))
-            manage_btn = QPushButton("Manage Emails")
-            manage_btn.clicked.connect(lambda _, cid=row[0], cname=row[1]: self.open_email_dialog(cid, cname))
-            self.customer_table.setCellWidget(i, 4, manage_btn)
-        conn.close()
+        self.customer_index = None
+        self.filter_customers()
+
+    def filter_customers(self):
+        search_text = self.customer_search_input.text()
+        if not search_text.strip():
+            self.customer_model.set_filter(None)
+            return
+        if self.customer_index is None:
+            self.tasks.submit(
+                "Building customer search index",
+                lambda: customer_index(get_connection(settings.db_path)),
+                on_done=self.set_customer_index,
+            )
+            return
+        self.customer_model.set_filter(self.customer_index.search(search_text))
+
+    def set_customer_index(self, index):
+        self.customer_index = index
+        self.filter_customers()
+
+    def apply_customer_changes(self, changes):
+        # The table patches its loaded rows; the search index rereads only
+        # the customers concerned. Current search results stay as they are.
+        self.customer_model.apply_changes(changes)
+        if any(change.action == RELOAD for change in changes):
+            self.customer_index = None
+            if self.customer_search_input.text().strip():
+                self.filter_customers()
+            return
+        if self.customer_index is not None:
+            customer_ids = {
+                change.row_id if change.table == "Customers" else change.values["customer_id"]
+                for change in changes
+            }
+            index = self.customer_index
+            self.tasks.submit(
+                "Updating search index",
+                lambda: changed_customer_entries(get_connection(settings.db_path), customer_ids),
+                on_done=lambda result: self.refresh_customer_index(index, *result),
+            )
+
+    def refresh_customer_index(self, index, customer_ids, entries):
+        # Only if the index is still the one in use
+        if self.customer_index is index:
+            refresh_customers(index, customer_ids, entries)
+
+    def open_email_dialog_at(self, index):
+        self.open_email_dialog(*self.customer_model.customer_at(index.row()))
 
     def open_email_dialog(self, customer_id, customer_name):
-        dialog = EmailManagementDialog(customer_id, customer_name, db_path)
+        dialog = EmailManagementDialog(customer_id, customer_name, settings.db_path, self.tasks)
         dialog.exec()
-        self.load_customers()
 
     def add_customer(self):
         name = self.customer_name_input.text().strip()
@@ -139,54 +225,124 @@ class MainWindow(QWidget):
             QMessageBox.warning(self, "Validation", "Customer name is required.")
             return
 
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("INSERT INTO Customers (name, active) VALUES (?, ?)", (name, active))
-        customer_id = cur.lastrowid
-        if email:
-            cur.execute("INSERT INTO CustomerEmails (customer_id, email) VALUES (?, ?)", (customer_id, email))
-        conn.commit()
-        conn.close()
+        self.add_customer_btn.setEnabled(False)
+        self.tasks.submit(
+            "Adding customer", insert_customer, settings.db_path, name, email, active,
+            on_done=lambda _: self.customer_added(name),
+            on_error=self.add_customer_failed,
+        )
 
-        logging.info(f"Added customer: {name}")
+    def customer_added(self, name):
+        self.add_customer_btn.setEnabled(True)
         QMessageBox.information(self, "Success", f"Customer '{name}' added.")
         self.customer_name_input.clear()
         self.customer_email_input.clear()
         self.customer_active_input.setChecked(False)
-        self.load_customers()
-        # This updates the matrix view
-        self.tab_categories.refresh_data()
+
+    def add_customer_failed(self, error):
+        self.add_customer_btn.setEnabled(True)
+        QMessageBox.critical(self, "Error", f"Failed to add customer: {error}")
+
+    def import_customer_file(self):
+        path, _ = QFileDialog.getOpenFileName(
+            self, "Import Customers", "", "Customer lists (*.csv *.xlsx);;All files (*)"
+        )
+        if not path:
+            return
+        # Unsaved matrix clicks first, so the preview compares against them
+        self.import_btn.setEnabled(False)
+        self.tasks.submit(
+            "Checking import file", after_flush, self.tab_categories.changes,
+            import_customers, settings.db_path, path, True,
+            on_done=lambda summary: self.confirm_import(path, summary),
+            on_error=self.import_failed,
+        )
+
+    def confirm_import(self, path, summary):
+        lines = [
+            f"{summary['rows'] - summary['invalid']} of {summary['rows']} rows can be imported.",
+            "",
+            f"Customers: {summary['customers_added']} new, {summary['customers_updated']} changed",
+            f"Email addresses: {summary['emails_added']} new, {summary['emails_suppressed']} suppressed",
+            f"Category mappings: {summary['mappings_added']} new",
+        ]
+        if summary["errors"]:
+            lines += ["", "Skipped:"] + summary["errors"][:10]
+            if summary["invalid"] > 10:
+                lines.append(f"... {summary['invalid'] - 10} more")
+        answer = QMessageBox.question(self, "Import Customers", "\n".join(lines) + "\n\nImport now?")
+        if answer != QMessageBox.Yes:
+            self.import_btn.setEnabled(True)
+            return
+        self.tasks.submit(
+            "Importing customers", import_customers, settings.db_path, path,
+            on_done=self.customers_imported, on_error=self.import_failed,
+        )
+
+    def customers_imported(self, summary):
+        self.import_btn.setEnabled(True)
+        QMessageBox.information(
+            self, "Import Customers",
+            f"Imported {summary['customers_added']} new and {summary['customers_updated']} changed customers, "
+            f"{summary['emails_added']} email addresses and {summary['mappings_added']} category mappings."
+        )
+
+    def import_failed(self, error):
+        self.import_btn.setEnabled(True)
+        QMessageBox.critical(self, "Import Customers", f"Import failed: {error}")
+
+    def export_customer_file(self):
+        path, _ = QFileDialog.getSaveFileName(
+            self, "Export Customers", "customers.csv", "CSV (*.csv);;Excel (*.xlsx)"
+        )
+        if not path:
+            return
+        self.tasks.submit(
+            "Exporting customers", export_customers, settings.db_path, path,
+            on_done=lambda written: QMessageBox.information(
+                self, "Export Customers", f"Exported {written} customers to {path}"),
+            on_error=lambda error: QMessageBox.critical(self, "Export Customers", f"Export failed: {error}"),
+        )
 
     def send_test_newsletter(self):
         customer = {"customer_name": "Test GmbH", "customer_email": "test@example.com"}
         changes = [{
+            "id": 0,
             "type": "change",
             "effective_date": "2025-07-01",
             "category": "Germany",
             "content": "New rule for energy audits."
         }]
-        html = template.render(
+        html = settings.renderer.render(
             quarter="Q2 2025",
             customer_name=customer["customer_name"],
             customer_email=customer["customer_email"],
-            current_year=datetime.now().year,
-            changes=changes
+            changes=changes,
+            # Made-up change, kept out of the shared render caches
+            cache=False,
         )
 
-        msg = MIMEText(html, "html")
-        msg["Subject"] = "Test ISO 50001 Update"
-        msg["From"] = smtp_user
-        msg["To"] = customer["customer_email"]
-
-        try:
-            server = smtplib.SMTP(smtp_host, smtp_port)
-            if smtp_tls:
-                server.starttls()
-            server.login(smtp_user, smtp_pass)
-            server.sendmail(smtp_user, [customer["customer_email"]], msg.as_string())
-            server.quit()
-            logging.info(f"Sent test newsletter to {customer['customer_email']}")
-            QMessageBox.information(self, "Success", f"Test newsletter sent to {customer['customer_email']}")
-        except Exception as e:
-            logging.error(f"Failed to send email: {e}")
-            QMessageBox.critical(self, "Error", f"Failed to send email: {str(e)}")
+        smtp_user = settings.config['SMTP']['username']
+        msg = build_message(html, "Test ISO 50001 Update", smtp_user, customer["customer_email"])
+        self.send_btn.setEnabled(False)
+        self.tasks.submit(
+            "Sending test newsletter",
+            send_messages,
+            [OutgoingMessage(smtp_user, customer["customer_email"], msg)],
+            reports_progress=True,
+            on_done=self.test_newsletter_sent,
+            on_error=self.test_newsletter_failed,
+        )
+
+    def test_newsletter_sent(self, results):
+        self.send_btn.setEnabled(True)
+        for job, error in results:
+            if error is not None:
+                self.test_newsletter_failed(error)
+                continue
+            logging.info(f"Sent test newsletter to {job.to_email}")
+            QMessageBox.information(self, "Success", f"Test newsletter sent to {job.to_email}")
+
+    def test_newsletter_failed(self, error):
+        self.send_btn.setEnabled(True)
+        QMessageBox.critical(self, "Error", f"Failed to send email: {str(error)}")
@@ -0,0 +1,171 @@
+# MatrixModel - full customers × categories grid for the category matrix tab
+from PySide6.QtCore import Qt, QAbstractTableModel, QModelIndex, QEvent, QRect, Signal
+from PySide6.QtWidgets import QApplication, QStyle, QStyledItemDelegate, QStyleOptionButton
+from core.db import get_connection
+from core.models import CATEGORIES_SQL
+
+
+class MappingBitset:
+    # One bit per (customer row, category column), row-major
+    def __init__(self, rows, columns):
+        self.rows = rows
+        self.columns = columns
+        self.bits = bytearray((rows * columns + 7) // 8)
+
+    def get(self, row, column):
+        i = row * self.columns + column
+        return bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+    def add_row(self):
+        self.rows += 1
+        self.bits.extend(bytes((self.rows * self.columns + 7) // 8 - len(self.bits)))
+
+    def set(self, row, column, value):
+        i = row * self.columns + column
+        if value:
+            self.bits[i >> 3] |= 1 << (i & 7)
+        else:
+            self.bits[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+
+
+class MatrixModel(QAbstractTableModel):
+    # Emitted after a cell was toggled in the grid: customer_id, category_id, checked
+    toggled = Signal(int, int, bool)
+
+    def __init__(self, db_path):
+        super().__init__()
+        self.db_path = db_path
+        self.customers = []
+        self.categories = []
+        self.customer_rows = {}
+        self.category_columns = {}
+        self.bitset = MappingBitset(0, 0)
+        self.visible = None
+        # Customer row -> position in visible, rebuilt whenever visible changes
+        self.visible_positions = None
+
+    @staticmethod
+    def fetch(db_path):
+        # Runs off the GUI thread; apply() installs the result
+        conn = get_connection(db_path)
+        customers = conn.execute("SELECT id, name FROM Customers WHERE active = 1 ORDER BY name").fetchall()
+        categories = conn.execute(CATEGORIES_SQL).fetchall()
+        customer_rows = {customer_id: row for row, (customer_id, _) in enumerate(customers)}
+        category_columns = {category_id: column for column, (category_id, _) in enumerate(categories)}
+        bitset = MappingBitset(len(customers), len(categories))
+        for customer_id, category_id in conn.execute(
+            "SELECT customer_id, category_id FROM CustomerCategoryMapping"
+        ):
+            row = customer_rows.get(customer_id)
+            column = category_columns.get(category_id)
+            if row is not None and column is not None:
+                bitset.set(row, column, True)
+        return customers, categories, customer_rows, category_columns, bitset
+
+    def apply(self, data):
+        self.beginResetModel()
+        self.customers, self.categories, self.customer_rows, self.category_columns, self.bitset = data
+        self.visible = None
+        self.visible_positions = None
+        self.endResetModel()
+
+    def load(self):
+        self.apply(self.fetch(self.db_path))
+
+    def set_visible_rows(self, rows):
+        # rows: customer row numbers to show, or None for all
+        self.beginResetModel()
+        self.visible = rows
+        self.visible_positions = None if rows is None else {row: position for position, row in enumerate(rows)}
+        self.endResetModel()
+
+    def set_checked(self, customer_id, category_id, checked):
+        # Applies a change made elsewhere without emitting toggled
+        row = self.customer_rows.get(customer_id)
+        column = self.category_columns.get(category_id)
+        if row is None or column is None or self.bitset.get(row, column) == checked:
+            return
+        self.bitset.set(row, column, checked)
+        position = row if self.visible_positions is None else self.visible_positions.get(row)
+        if position is None:
+            return
+        index = self.index(position, column)
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+
+    def add_customer(self, customer_id, name):
+        # New customers go to the end, not into name order, so no row shifts;
+        # the next full load sorts them in. Hidden while a search is shown.
+        row = len(self.customers)
+        if self.visible is None:
+            self.beginInsertRows(QModelIndex(), row, row)
+        self.customers.append((customer_id, name))
+        self.customer_rows[customer_id] = row
+        self.bitset.add_row()
+        if self.visible is None:
+            self.endInsertRows()
+
+    def customer_row(self, index_row):
+        return self.visible[index_row] if self.visible is not None else index_row
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.visible) if self.visible is not None else len(self.customers)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.categories)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role not in (Qt.DisplayRole, Qt.ToolTipRole):
+            return None
+        if orientation == Qt.Horizontal:
+            return self.categories[section][1]
+        return self.customers[self.customer_row(section)][1]
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled | Qt.ItemIsUserCheckable
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.CheckStateRole or not index.isValid():
+            return None
+        checked = self.bitset.get(self.customer_row(index.row()), index.column())
+        return Qt.Checked if checked else Qt.Unchecked
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.CheckStateRole or not index.isValid():
+            return False
+        checked = Qt.CheckState(value) == Qt.Checked
+        row = self.customer_row(index.row())
+        if self.bitset.get(row, index.column()) == checked:
+            return False
+        self.bitset.set(row, index.column(), checked)
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+        self.toggled.emit(self.customers[row][0], self.categories[index.column()][0], checked)
+        return True
+
+
+class CheckBoxDelegate(QStyledItemDelegate):
+    # Paints a centered check indicator; no widget exists per cell
+    def _indicator_rect(self, option):
+        style = option.widget.style() if option.widget else QApplication.style()
+        size = style.pixelMetric(QStyle.PM_IndicatorWidth)
+        rect = QRect(0, 0, size, size)
+        rect.moveCenter(option.rect.center())
+        return rect
+
+    def paint(self, painter, option, index):
+        indicator = QStyleOptionButton()
+        indicator.rect = self._indicator_rect(option)
+        indicator.state = QStyle.State_Enabled
+        indicator.state |= QStyle.State_On if index.data(Qt.CheckStateRole) == Qt.Checked else QStyle.State_Off
+        style = option.widget.style() if option.widget else QApplication.style()
+        style.drawPrimitive(QStyle.PE_IndicatorCheckBox, indicator, painter, option.widget)
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QEvent.MouseButtonRelease and option.rect.contains(event.position().toPoint()):
+            checked = index.data(Qt.CheckStateRole) == Qt.Checked
+            model.setData(index, Qt.Unchecked if checked else Qt.Checked, Qt.CheckStateRole)
+            return True
+        if event.type() == QEvent.MouseButtonDblClick:
+            return True
+        return super().editorEvent(event, model, option, index)
@@ -0,0 +1,149 @@
+# TaskRunner - runs DB and SMTP work on QThreadPool, results come back as signals
+import logging
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal
+from PySide6.QtWidgets import QStatusBar, QLabel, QProgressBar, QPushButton
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class TaskSignals(QObject):
+    # Emitted from the worker thread, delivered queued on the GUI thread
+    progress = Signal(int, int)
+    finished = Signal(object)
+    failed = Signal(object)
+    cancelled = Signal()
+
+
+class Task(QRunnable):
+    def __init__(self, name, fn, args, kwargs, reports_progress=False):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.reports_progress = reports_progress
+        self.signals = TaskSignals()
+        self.state = "queued"
+        self.done = 0
+        self.total = 0
+        self._cancel = False
+
+    def cancel(self):
+        self._cancel = True
+
+    @property
+    def is_cancelled(self):
+        return self._cancel
+
+    def report(self, done, total):
+        # Safe to call from any thread the task function uses
+        self.done, self.total = done, total
+        self.signals.progress.emit(done, total)
+
+    def raise_if_cancelled(self):
+        if self._cancel:
+            raise TaskCancelled()
+
+    def run(self):
+        if self._cancel:
+            self.state = "cancelled"
+            self.signals.cancelled.emit()
+            return
+        self.state = "running"
+        self.signals.progress.emit(0, 0)
+        try:
+            if self.reports_progress:
+                result = self.fn(*self.args, task=self, **self.kwargs)
+            else:
+                result = self.fn(*self.args, **self.kwargs)
+        except TaskCancelled:
+            self.state = "cancelled"
+            self.signals.cancelled.emit()
+        except Exception as e:
+            logging.error(f"Task '{self.name}' failed: {e}")
+            self.state = "failed"
+            self.signals.failed.emit(e)
+        else:
+            self.state = "finished"
+            self.signals.finished.emit(result)
+
+
+class TaskRunner(QObject):
+    # Emitted whenever a task is queued, progresses or ends
+    changed = Signal()
+
+    def __init__(self, parent=None, max_threads=4):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_threads)
+        self.tasks = []
+
+    def submit(self, name, fn, *args, on_done=None, on_error=None, on_progress=None,
+               reports_progress=False, **kwargs):
+        # With reports_progress=True, fn gets the Task as `task=` keyword to
+        # call task.report(done, total) and check task.is_cancelled
+        task = Task(name, fn, args, kwargs, reports_progress)
+        if on_done:
+            task.signals.finished.connect(on_done)
+        if on_error:
+            task.signals.failed.connect(on_error)
+        if on_progress:
+            task.signals.progress.connect(on_progress)
+        for signal in (task.signals.progress, task.signals.finished, task.signals.failed, task.signals.cancelled):
+            signal.connect(lambda *_, t=task: self._update(t))
+        self.tasks.append(task)
+        self.pool.start(task)
+        self.changed.emit()
+        return task
+
+    def active(self):
+        return [task for task in self.tasks if task.state in ("queued", "running")]
+
+    def cancel_all(self):
+        for task in self.active():
+            task.cancel()
+
+    def wait(self, msecs=-1):
+        return self.pool.waitForDone(msecs)
+
+    def _update(self, task):
+        if task.state not in ("queued", "running") and task in self.tasks:
+            self.tasks.remove(task)
+        self.changed.emit()
+
+
+class TaskStatusBar(QStatusBar):
+    # Shows the running task with its progress and the length of the queue
+    def __init__(self, runner, parent=None):
+        super().__init__(parent)
+        self.runner = runner
+        self.label = QLabel()
+        self.progress = QProgressBar()
+        self.progress.setMaximumWidth(200)
+        self.cancel_btn = QPushButton("Cancel")
+        self.cancel_btn.clicked.connect(self.runner.cancel_all)
+        self.addWidget(self.label, 1)
+        self.addPermanentWidget(self.progress)
+        self.addPermanentWidget(self.cancel_btn)
+        self.runner.changed.connect(self.refresh)
+        self.refresh()
+
+    def refresh(self):
+        active = self.runner.active()
+        running = [task for task in active if task.state == "running"]
+        queued = len(active) - len(running)
+        self.progress.setVisible(bool(active))
+        self.cancel_btn.setVisible(bool(active))
+        if not active:
+            self.label.setText("Ready")
+            return
+        task = running[0] if running else active[0]
+        text = task.name
+        if len(active) > 1:
+            text += f" (+{len(active) - 1} more, {queued} queued)"
+        self.label.setText(text)
+        self.progress.setRange(0, task.total)
+        self.progress.setValue(task.done)